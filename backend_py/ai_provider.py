@@ -3,11 +3,19 @@ AI提供商通用接口
 支持: Gemini (多模态), DeepSeek (文本), 千问VL (多模态)
 """
 import os
+import json
 import httpx
 import base64
-from typing import Optional, List, Dict, Any, Union
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Optional, List, Dict, Any, AsyncIterator
 from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
+import config
+from services import admission
+
 # 尝试导入Gemini
 try:
     import google.generativeai as genai
@@ -15,9 +23,76 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False
 
+# HTTP/2 依赖 h2 包，未安装时回退到 HTTP/1.1 长连接
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def _pool_options() -> Dict[str, Any]:
+    """AI提供商共享连接池参数"""
+    http2 = config.AI_HTTP2 and HTTP2_AVAILABLE
+    if config.AI_HTTP2 and not HTTP2_AVAILABLE:
+        print("⚠️ Warning: h2 not installed, AI HTTP clients fall back to HTTP/1.1")
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=config.AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=config.AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+async def _iter_sse_data(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """逐条解析上游SSE响应中的 data 字段（JSON）"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        payload = line[5:].strip()
+        if not payload or payload == "[DONE]":
+            continue
+        yield json.loads(payload)
+
+
+# 进程级提供商注册表：每种提供商只保留一个实例（及其连接池）
+_registry: Dict[str, "AIProvider"] = {}
+_registry_lock = threading.RLock()
+
+
 class AIProvider:
     """AI提供商基类"""
     
+    # 预热连接时请求的地址，None表示不需要预热
+    warmup_url: Optional[str] = None
+    
+    def __init__(self):
+        self._client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._client_lock = threading.Lock()
+    
+    @staticmethod
+    def get(provider: str = None) -> "AIProvider":
+        """
+        获取进程内共享的提供商实例（复用长连接）
+        
+        与 create 不同，同名提供商只初始化一次。
+        """
+        if provider is None:
+            provider = os.getenv("AI_PROVIDER", "gemini")
+        
+        name = provider.lower()
+        instance = _registry.get(name)
+        if instance is None:
+            with _registry_lock:
+                instance = _registry.get(name)
+                if instance is None:
+                    instance = AIProvider.create(name)
+                    _registry[name] = instance
+        return instance
+    
     @staticmethod
     def create(provider: str = None):
         """工厂方法创建AI提供商实例"""
@@ -30,6 +105,8 @@ class AIProvider:
             return DeepSeekProvider()
         elif provider.lower() == "qwen":
             return QwenVLProvider()
+        elif provider.lower() == "auto":
+            return RoutingProvider(config.AI_PROVIDER_CHAIN)
         else:
             raise ValueError(f"Unsupported AI provider: {provider}")
     
@@ -44,15 +121,100 @@ class AIProvider:
         """
         raise NotImplementedError
     
+    async def agenerate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """
+        异步生成文本内容，参数同 generate
+        
+        默认实现把同步 generate 放到线程中执行，避免阻塞事件循环；
+        子类应尽量覆盖为原生异步实现。
+        """
+        try:
+            return await asyncio.wait_for(
+                asyncio.to_thread(self.generate, prompt, images, timeout),
+                timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"AI API请求超时（{timeout}秒）")
+    
+    async def astream(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> AsyncIterator[str]:
+        """
+        流式生成文本内容，逐段产出增量文本，参数同 generate
+        
+        默认实现一次性产出完整结果；支持增量输出的子类应覆盖。
+        """
+        yield await self.agenerate(prompt, images=images, timeout=timeout)
+    
     def supports_multimodal(self) -> bool:
         """是否支持多模态（图片理解）"""
         return False
+    
+    @property
+    def client(self) -> httpx.Client:
+        """共享的同步HTTP客户端（懒加载）"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.Client(**_pool_options())
+        return self._client
+    
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """共享的异步HTTP客户端（懒加载）"""
+        if self._async_client is None:
+            with self._client_lock:
+                if self._async_client is None:
+                    self._async_client = httpx.AsyncClient(**_pool_options())
+        return self._async_client
+    
+    async def warmup(self) -> None:
+        """预先建立连接（DNS + TLS），失败不影响启动"""
+        if not self.warmup_url:
+            return
+        try:
+            await self.async_client.head(self.warmup_url, timeout=10)
+            print(f"{type(self).__name__} connection warmed up")
+        except httpx.HTTPError as e:
+            print(f"{type(self).__name__} warmup failed: {e}")
+    
+    async def aclose(self) -> None:
+        """关闭连接池"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+async def warmup_providers(names: List[str] = None) -> None:
+    """应用启动时预热提供商连接"""
+    if names is None:
+        names = [os.getenv("AI_PROVIDER", "gemini")]
+    for name in names:
+        try:
+            await AIProvider.get(name).warmup()
+        except (ImportError, ValueError) as e:
+            print(f"Skip warmup for {name}: {e}")
+
+
+async def close_providers() -> None:
+    """应用关闭时释放所有提供商连接"""
+    with _registry_lock:
+        providers = list(_registry.values())
+        _registry.clear()
+    for provider in providers:
+        await provider.aclose()
+
+
+# 同步 GeminiProvider.generate 使用的有界线程池（异步路径不占用线程）
+_gemini_executor = ThreadPoolExecutor(max_workers=config.GEMINI_SYNC_WORKERS, thread_name_prefix="gemini")
 
 
 class GeminiProvider(AIProvider):
     """Google Gemini提供商 - 支持多模态（图片理解）"""
     
     def __init__(self):
+        super().__init__()
         if not GEMINI_AVAILABLE:
             raise ImportError("google-generativeai not installed")
         
@@ -61,59 +223,114 @@ class GeminiProvider(AIProvider):
             raise ValueError("GEMINI_API_KEY environment variable is not set")
         
         genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel("gemini-1.5-pro")
+        self.model_name = "gemini-1.5-pro"
+        self.model = genai.GenerativeModel(self.model_name)
     
     def supports_multimodal(self) -> bool:
         return True
     
+    def _build_contents(self, prompt: str, images: List[Dict] = None) -> list:
+        """构建Gemini请求内容列表"""
+        contents = [prompt]
+        
+        # 如果有图片，以原始字节+MIME类型传入，无需在请求线程中解码
+        if images:
+            for img_data in images:
+                contents.append({
+                    "mime_type": img_data["mime_type"],
+                    "data": base64.b64decode(img_data["data"])
+                })
+        
+        return contents
+    
+    def _generation_config(self):
+        return genai.GenerationConfig(
+            temperature=0.7,
+            max_output_tokens=4096,
+        )
+    
     def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
         """调用Gemini API生成内容 - 支持图片"""
         print(f"Calling Gemini API... (timeout={timeout}s, images={len(images) if images else 0})")
         
         def call_api():
-            # 构建内容列表
-            contents = [prompt]
-            
-            # 如果有图片，添加到内容中
-            if images:
-                for img_data in images:
-                    # Gemini支持直接传入PIL Image或base64
-                    import io
-                    from PIL import Image
-                    
-                    # 解码base64图片
-                    img_bytes = base64.b64decode(img_data["data"])
-                    img = Image.open(io.BytesIO(img_bytes))
-                    contents.append(img)
-            
             response = self.model.generate_content(
-                contents,
-                generation_config=genai.GenerationConfig(
-                    temperature=0.7,
-                    max_output_tokens=4096,
-                )
+                self._build_contents(prompt, images),
+                generation_config=self._generation_config()
             )
             return response.text
         
-        # 使用线程池和超时
-        with ThreadPoolExecutor() as executor:
-            future = executor.submit(call_api)
-            try:
-                result = future.result(timeout=timeout)
-                print("Gemini API response received successfully")
-                return result
-            except FuturesTimeoutError:
-                print(f"Gemini API call timed out after {timeout} seconds")
-                raise TimeoutError(f"Gemini API请求超时（{timeout}秒）- 可能是网络问题或地区限制。建议：1) 开启VPN 2) 切换到DeepSeek")
-            except Exception as e:
-                print(f"Gemini API call failed: {e}")
-                raise
+        # 使用共享线程池和超时；不能用 with 块，否则超时后 __exit__ 仍会等待卡住的调用
+        future = _gemini_executor.submit(call_api)
+        try:
+            result = future.result(timeout=timeout)
+            print("Gemini API response received successfully")
+            return result
+        except FuturesTimeoutError:
+            future.cancel()
+            print(f"Gemini API call timed out after {timeout} seconds")
+            raise TimeoutError(f"Gemini API请求超时（{timeout}秒）- 可能是网络问题或地区限制。建议：1) 开启VPN 2) 切换到DeepSeek")
+        except Exception as e:
+            print(f"Gemini API call failed: {e}")
+            raise
+    
+    async def agenerate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """异步调用Gemini API生成内容 - 支持图片"""
+        print(f"Calling Gemini API (async)... (timeout={timeout}s, images={len(images) if images else 0})")
+        
+        try:
+            contents = self._build_contents(prompt, images)
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(
+                    contents,
+                    generation_config=self._generation_config()
+                ),
+                timeout=timeout
+            )
+            print("Gemini API response received successfully")
+            return response.text
+        except asyncio.TimeoutError:
+            print(f"Gemini API call timed out after {timeout} seconds")
+            raise TimeoutError(f"Gemini API请求超时（{timeout}秒）- 可能是网络问题或地区限制。建议：1) 开启VPN 2) 切换到DeepSeek")
+        except Exception as e:
+            print(f"Gemini API call failed: {e}")
+            raise
+
+
+    async def astream(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> AsyncIterator[str]:
+        """流式调用Gemini API（stream=True）"""
+        print(f"Streaming Gemini API... (timeout={timeout}s, images={len(images) if images else 0})")
+        
+        contents = self._build_contents(prompt, images)
+        try:
+            response = await asyncio.wait_for(
+                self.model.generate_content_async(
+                    contents,
+                    generation_config=self._generation_config(),
+                    stream=True
+                ),
+                timeout=timeout
+            )
+            chunks = response.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    yield chunk.text
+        except asyncio.TimeoutError:
+            print(f"Gemini API stream timed out after {timeout} seconds")
+            raise TimeoutError(f"Gemini API请求超时（{timeout}秒）- 可能是网络问题或地区限制。建议：1) 开启VPN 2) 切换到DeepSeek")
 
 
 class DeepSeekProvider(AIProvider):
     """DeepSeek提供商（国内访问更稳定，仅支持文本）"""
     
+    warmup_url = "https://api.deepseek.com"
+    
     def __init__(self):
+        super().__init__()
         self.api_key = os.getenv("DEEPSEEK_API_KEY")
         if not self.api_key:
             raise ValueError("DEEPSEEK_API_KEY environment variable is not set")
@@ -124,13 +341,8 @@ class DeepSeekProvider(AIProvider):
     def supports_multimodal(self) -> bool:
         return False
     
-    def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
-        """调用DeepSeek API生成内容（仅文本）"""
-        if images:
-            print("⚠️ Warning: DeepSeek does not support image understanding. Images will be ignored.")
-        
-        print(f"Calling DeepSeek API... (timeout={timeout}s)")
-        
+    def _build_request(self, prompt: str):
+        """构建请求URL、请求头和请求体"""
         url = f"{self.base_url}/v1/chat/completions"
         headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -144,19 +356,49 @@ class DeepSeekProvider(AIProvider):
             "temperature": 0.7,
             "max_tokens": 4096
         }
+        return url, headers, data
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        if "choices" in result and len(result["choices"]) > 0:
+            content = result["choices"][0]["message"]["content"]
+            print("DeepSeek API response received successfully")
+            return content
+        raise Exception("DeepSeek API returned invalid response")
+    
+    def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """调用DeepSeek API生成内容（仅文本）"""
+        if images:
+            print("⚠️ Warning: DeepSeek does not support image understanding. Images will be ignored.")
+        
+        print(f"Calling DeepSeek API... (timeout={timeout}s)")
+        
+        url, headers, data = self._build_request(prompt)
         
         try:
-            with httpx.Client(timeout=timeout) as client:
-                response = client.post(url, json=data, headers=headers)
-                response.raise_for_status()
-                result = response.json()
-                
-                if "choices" in result and len(result["choices"]) > 0:
-                    content = result["choices"][0]["message"]["content"]
-                    print("DeepSeek API response received successfully")
-                    return content
-                else:
-                    raise Exception("DeepSeek API returned invalid response")
+            response = self.client.post(url, json=data, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            return self._parse_response(response.json())
+        
+        except httpx.TimeoutException:
+            print(f"DeepSeek API call timed out after {timeout} seconds")
+            raise TimeoutError(f"DeepSeek API请求超时（{timeout}秒）")
+        except Exception as e:
+            print(f"DeepSeek API call failed: {e}")
+            raise
+    
+    async def agenerate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """异步调用DeepSeek API生成内容（仅文本）"""
+        if images:
+            print("⚠️ Warning: DeepSeek does not support image understanding. Images will be ignored.")
+        
+        print(f"Calling DeepSeek API (async)... (timeout={timeout}s)")
+        
+        url, headers, data = self._build_request(prompt)
+        
+        try:
+            response = await self.async_client.post(url, json=data, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            return self._parse_response(response.json())
         
         except httpx.TimeoutException:
             print(f"DeepSeek API call timed out after {timeout} seconds")
@@ -166,10 +408,37 @@ class DeepSeekProvider(AIProvider):
             raise
 
 
+    async def astream(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> AsyncIterator[str]:
+        """流式调用DeepSeek API（stream=true，增量返回delta）"""
+        if images:
+            print("⚠️ Warning: DeepSeek does not support image understanding. Images will be ignored.")
+        
+        print(f"Streaming DeepSeek API... (timeout={timeout}s)")
+        
+        url, headers, data = self._build_request(prompt)
+        data["stream"] = True
+        
+        try:
+            async with self.async_client.stream("POST", url, json=data, headers=headers, timeout=timeout) as response:
+                response.raise_for_status()
+                async for event in _iter_sse_data(response):
+                    choices = event.get("choices") or []
+                    if choices:
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+        except httpx.TimeoutException:
+            print(f"DeepSeek API stream timed out after {timeout} seconds")
+            raise TimeoutError(f"DeepSeek API请求超时（{timeout}秒）")
+
+
 class QwenVLProvider(AIProvider):
     """阿里千问VL提供商 - 支持多模态（图片理解），国内可用"""
     
+    warmup_url = "https://dashscope.aliyuncs.com"
+    
     def __init__(self):
+        super().__init__()
         self.api_key = os.getenv("QWEN_API_KEY")
         if not self.api_key:
             raise ValueError("QWEN_API_KEY environment variable is not set")
@@ -180,10 +449,8 @@ class QwenVLProvider(AIProvider):
     def supports_multimodal(self) -> bool:
         return True
     
-    def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
-        """调用千问VL API生成内容 - 支持图片理解"""
-        print(f"Calling Qwen VL API... (timeout={timeout}s, images={len(images) if images else 0})")
-        
+    def _build_request(self, prompt: str, images: List[Dict] = None):
+        """构建请求头和请求体"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -217,22 +484,28 @@ class QwenVLProvider(AIProvider):
                 "max_tokens": 4096
             }
         }
+        return headers, data
+    
+    def _parse_response(self, result: Dict[str, Any]) -> str:
+        if "output" in result and "choices" in result["output"]:
+            content_text = result["output"]["choices"][0]["message"]["content"]
+            # 千问VL返回的content可能是列表
+            if isinstance(content_text, list):
+                content_text = "".join([item.get("text", "") for item in content_text if item.get("text")])
+            print("Qwen VL API response received successfully")
+            return content_text
+        raise Exception("Qwen VL API returned invalid response")
+    
+    def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """调用千问VL API生成内容 - 支持图片理解"""
+        print(f"Calling Qwen VL API... (timeout={timeout}s, images={len(images) if images else 0})")
+        
+        headers, data = self._build_request(prompt, images)
         
         try:
-            with httpx.Client(timeout=timeout) as client:
-                response = client.post(self.base_url, json=data, headers=headers)
-                response.raise_for_status()
-                result = response.json()
-                
-                if "output" in result and "choices" in result["output"]:
-                    content_text = result["output"]["choices"][0]["message"]["content"]
-                    # 千问VL返回的content可能是列表
-                    if isinstance(content_text, list):
-                        content_text = "".join([item.get("text", "") for item in content_text if item.get("text")])
-                    print("Qwen VL API response received successfully")
-                    return content_text
-                else:
-                    raise Exception("Qwen VL API returned invalid response")
+            response = self.client.post(self.base_url, json=data, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            return self._parse_response(response.json())
         
         except httpx.TimeoutException:
             print(f"Qwen VL API call timed out after {timeout} seconds")
@@ -240,4 +513,365 @@ class QwenVLProvider(AIProvider):
         except Exception as e:
             print(f"Qwen VL API call failed: {e}")
             raise
+    
+    async def agenerate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """异步调用千问VL API生成内容 - 支持图片理解"""
+        print(f"Calling Qwen VL API (async)... (timeout={timeout}s, images={len(images) if images else 0})")
+        
+        headers, data = self._build_request(prompt, images)
+        
+        try:
+            response = await self.async_client.post(self.base_url, json=data, headers=headers, timeout=timeout)
+            response.raise_for_status()
+            return self._parse_response(response.json())
+        
+        except httpx.TimeoutException:
+            print(f"Qwen VL API call timed out after {timeout} seconds")
+            raise TimeoutError(f"千问VL API请求超时（{timeout}秒）")
+        except Exception as e:
+            print(f"Qwen VL API call failed: {e}")
+            raise
+    
+    async def astream(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> AsyncIterator[str]:
+        """流式调用千问VL API（DashScope SSE + incremental_output）"""
+        print(f"Streaming Qwen VL API... (timeout={timeout}s, images={len(images) if images else 0})")
+        
+        headers, data = self._build_request(prompt, images)
+        headers["X-DashScope-SSE"] = "enable"
+        data["parameters"]["incremental_output"] = True
+        
+        try:
+            async with self.async_client.stream("POST", self.base_url, json=data, headers=headers, timeout=timeout) as response:
+                response.raise_for_status()
+                async for event in _iter_sse_data(response):
+                    choices = event.get("output", {}).get("choices") or []
+                    if not choices:
+                        continue
+                    delta = choices[0].get("message", {}).get("content", "")
+                    if isinstance(delta, list):
+                        delta = "".join([item.get("text", "") for item in delta if item.get("text")])
+                    if delta:
+                        yield delta
+        except httpx.TimeoutException:
+            print(f"Qwen VL API stream timed out after {timeout} seconds")
+            raise TimeoutError(f"千问VL API请求超时（{timeout}秒）")
 
+
+class CircuitBreaker:
+    """
+    单个提供商的熔断器
+    
+    根据最近 window 次调用的失败率（错误或超过 slow_call_seconds 的慢调用）决定是否熔断；
+    熔断 cooldown 秒后进入半开状态，放行一次探测调用。
+    """
+    
+    def __init__(self, window: int = 20, failure_rate: float = 0.5, min_calls: int = 5,
+                 slow_call_seconds: float = 30, cooldown: float = 30):
+        self.window = deque(maxlen=window)
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.latencies = deque(maxlen=100)  # 成功调用耗时，用于计算p95
+    
+    def available(self) -> bool:
+        """是否可能放行调用（不改变状态）"""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self._probe_in_flight
+    
+    def allow(self) -> bool:
+        """放行一次调用；半开状态下只放行一个探测调用"""
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+    
+    def record(self, success: bool, latency: float) -> None:
+        failed = not success or latency > self.slow_call_seconds
+        if success:
+            self.latencies.append(latency)
+        
+        if self.state == "half_open":
+            self._probe_in_flight = False
+            if failed:
+                self._open()
+            else:
+                self.state = "closed"
+                self.window.clear()
+            return
+        
+        self.window.append(failed)
+        if len(self.window) >= self.min_calls and sum(self.window) / len(self.window) >= self.failure_rate:
+            self._open()
+    
+    def release(self) -> None:
+        """调用被取消、没有结果：不计入统计；半开状态下释放探测名额"""
+        if self.state == "half_open":
+            self._probe_in_flight = False
+    
+    def _open(self) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.window.clear()
+    
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < 10:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "recent_calls": len(self.window),
+            "recent_failures": sum(self.window),
+            "p95_latency": self.p95()
+        }
+
+
+class RoutingProvider(AIProvider):
+    """
+    路由提供商：按顺序在多个提供商间故障转移
+    
+    - 每个提供商一个熔断器，熔断期间直接跳过
+    - 有图片的请求只路由到支持多模态的提供商
+    - 可选对冲请求：首选提供商超过其p95耗时仍未返回时，并行向下一个提供商发起请求
+    - 准入按实际调用的成员提供商申请名额（见 services/admission.acquire_member），
+      成员名额不足时转到下一个提供商，不计入熔断统计
+    """
+    
+    def __init__(self, chain: List[str]):
+        super().__init__()
+        self.chain = [name.strip().lower() for name in chain if name.strip()]
+        if not self.chain:
+            raise ValueError("AI provider chain is empty")
+        self.model_name = ",".join(self.chain)
+        self.breakers: Dict[str, CircuitBreaker] = {
+            name: CircuitBreaker(
+                slow_call_seconds=config.AI_BREAKER_SLOW_CALL,
+                cooldown=config.AI_BREAKER_COOLDOWN
+            )
+            for name in self.chain
+        }
+        self._unavailable: Dict[str, str] = {}
+    
+    def _member(self, name: str) -> Optional[AIProvider]:
+        if name in self._unavailable:
+            return None
+        try:
+            return AIProvider.get(name)
+        except (ImportError, ValueError) as e:
+            # 未配置的提供商（缺少API Key或依赖）不参与路由
+            print(f"Routing: provider {name} unavailable: {e}")
+            self._unavailable[name] = str(e)
+            return None
+    
+    def supports_multimodal(self) -> bool:
+        return any(p.supports_multimodal() for p in self._members())
+    
+    def _members(self) -> List[AIProvider]:
+        return [p for p in (self._member(name) for name in self.chain) if p is not None]
+    
+    def _candidates(self, images: List[Dict] = None) -> List[tuple]:
+        """按顺序返回当前可用的 (名称, 提供商)"""
+        candidates = []
+        for name in self.chain:
+            provider = self._member(name)
+            if provider is None:
+                continue
+            if images and not provider.supports_multimodal():
+                continue
+            candidates.append((name, provider))
+        if not candidates:
+            raise RuntimeError("没有可用的AI提供商" + ("（需要支持图片理解）" if images else ""))
+        return candidates
+    
+    def _attempt_timeout(self, remaining: float, is_last: bool) -> float:
+        # 给后续提供商留出时间；最后一个提供商可以用完剩余预算
+        return remaining if is_last else min(remaining, config.AI_ROUTE_ATTEMPT_TIMEOUT)
+    
+    async def _admit(self, name: str, wait: bool = True) -> Optional["admission.Ticket"]:
+        """申请成员提供商的名额；未获准入时释放半开状态的探测名额"""
+        try:
+            return await admission.acquire_member(name, wait=wait)
+        except BaseException:
+            self.breakers[name].release()
+            raise
+    
+    async def _call(self, name: str, provider: AIProvider, prompt: str, images: List[Dict], timeout: float,
+                    wait_admission: bool = True) -> str:
+        breaker = self.breakers[name]
+        ticket = await self._admit(name, wait=wait_admission)
+        started = time.monotonic()
+        try:
+            result = await provider.agenerate(prompt, images=images, timeout=timeout)
+        except asyncio.CancelledError:
+            # 对冲落败或上层取消，不计入熔断统计
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record(False, time.monotonic() - started)
+            raise
+        finally:
+            if ticket is not None:
+                ticket.release()
+        breaker.record(True, time.monotonic() - started)
+        return result
+    
+    async def _hedged(self, primary: tuple, backup: tuple, prompt: str, images: List[Dict],
+                      timeout: float, hedge_after: float) -> str:
+        """首选请求超过 hedge_after 秒未返回时，向备选提供商发起对冲请求，取先成功者"""
+        deadline = time.monotonic() + timeout
+        first = asyncio.ensure_future(self._call(*primary, prompt, images, timeout))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done and self.breakers[backup[0]].allow():
+                print(f"Routing: {primary[0]} slower than p95 ({hedge_after:.1f}s), hedging to {backup[0]}")
+                remaining = max(deadline - time.monotonic(), 0.1)
+                # 对冲请求不排队：备选提供商没有空闲名额时放弃对冲
+                tasks.add(asyncio.ensure_future(self._call(*backup, prompt, images, remaining, wait_admission=False)))
+            
+            last_error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise TimeoutError(f"AI API请求超时（{timeout:g}秒）")
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def agenerate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        deadline = time.monotonic() + timeout
+        candidates = [c for c in self._candidates(images) if self.breakers[c[0]].available()]
+        last_error: Optional[Exception] = None
+        for idx, (name, provider) in enumerate(candidates):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breakers[name].allow():
+                continue
+            is_last = idx == len(candidates) - 1
+            attempt_timeout = self._attempt_timeout(remaining, is_last)
+            try:
+                hedge_after = self.breakers[name].p95() if config.AI_HEDGE_ENABLED else None
+                if hedge_after is not None and not is_last and hedge_after < attempt_timeout:
+                    backup = candidates[idx + 1]
+                    return await self._hedged((name, provider), backup, prompt, images, attempt_timeout, hedge_after)
+                return await self._call(name, provider, prompt, images, attempt_timeout)
+            except Exception as e:
+                print(f"Routing: provider {name} failed: {e}")
+                last_error = e
+        
+        self._raise_exhausted(last_error, timeout)
+    
+    def generate(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> str:
+        """同步故障转移（不做对冲）"""
+        deadline = time.monotonic() + timeout
+        candidates = [c for c in self._candidates(images) if self.breakers[c[0]].available()]
+        last_error: Optional[Exception] = None
+        for idx, (name, provider) in enumerate(candidates):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self.breakers[name].allow():
+                continue
+            started = time.monotonic()
+            try:
+                result = provider.generate(
+                    prompt, images=images,
+                    timeout=self._attempt_timeout(remaining, idx == len(candidates) - 1)
+                )
+            except Exception as e:
+                self.breakers[name].record(False, time.monotonic() - started)
+                print(f"Routing: provider {name} failed: {e}")
+                last_error = e
+                continue
+            self.breakers[name].record(True, time.monotonic() - started)
+            return result
+        self._raise_exhausted(last_error, timeout)
+    
+    async def astream(self, prompt: str, images: List[Dict] = None, timeout: int = 30) -> AsyncIterator[str]:
+        """流式故障转移：只在尚未输出任何内容前切换提供商"""
+        deadline = time.monotonic() + timeout
+        candidates = [c for c in self._candidates(images) if self.breakers[c[0]].available()]
+        last_error: Optional[Exception] = None
+        for idx, (name, provider) in enumerate(candidates):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            breaker = self.breakers[name]
+            if not breaker.allow():
+                continue
+            try:
+                ticket = await self._admit(name)
+            except admission.AdmissionRejected as e:
+                print(f"Routing: provider {name} not admitted: {e}")
+                last_error = e
+                continue
+            started = time.monotonic()
+            emitted = False
+            finished = False
+            try:
+                async for chunk in provider.astream(
+                    prompt, images=images,
+                    timeout=self._attempt_timeout(remaining, idx == len(candidates) - 1)
+                ):
+                    emitted = True
+                    yield chunk
+                finished = True
+            except Exception as e:
+                finished = True
+                breaker.record(False, time.monotonic() - started)
+                if emitted:
+                    raise
+                print(f"Routing: provider {name} stream failed: {e}")
+                last_error = e
+                continue
+            finally:
+                # 被取消（CancelledError）或消费方提前关闭生成器（GeneratorExit）时没有结果，
+                # 也要释放半开状态的探测名额，否则该提供商会一直被跳过
+                if not finished:
+                    breaker.release()
+                if ticket is not None:
+                    ticket.release()
+            breaker.record(True, time.monotonic() - started)
+            return
+        self._raise_exhausted(last_error, timeout)
+    
+    def _raise_exhausted(self, last_error: Optional[Exception], timeout: float) -> None:
+        if last_error is None:
+            if all(not b.available() for b in self.breakers.values()):
+                raise RuntimeError("所有AI提供商均处于熔断状态，请稍后重试")
+            raise TimeoutError(f"AI API请求超时（{timeout:g}秒），所有提供商均未及时响应")
+        if isinstance(last_error, TimeoutError):
+            raise TimeoutError(f"AI API请求超时（{timeout:g}秒），所有提供商均未及时响应")
+        raise last_error
+    
+    async def warmup(self) -> None:
+        for provider in self._members():
+            await provider.warmup()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """各提供商的熔断状态"""
+        return {
+            name: dict(self.breakers[name].snapshot(), unavailable=self._unavailable.get(name))
+            for name in self.chain
+        }
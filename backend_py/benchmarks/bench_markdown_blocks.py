@@ -0,0 +1,133 @@
+"""
+Markdown → 飞书blocks 转换的微基准
+
+用法（在 backend_py 目录下）：
+    python benchmarks/bench_markdown_blocks.py --size-mb 4
+
+对比：
+- legacy：原 create_feishu_document 中的逐行 startswith + 每行调用 re.match 的实现
+- compiler 整篇：MarkdownBlockCompiler 一次喂入全文
+- compiler 流式：按小块喂入（模拟AI流式输出）
+- 仅标题/图片/段落：legacy 能处理的输入，对比两者在相同功能下的开销
+
+legacy 不解析行内样式、列表、代码块和表格（原样写成段落），在混合样式的输入上
+compiler 慢出的部分主要是 parse_inline 的行内样式解析和多出来的 text_run/style 对象。
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services.markdown_blocks import compile_markdown
+
+SAMPLE_LINES = [
+    "# 一级标题",
+    "## 二级标题 **加粗**",
+    "### 三级标题",
+    "普通段落，包含 **粗体**、*斜体*、`行内代码` 和 [链接](https://example.com/a?b=1)。" * 2,
+    "这是一段比较长的正文，用来模拟AI生成的文章内容，没有任何样式标记。" * 3,
+    "- 无序列表项 ~~删除~~",
+    "1. 有序列表项",
+    "> 引用内容",
+    "![配图](image_1)",
+    "",
+]
+# 只含 legacy 支持的语法
+PLAIN_LINES = [
+    "# 一级标题",
+    "## 二级标题",
+    "### 三级标题",
+    "这是一段比较长的正文，用来模拟AI生成的文章内容，没有任何样式标记。" * 3,
+    "![配图](image_1)",
+    "",
+]
+CODE_BLOCK = ["```python", "def hello():", "    return 'world'", "```"]
+TABLE = ["| 名称 | 数值 | 说明 |", "|---|---:|:---|", "| a | 1 | 第一行 |", "| b | 2 | 第二行 |"]
+
+
+def make_document(size_bytes: int, seed: int = 0, plain: bool = False) -> str:
+    rng = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size_bytes:
+        roll = rng.random()
+        if plain:
+            chunk = [rng.choice(PLAIN_LINES)]
+        elif roll < 0.03:
+            chunk = CODE_BLOCK
+        elif roll < 0.05:
+            chunk = TABLE
+        else:
+            chunk = [rng.choice(SAMPLE_LINES)]
+        lines.extend(chunk)
+        total += sum(len(line.encode()) + 1 for line in chunk)
+    return "\n".join(lines)
+
+
+def legacy_convert(content: str) -> list:
+    """原实现（仅标题、图片、段落）"""
+    blocks = []
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        img_match = re.match(r'!\[([^\]]*)\]\(image_(\d+)\)', line)
+        if img_match:
+            blocks.append({"block_type": 27, "image": {"token": f"image_{img_match.group(2)}"}})
+            continue
+        if line.startswith('####'):
+            blocks.append({"block_type": 5, "heading3": {"elements": [{"text_run": {"content": line[5:].strip()}}]}})
+        elif line.startswith('###'):
+            blocks.append({"block_type": 5, "heading3": {"elements": [{"text_run": {"content": line[4:].strip()}}]}})
+        elif line.startswith('##'):
+            blocks.append({"block_type": 4, "heading2": {"elements": [{"text_run": {"content": line[3:].strip()}}]}})
+        elif line.startswith('#'):
+            blocks.append({"block_type": 3, "heading1": {"elements": [{"text_run": {"content": line[2:].strip()}}]}})
+        else:
+            blocks.append({"block_type": 2, "text": {"elements": [{"text_run": {"content": line}}]}})
+    return blocks
+
+
+def split_chunks(text: str, chunk_size: int) -> list:
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def bench(name: str, func, size_bytes: int, repeat: int) -> None:
+    best = float("inf")
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {best * 1000:9.1f} ms  {size_bytes / best / 1024 / 1024:7.1f} MB/s  {count} blocks")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=4.0, help="生成的Markdown大小（MB）")
+    parser.add_argument("--chunk", type=int, default=64, help="流式喂入时每块的字符数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数（取最好成绩）")
+    args = parser.parse_args()
+
+    document = make_document(int(args.size_mb * 1024 * 1024))
+    size_bytes = len(document.encode())
+    chunks = split_chunks(document, args.chunk)
+    print(f"Input: {size_bytes / 1024 / 1024:.2f} MB, {document.count(chr(10)) + 1} lines, "
+          f"{len(chunks)} chunks of {args.chunk} chars\n")
+
+    bench("legacy (headings/images)", lambda: len(legacy_convert(document)), size_bytes, args.repeat)
+    bench("compiler, whole text", lambda: sum(1 for _ in compile_markdown([document])), size_bytes, args.repeat)
+    bench(f"compiler, {args.chunk}-char chunks", lambda: sum(1 for _ in compile_markdown(chunks)), size_bytes, args.repeat)
+
+    plain = make_document(int(args.size_mb * 1024 * 1024), plain=True)
+    plain_bytes = len(plain.encode())
+    print(f"\nHeadings/images/paragraphs only: {plain_bytes / 1024 / 1024:.2f} MB\n")
+    bench("legacy (headings/images)", lambda: len(legacy_convert(plain)), plain_bytes, args.repeat)
+    bench("compiler, whole text", lambda: sum(1 for _ in compile_markdown([plain])), plain_bytes, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
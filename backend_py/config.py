@@ -18,3 +18,110 @@ DEEPSEEK_MODEL = "deepseek-chat"
 # 请求超时设置（秒）
 API_TIMEOUT = 30
 
+
+# AI提供商HTTP连接池设置（进程内共享，长连接复用）
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "50"))
+AI_HTTP_MAX_KEEPALIVE = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "20"))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY", "120"))
+# 是否启用HTTP/2（需要安装 h2，即 httpx[http2]）
+AI_HTTP2 = os.getenv("AI_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# AI生成结果缓存
+GENERATION_CACHE_SIZE = int(os.getenv("GENERATION_CACHE_SIZE", "256"))
+# 磁盘缓存路径（SQLite），为空则只使用内存缓存
+GENERATION_CACHE_DISK_PATH = os.getenv("GENERATION_CACHE_DISK_PATH", "")
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", "86400"))
+GENERATION_CACHE_MAX_DISK_MB = int(os.getenv("GENERATION_CACHE_MAX_DISK_MB", "200"))
+
+# 多模态调用前的图片预处理
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1568"))  # 最长边像素
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()  # "jpeg" 或 "webp"
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# 感知哈希汉明距离不超过该值视为重复图片；默认 -1，只去除完全相同的图片
+# （8x8 dHash 对纯色、简单图形区分度很低，开启时建议取 0~2）
+IMAGE_DEDUP_DISTANCE = int(os.getenv("IMAGE_DEDUP_DISTANCE", "-1"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+
+# 生成文章时下载文档图片
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "6"))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "20"))
+
+# 请求时间预算：一次AI请求（含下载图片）的总时长上限，客户端可用 X-Request-Timeout 头缩短
+AI_REQUEST_BUDGET = float(os.getenv("AI_REQUEST_BUDGET", "90"))
+# 单次AI提供商调用的超时上限（秒）
+AI_PROVIDER_TIMEOUT = float(os.getenv("AI_PROVIDER_TIMEOUT", "60"))
+# 同步Gemini调用的线程池大小
+GEMINI_SYNC_WORKERS = int(os.getenv("GEMINI_SYNC_WORKERS", "8"))
+
+# AI_PROVIDER=auto 时的故障转移顺序
+AI_PROVIDER_CHAIN = os.getenv("AI_PROVIDER_CHAIN", "qwen,gemini,deepseek").split(",")
+# 非最后一个提供商单次尝试的超时上限，为后续提供商留出时间
+AI_ROUTE_ATTEMPT_TIMEOUT = float(os.getenv("AI_ROUTE_ATTEMPT_TIMEOUT", "30"))
+# 熔断：超过该耗时（秒）的调用计为慢调用；熔断后冷却时间（秒）
+AI_BREAKER_SLOW_CALL = float(os.getenv("AI_BREAKER_SLOW_CALL", "45"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+# 首选提供商超过其p95耗时仍未返回时，向下一个提供商发起对冲请求
+AI_HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# AI调用准入控制
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))  # 每个提供商默认并发上限
+AI_CONCURRENCY_LIMITS = os.getenv("AI_CONCURRENCY_LIMITS", "")  # 按提供商覆盖，如 "qwen=4,deepseek=8"
+AI_MAX_QUEUE = int(os.getenv("AI_MAX_QUEUE", "32"))  # 每个提供商的等待队列长度
+AI_MAX_PER_USER = int(os.getenv("AI_MAX_PER_USER", "2"))  # 单用户同时进行+排队的请求数
+
+# 后台批量生成任务
+BATCH_JOB_DIR = os.getenv("BATCH_JOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jobs"))
+BATCH_JOB_CONCURRENCY = int(os.getenv("BATCH_JOB_CONCURRENCY", "2"))
+BATCH_JOB_MAX_RETRIES = int(os.getenv("BATCH_JOB_MAX_RETRIES", "3"))  # 被准入控制拒绝时的重试次数
+BATCH_JOB_LEASE = float(os.getenv("BATCH_JOB_LEASE", "60"))  # 执行任务的租约时长（秒），执行期间每1/3时长续期一次
+
+# 文档内容缓存（按修订版本校验）的内存上限
+DOCUMENT_CACHE_MAX_MB = int(os.getenv("DOCUMENT_CACHE_MAX_MB", "64"))
+
+# 图片代理磁盘缓存（image_token 对应的内容不可变）
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "images"))
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "512"))
+# 缓存命中时向飞书确认用户对图片的访问权限，确认结果在进程内保留的秒数
+IMAGE_ACCESS_CHECK_TTL = float(os.getenv("IMAGE_ACCESS_CHECK_TTL", "300"))
+# 图片缩略图变体：请求的宽度向上取到最近的档位，限制缓存中的变体数量
+IMAGE_VARIANT_WIDTHS = [int(w) for w in os.getenv("IMAGE_VARIANT_WIDTHS", "160,320,640,960,1280,1920").split(",")]
+IMAGE_VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+
+# 飞书开放平台调用限流：应用级总QPS；被限流时的重试次数与退避时间（秒）
+FEISHU_APP_QPS = float(os.getenv("FEISHU_APP_QPS", "50"))
+FEISHU_MAX_RETRIES = int(os.getenv("FEISHU_MAX_RETRIES", "4"))
+FEISHU_RETRY_BASE_DELAY = float(os.getenv("FEISHU_RETRY_BASE_DELAY", "0.5"))
+FEISHU_RETRY_MAX_DELAY = float(os.getenv("FEISHU_RETRY_MAX_DELAY", "8"))
+# 写回飞书文档时并发上传图片的数量（仍受上面的限流约束）
+FEISHU_UPLOAD_CONCURRENCY = int(os.getenv("FEISHU_UPLOAD_CONCURRENCY", "4"))
+# 写入文档blocks时同时在途的批次数，以及单批失败的重试次数
+FEISHU_WRITE_WINDOW = int(os.getenv("FEISHU_WRITE_WINDOW", "2"))
+FEISHU_WRITE_RETRIES = int(os.getenv("FEISHU_WRITE_RETRIES", "3"))
+
+# 飞书API共享连接池（应用生命周期内复用，可用时启用HTTP/2多路复用）
+FEISHU_HTTP_MAX_CONNECTIONS = int(os.getenv("FEISHU_HTTP_MAX_CONNECTIONS", "100"))
+FEISHU_HTTP_MAX_KEEPALIVE = int(os.getenv("FEISHU_HTTP_MAX_KEEPALIVE", "20"))
+FEISHU_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("FEISHU_HTTP_KEEPALIVE_EXPIRY", "60"))
+FEISHU_HTTP2 = os.getenv("FEISHU_HTTP2", "true").lower() in ("1", "true", "yes")
+# 超时（秒）：连接超时、默认读超时，以及上传/下载/写入blocks等慢接口的读超时
+FEISHU_CONNECT_TIMEOUT = float(os.getenv("FEISHU_CONNECT_TIMEOUT", "5"))
+FEISHU_TIMEOUT = float(os.getenv("FEISHU_TIMEOUT", "15"))
+FEISHU_UPLOAD_TIMEOUT = float(os.getenv("FEISHU_UPLOAD_TIMEOUT", "60"))
+FEISHU_DOWNLOAD_TIMEOUT = float(os.getenv("FEISHU_DOWNLOAD_TIMEOUT", "30"))
+FEISHU_WRITE_TIMEOUT = float(os.getenv("FEISHU_WRITE_TIMEOUT", "30"))
+# app_access_token 缓存：过期前多少秒开始后台刷新（飞书在剩余不足30分钟时才签发新token，需小于1800）
+FEISHU_APP_TOKEN_REFRESH_MARGIN = float(os.getenv("FEISHU_APP_TOKEN_REFRESH_MARGIN", "300"))
+
+# AI创作会话存储：闲置多久后过期（秒），以及所有会话占用的上限（按LRU淘汰）
+SESSION_TTL = float(os.getenv("SESSION_TTL", "7200"))
+SESSION_STORE_MAX_MB = int(os.getenv("SESSION_STORE_MAX_MB", "512"))
+# 会话存储后端：memory（单进程）、sqlite（同机多个worker共享）、redis（多机共享，需要安装redis包）
+SESSION_STORE_BACKEND = os.getenv("SESSION_STORE_BACKEND", "memory").lower()
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sessions.db"))
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+# 会话图片按内容SHA-256存放在磁盘上（会话中只保存引用），超过TTL（秒）未使用的图片被清理，默认为会话TTL的2倍
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "session_images"))
+IMAGE_STORE_TTL = float(os.getenv("IMAGE_STORE_TTL", "0"))
+
+# 局部精修时，随提纲附带的待修改部分前后的原文字符数
+REFINE_CONTEXT_CHARS = int(os.getenv("REFINE_CONTEXT_CHARS", "200"))
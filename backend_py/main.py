@@ -1,13 +1,12 @@
 """
 飞书妙笔 - 后端主入口
 """
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
 
-from routers import auth, documents, ai
-
 # 直接设置环境变量，避免.env文件编码问题
 os.environ["FEISHU_APP_ID"] = "cli_a855c1780938900b"
 os.environ["FEISHU_APP_SECRET"] = "DXAXNDNvdviTiPgt64f3rbqF6pPCiVEv"
@@ -19,6 +18,7 @@ os.environ["DEEPSEEK_API_KEY"] = "sk-7a5f88d8af69468590b756add1514b57"
 # - "deepseek": 仅文本理解，国内直接可用
 # - "gemini": 支持图片理解和智能排版，需要VPN
 # - "qwen": 支持图片理解和智能排版，国内直接可用 ⭐推荐
+# - "auto": 按 AI_PROVIDER_CHAIN 顺序故障转移（带熔断），有图片时只路由到多模态模型
 
 # 千问VL配置 - 支持图片理解和智能排版
 os.environ["QWEN_API_KEY"] = "sk-8dea6d7ed4864155a0fa33433c5c58a4"
@@ -33,10 +33,35 @@ os.environ["FRONTEND_URL"] = "http://localhost:3000"
 # 加载环境变量
 load_dotenv()
 
+# config 在导入时读取环境变量，路由和服务模块必须在上面的设置和 load_dotenv() 之后导入
+from routers import auth, documents, ai, jobs  # noqa: E402
+from ai_provider import warmup_providers, close_providers  # noqa: E402
+from services.image_pipeline import shutdown_executor  # noqa: E402
+from services.batch_jobs import batch_jobs  # noqa: E402
+from services.feishu_api import start_client, close_client  # noqa: E402
+from services.app_token import app_token_manager  # noqa: E402
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时预热AI和飞书连接并检查未完成的批量任务，关闭时释放连接池和进程池"""
+    await warmup_providers()
+    await start_client()
+    app_token_manager.start()
+    await batch_jobs.load_checkpoints()
+    yield
+    await batch_jobs.shutdown()
+    await app_token_manager.stop()
+    await close_providers()
+    await close_client()
+    shutdown_executor()
+
+
 app = FastAPI(
     title="飞书妙笔 API",
     description="智能内容创作辅助应用后端服务",
-    version="1.1.0"
+    version="1.1.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -52,6 +77,7 @@ app.add_middleware(
 app.include_router(auth.router, prefix="/api/auth", tags=["认证"])
 app.include_router(documents.router, prefix="/api/documents", tags=["文档"])
 app.include_router(ai.router, prefix="/api/ai", tags=["AI创作"])
+app.include_router(jobs.router, prefix="/api/jobs", tags=["批量任务"])
 
 
 @app.get("/")
@@ -1,24 +1,36 @@
 """
 AI创作路由 - 支持多种AI提供商（Gemini, DeepSeek）
 """
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, HTTPException, Header, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import os
-import httpx
-import base64
-from io import BytesIO
+import json
+import asyncio
+import hashlib
+import time
 
 # 导入AI提供商
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from ai_provider import AIProvider
+import config
+from ai_provider import AIProvider, RoutingProvider
+from services.image_refs import fix_image_refs, ImageRefStreamFixer
+from services.article_sections import find_section, snap_range, build_outline, referenced_images, splice_section
+from services.image_pipeline import preprocess_images
+from services.image_cache import image_cache
+from services.generation_cache import generation_cache, make_key
+from services.session_store import session_store
+from services.image_store import image_store, ImageMissingError
+from services.deadline import Deadline, ClientDisconnected, run_with_deadline
+from services import admission
+from services.admission import AdmissionRejected, PRIORITY_CREATE, PRIORITY_REFINE
+from routers import documents
 
 router = APIRouter()
 
-# 会话存储（生产环境应使用Redis等）
-sessions: Dict[str, Dict[str, Any]] = {}
-
 
 class Message(BaseModel):
     role: str  # "user" 或 "assistant"
@@ -30,67 +42,27 @@ class CreateRequest(BaseModel):
     blocks: List[dict]
     instruction: str
     session_id: Optional[str] = None
+    no_cache: bool = False  # True时跳过生成缓存，重新生成一个版本
 
 
 class RefineRequest(BaseModel):
     session_id: str
     instruction: str
+    no_cache: bool = False  # True时跳过生成缓存，重新生成一个版本
+    # 局部精修：只修改某个标题下的章节，或 [range_start, range_end) 字符范围（按整行扩展）
+    section: Optional[str] = None
+    range_start: Optional[int] = None
+    range_end: Optional[int] = None
 
 
 class AIResponse(BaseModel):
     session_id: str
     content: str
     messages: List[Message]
+    failed_images: List[Dict[str, str]] = []  # 下载失败的图片及原因
 
 
-@router.post("/create", response_model=AIResponse)
-async def create_article(
-    request: CreateRequest,
-    authorization: str = Header(...)
-):
-    """
-    首次生成文章
-    """
-    try:
-        print(f"AI Create request received: doc_id={request.doc_id}, blocks_count={len(request.blocks)}")
-        
-        # 检查Gemini API Key
-        gemini_key = os.getenv("GEMINI_API_KEY")
-        if not gemini_key:
-            raise HTTPException(status_code=500, detail="Gemini API Key未配置")
-        
-        print(f"Gemini API Key configured: {gemini_key[:10]}...")
-        
-        token = authorization.replace("Bearer ", "")
-        
-        # 准备内容
-        text_content = []
-        image_parts = []
-        
-        async with httpx.AsyncClient() as client:
-            for block in request.blocks:
-                if block.get("block_type") == "text" and block.get("text"):
-                    text_content.append(block["text"])
-                    
-                elif block.get("block_type") == "image" and block.get("image_token"):
-                    # 下载图片
-                    try:
-                        img_response = await client.get(
-                            f"https://open.feishu.cn/open-apis/drive/v1/medias/{block['image_token']}/download",
-                            headers={"Authorization": f"Bearer {token}"}
-                        )
-                        if img_response.status_code == 200:
-                            image_parts.append({
-                                "mime_type": "image/jpeg",
-                                "data": base64.b64encode(img_response.content).decode()
-                            })
-                    except Exception as e:
-                        print(f"下载图片失败: {e}")
-        
-        # 构建prompt
-        combined_text = "\n\n".join(text_content)
-        
-        system_prompt = """你是一位专业的内容创作和排版助手。你的任务是：
+SYSTEM_PROMPT = """你是一位专业的内容创作和排版助手。你的任务是：
 1. **理解图片内容**：仔细分析每张图片的内容、主题和信息
 2. **智能排版**：根据图片内容和文本内容的关联性，将图片插入到文章最合适的位置
 3. **重新组织**：优化文章结构，使文字和图片协同表达，逻辑连贯
@@ -107,7 +79,83 @@ async def create_article(
 - 保持原文的核心信息和观点
 """
 
-        user_prompt = f"""原始文本内容：
+
+async def download_images(image_tokens: List[str], token: str, timeout: float = None):
+    """
+    并发下载飞书图片，并发数受限，单张图片独立超时
+    
+    原图经由图片磁盘缓存获取：前端预览过的图片不会再次从飞书下载（命中缓存时仍校验访问权限）。
+    返回 (按输入顺序排列的图片字节列表（失败项为None）, 失败列表)
+    """
+    if timeout is None:
+        timeout = config.IMAGE_DOWNLOAD_TIMEOUT
+    semaphore = asyncio.Semaphore(config.IMAGE_DOWNLOAD_CONCURRENCY)
+    failed_images: List[Dict[str, str]] = []
+    
+    async def download(image_token: str) -> Optional[bytes]:
+        async with semaphore:
+            try:
+                entry = await asyncio.wait_for(
+                    documents.get_cached_image(image_token, token),
+                    timeout=timeout
+                )
+                return await image_cache.read(entry)
+            except asyncio.TimeoutError:
+                error = f"下载超时（{timeout:.0f}秒）"
+            except HTTPException as e:
+                error = e.detail
+            except Exception as e:
+                error = str(e)
+            print(f"下载图片失败: {image_token} - {error}")
+            failed_images.append({"image_token": image_token, "error": error})
+            return None
+    
+    if not image_tokens:
+        return [], failed_images
+    
+    results = await asyncio.gather(*[download(t) for t in image_tokens])
+    
+    print(f"Downloaded {len(image_tokens) - len(failed_images)}/{len(image_tokens)} images")
+    return list(results), failed_images
+
+
+async def _prepare_create(request: CreateRequest, token: str, deadline: Deadline) -> Dict[str, Any]:
+    """
+    准备首次生成所需的内容：提取文本、下载图片、构建prompt
+    """
+    # 检查Gemini API Key
+    gemini_key = os.getenv("GEMINI_API_KEY")
+    if not gemini_key:
+        raise HTTPException(status_code=500, detail="Gemini API Key未配置")
+    
+    print(f"Gemini API Key configured: {gemini_key[:10]}...")
+    
+    # 准备内容
+    text_content = []
+    image_tokens = []
+    
+    for block in request.blocks:
+        if block.get("block_type") == "text" and block.get("text"):
+            text_content.append(block["text"])
+        elif block.get("block_type") == "image" and block.get("image_token"):
+            image_tokens.append(block["image_token"])
+    
+    # 并发下载图片（保持文档中的顺序，image_N编号稳定）
+    downloaded, failed_images = await download_images(
+        image_tokens, token, timeout=deadline.timeout(config.IMAGE_DOWNLOAD_TIMEOUT)
+    )
+    raw_images = [data for data in downloaded if data is not None]
+    
+    # 识别格式、缩放、重新编码并去重；结果存入图片存储，之后只传递引用
+    image_parts = [
+        await image_store.put(img["content"], img["mime_type"], img["sha256"])
+        for img in await preprocess_images(raw_images)
+    ]
+    
+    # 构建prompt
+    combined_text = "\n\n".join(text_content)
+    
+    user_prompt = f"""原始文本内容：
 {combined_text}
 
 用户指示：
@@ -115,43 +163,35 @@ async def create_article(
 
 任务：请根据文本和图片内容，创作一篇高质量的文章，并将图片智能地插入到最合适的位置。"""
 
-        if image_parts:
-            user_prompt += f"\n\n📷 文档中包含 {len(image_parts)} 张图片，请：\n1. 仔细理解每张图片的内容\n2. 根据图片与文本的关联性，将图片插入到最合适的位置\n3. 为每张图片添加简洁的描述"
-        else:
-            user_prompt += "\n\n注意：文档中没有图片。"
-        
-        # 初始化AI提供商
-        ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
-        print(f"Using AI Provider: {ai_provider_name}")
-        print(f"Generated prompt length: {len(user_prompt)}")
-        print(f"Number of images: {len(image_parts)}")
-        
-        try:
-            ai_provider = AIProvider.create(ai_provider_name)
-            
-            # 检查是否支持多模态
-            if image_parts and not ai_provider.supports_multimodal():
-                print(f"⚠️ Warning: {ai_provider_name} does not support image understanding")
-                user_prompt += f"\n\n⚠️ 注意：当前AI模型（{ai_provider_name}）不支持图片理解，仅能根据文本内容创作。建议切换到支持多模态的模型（如Gemini或千问VL）以实现图片理解和智能排版功能。"
-            
-            # 调用AI生成（传入图片）
-            generated_text = ai_provider.generate(user_prompt, images=image_parts, timeout=60)
-            print(f"Generated text length: {len(generated_text)}")
-            
-            # 修正可能的图片格式错误
-            import re
-            # 修正 image1.jpg -> image_1
-            generated_text = re.sub(r'!\[([^\]]*)\]\(image(\d+)\.(?:jpg|png|jpeg|gif)\)', r'![\1](image_\2)', generated_text)
-            # 修正 img_1 -> image_1
-            generated_text = re.sub(r'!\[([^\]]*)\]\(img_(\d+)\)', r'![\1](image_\2)', generated_text)
-            # 修正 picture1 -> image_1
-            generated_text = re.sub(r'!\[([^\]]*)\]\(picture(\d+)\)', r'![\1](image_\2)', generated_text)
-            print(f"After format fix: {len(generated_text)}")
-                    
-        except TimeoutError as e:
-            print(f"AI API call timed out: {e}")
-            # 如果超时，返回带提示的示例响应
-            generated_text = f"""# ⚠️ AI生成超时
+    if image_parts:
+        user_prompt += f"\n\n📷 文档中包含 {len(image_parts)} 张图片，请：\n1. 仔细理解每张图片的内容\n2. 根据图片与文本的关联性，将图片插入到最合适的位置\n3. 为每张图片添加简洁的描述"
+    else:
+        user_prompt += "\n\n注意：文档中没有图片。"
+    
+    return {
+        "combined_text": combined_text,
+        "image_parts": image_parts,
+        "user_prompt": user_prompt,
+        "failed_images": failed_images
+    }
+
+
+def _get_provider_for(ai_provider_name: str, prompt: str, images: List[Dict]):
+    """
+    获取AI提供商；若有图片而提供商不支持多模态，在prompt末尾追加提示
+    """
+    ai_provider = AIProvider.get(ai_provider_name)
+    
+    # 检查是否支持多模态
+    if images and not ai_provider.supports_multimodal():
+        print(f"⚠️ Warning: {ai_provider_name} does not support image understanding")
+        prompt += f"\n\n⚠️ 注意：当前AI模型（{ai_provider_name}）不支持图片理解，仅能根据文本内容创作。建议切换到支持多模态的模型（如Gemini或千问VL）以实现图片理解和智能排版功能。"
+    
+    return ai_provider, prompt
+
+
+def _create_timeout_article(combined_text: str) -> str:
+    return f"""# ⚠️ AI生成超时
 
 **问题：** API请求超时（30秒）
 
@@ -174,14 +214,12 @@ async def create_article(
 {combined_text[:500]}...
 
 *重新配置后请再次点击生成*"""
-            print("Using fallback content due to timeout")
-            
-        except Exception as e:
-            print(f"AI API call failed: {e}")
-            # 如果其他错误，返回错误提示
-            generated_text = f"""# ❌ AI生成失败
 
-**错误信息：** {str(e)}
+
+def _create_error_article(error: Exception, combined_text: str) -> str:
+    return f"""# ❌ AI生成失败
+
+**错误信息：** {str(error)}
 
 **建议：**
 1. 检查API Key是否正确配置
@@ -196,22 +234,221 @@ async def create_article(
 {combined_text[:500]}...
 
 *解决问题后请再次尝试*"""
+
+
+async def _save_create_session(
+    session_id: str,
+    request: CreateRequest,
+    user_prompt: str,
+    generated_text: str,
+    image_parts: List[Dict],
+    user: str
+) -> None:
+    await session_store.set(session_id, {
+        "doc_id": request.doc_id,
+        "user": user,
+        "original_blocks": request.blocks,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_prompt},
+            {"role": "assistant", "content": generated_text}
+        ],
+        "current_article": generated_text,
+        "images": image_parts,
+        # 会话版本号，以及预览中各字段最后一次变化时的版本号（供预览增量返回）
+        "version": 1,
+        "field_versions": {"article_content": 1, "images": 1, "original_blocks": 1}
+    })
+
+
+def _new_session_id(doc_id: str) -> str:
+    return f"{doc_id}_{os.urandom(8).hex()}"
+
+
+def _session_user(session: Dict[str, Any], raw_request: Request) -> str:
+    """精修请求没有token，使用创建会话时记录的用户标识"""
+    return session.get("user") or (raw_request.client.host if raw_request.client else "anonymous")
+
+
+def _user_key(token: str) -> str:
+    """用户标识（token摘要），用于准入控制的按用户公平"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+async def _admit(ai_provider_name: str, priority: int, user: str, deadline: Deadline) -> admission.Ticket:
+    """
+    申请AI调用名额；队列已满或用户超限时返回 429/503 + Retry-After
+    
+    自动路由时名额按实际调用的成员提供商申请（由 RoutingProvider 在选定成员后申请），
+    这里只记录请求的优先级、用户和截止时间。
+    """
+    if isinstance(AIProvider.get(ai_provider_name), RoutingProvider):
+        return admission.set_routed_request(priority, user, time.monotonic() + deadline.remaining())
+    controller = admission.get_controller(ai_provider_name)
+    try:
+        return await controller.acquire(priority, user, timeout=deadline.remaining())
+    except AdmissionRejected as e:
+        raise _rejected(ai_provider_name, e)
+
+
+def _rejected(ai_provider_name: str, e: AdmissionRejected) -> HTTPException:
+    print(f"Admission rejected ({ai_provider_name}): {e.detail}")
+    return HTTPException(
+        status_code=e.status_code,
+        detail=e.detail,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+async def _generate(
+    ai_provider_name: str,
+    ai_provider: AIProvider,
+    prompt: str,
+    images: List[Dict],
+    priority: int,
+    user: str,
+    deadline: Deadline,
+    raw_request: Optional[Request],
+    bypass_cache: bool = False
+) -> str:
+    """
+    生成文本：先查生成缓存，未命中时经准入控制调用提供商
+    
+    剩余预算传给提供商；超时或客户端断开时取消调用。
+    返回（并缓存）的是已修正图片标记的文本，与流式接口缓存的内容一致。
+    bypass_cache=True 时跳过读取缓存（强制重新生成），但仍写入新结果。
+    """
+    cache_key = make_key(ai_provider, prompt, images)
+    if not bypass_cache:
+        cached = await generation_cache.aget(cache_key)
+        if cached is not None:
+            print(f"Generation cache hit: {cache_key[:12]}")
+            return cached
+    
+    async with await _admit(ai_provider_name, priority, user, deadline):
+        # 图片引用只在真正调用提供商时才读取并编码为base64
+        image_data = await _image_parts(images)
+        try:
+            result = await run_with_deadline(
+                ai_provider.agenerate(prompt, images=image_data, timeout=deadline.timeout(config.AI_PROVIDER_TIMEOUT)),
+                deadline,
+                raw_request
+            )
+        except AdmissionRejected as e:
+            # 自动路由：所有成员提供商都未获准入
+            raise _rejected(ai_provider_name, e)
+    result = fix_image_refs(result)
+    await generation_cache.aset(cache_key, result)
+    return result
+
+
+async def _image_parts(images: List[Dict]) -> List[Dict]:
+    """读取会话图片并编码为base64；图片已被清理时不能跳过（image_N 按位置对应），直接报错"""
+    try:
+        return await image_store.to_parts(images)
+    except ImageMissingError as e:
+        raise HTTPException(status_code=410, detail=f"会话图片已过期，请重新创作（{e}）")
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """格式化一条Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+
+async def generate_for_document(
+    request: CreateRequest,
+    token: str,
+    deadline: Deadline,
+    priority: int = PRIORITY_CREATE,
+    user: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    非交互式生成（供批量任务使用）：失败时直接抛出异常，不返回兜底文章
+    
+    返回 {"session_id", "content", "images", "failed_images"}
+    """
+    prepared = await _prepare_create(request, token, deadline)
+    image_parts = prepared["image_parts"]
+    ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
+    
+    ai_provider, user_prompt = _get_provider_for(ai_provider_name, prepared["user_prompt"], image_parts)
+    generated_text = await _generate(
+        ai_provider_name, ai_provider, user_prompt, image_parts,
+        priority, user or _user_key(token), deadline, None,
+        bypass_cache=request.no_cache
+    )
+    
+    session_id = _new_session_id(request.doc_id)
+    await _save_create_session(session_id, request, user_prompt, generated_text, image_parts, _user_key(token))
+    return {
+        "session_id": session_id,
+        "content": generated_text,
+        "images": image_parts,
+        "failed_images": prepared["failed_images"]
+    }
+
+
+@router.post("/create", response_model=AIResponse)
+async def create_article(
+    request: CreateRequest,
+    raw_request: Request,
+    authorization: str = Header(...)
+):
+    """
+    首次生成文章
+    """
+    try:
+        print(f"AI Create request received: doc_id={request.doc_id}, blocks_count={len(request.blocks)}")
+        
+        token = authorization.replace("Bearer ", "")
+        deadline = Deadline.from_headers(raw_request.headers, config.AI_REQUEST_BUDGET, maximum=config.AI_REQUEST_BUDGET)
+        
+        prepared = await _prepare_create(request, token, deadline)
+        combined_text = prepared["combined_text"]
+        image_parts = prepared["image_parts"]
+        user_prompt = prepared["user_prompt"]
+        
+        # 初始化AI提供商
+        ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
+        print(f"Using AI Provider: {ai_provider_name}")
+        print(f"Generated prompt length: {len(user_prompt)}")
+        print(f"Number of images: {len(image_parts)}")
+        
+        try:
+            ai_provider, user_prompt = _get_provider_for(ai_provider_name, user_prompt, image_parts)
+            
+            # 调用AI生成（传入图片）
+            generated_text = await _generate(
+                ai_provider_name, ai_provider, user_prompt, image_parts,
+                PRIORITY_CREATE, _user_key(token), deadline, raw_request,
+                bypass_cache=request.no_cache
+            )
+            print(f"Generated text length: {len(generated_text)}")
+                    
+        except (ClientDisconnected, HTTPException):
+            raise
+            
+        except TimeoutError as e:
+            print(f"AI API call timed out: {e}")
+            # 如果超时，返回带提示的示例响应
+            generated_text = _create_timeout_article(combined_text)
+            print("Using fallback content due to timeout")
+            
+        except Exception as e:
+            print(f"AI API call failed: {e}")
+            # 如果其他错误，返回错误提示
+            generated_text = _create_error_article(e, combined_text)
             print("Using fallback content due to error")
         
         # 创建会话
-        session_id = f"{request.doc_id}_{os.urandom(8).hex()}"
-        
-        sessions[session_id] = {
-            "doc_id": request.doc_id,
-            "original_blocks": request.blocks,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-                {"role": "assistant", "content": generated_text}
-            ],
-            "current_article": generated_text,
-            "images": image_parts
-        }
+        session_id = _new_session_id(request.doc_id)
+        await _save_create_session(session_id, request, user_prompt, generated_text, image_parts, _user_key(token))
         
         return AIResponse(
             session_id=session_id,
@@ -219,41 +456,274 @@ async def create_article(
             messages=[
                 Message(role="user", content=request.instruction),
                 Message(role="assistant", content="已生成文章")
-            ]
+            ],
+            failed_images=prepared["failed_images"]
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI生成失败: {str(e)}")
 
 
+@router.post("/create/stream")
+async def create_article_stream(
+    request: CreateRequest,
+    raw_request: Request,
+    authorization: str = Header(...)
+):
+    """
+    首次生成文章（流式，Server-Sent Events）
+    
+    事件依次为：status → meta → delta（多次）→ done；出错时发送 error。
+    客户端断开时 StreamingResponse 会取消本生成器，上游流式连接随之关闭。
+    """
+    token = authorization.replace("Bearer ", "")
+    deadline = Deadline.from_headers(raw_request.headers, config.AI_REQUEST_BUDGET, maximum=config.AI_REQUEST_BUDGET)
+    
+    async def event_stream():
+        yield _sse("status", {"stage": "preparing"})
+        try:
+            prepared = await _prepare_create(request, token, deadline)
+        except HTTPException as e:
+            yield _sse("error", {"detail": e.detail})
+            return
+        except Exception as e:
+            yield _sse("error", {"detail": f"AI生成失败: {str(e)}"})
+            return
+        
+        combined_text = prepared["combined_text"]
+        image_parts = prepared["image_parts"]
+        ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
+        session_id = _new_session_id(request.doc_id)
+        
+        yield _sse("meta", {
+            "session_id": session_id,
+            "provider": ai_provider_name,
+            "image_count": len(image_parts),
+            "failed_images": prepared["failed_images"]
+        })
+        
+        fixer = ImageRefStreamFixer()
+        parts = []
+        user_prompt = prepared["user_prompt"]
+        try:
+            ai_provider, user_prompt = _get_provider_for(ai_provider_name, prepared["user_prompt"], image_parts)
+            cache_key = make_key(ai_provider, user_prompt, image_parts)
+            cached = None if request.no_cache else await generation_cache.aget(cache_key)
+            if cached is not None:
+                yield _sse("delta", {"content": cached})
+                generated_text = cached
+            else:
+                async with await _admit(ai_provider_name, PRIORITY_CREATE, _user_key(token), deadline):
+                    image_data = await _image_parts(image_parts)
+                    stream_timeout = deadline.timeout(config.AI_PROVIDER_TIMEOUT)
+                    async for chunk in ai_provider.astream(user_prompt, images=image_data, timeout=stream_timeout):
+                        if deadline.expired():
+                            raise TimeoutError(f"请求超时（{deadline.budget:g}秒）")
+                        fixed = fixer.feed(chunk)
+                        if fixed:
+                            parts.append(fixed)
+                            yield _sse("delta", {"content": fixed})
+                tail = fixer.flush()
+                if tail:
+                    parts.append(tail)
+                    yield _sse("delta", {"content": tail})
+                generated_text = "".join(parts)
+                await generation_cache.aset(cache_key, generated_text)
+        except HTTPException as e:
+            # 未获准入：流已开始，无法再改HTTP状态码，通过error事件告知重试时间
+            yield _sse("error", {
+                "status_code": e.status_code,
+                "detail": e.detail,
+                "retry_after": int((e.headers or {}).get("Retry-After", 0))
+            })
+            return
+        except AdmissionRejected as e:
+            # 自动路由时成员提供商的名额在流开始后才申请
+            print(f"Admission rejected ({ai_provider_name}): {e.detail}")
+            yield _sse("error", {"status_code": e.status_code, "detail": e.detail, "retry_after": e.retry_after})
+            return
+        except TimeoutError as e:
+            print(f"AI API stream timed out: {e}")
+            generated_text = _create_timeout_article(combined_text)
+        except Exception as e:
+            print(f"AI API stream failed: {e}")
+            generated_text = _create_error_article(e, combined_text)
+        
+        await _save_create_session(session_id, request, user_prompt, generated_text, image_parts, _user_key(token))
+        yield _sse("done", {"session_id": session_id, "content": generated_text})
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+def _build_refine_prompt(session: Dict[str, Any], instruction: str) -> str:
+    current_article = session["current_article"]
+    images = session.get("images", [])
+    
+    refine_prompt = f"""当前文章版本：
+{current_article}
+
+用户的修改要求：
+{instruction}
+
+请根据用户的要求对文章进行修改，输出完整的修改后文章（使用Markdown格式）。"""
+
+    if images:
+        refine_prompt += f"\n\n⚠️ 重要：文档中有 {len(images)} 张图片\n"
+        refine_prompt += "- **必须**使用精确格式：![图片描述](image_1)、![图片描述](image_2)...\n"
+        refine_prompt += "- ❌ 错误：![图片](image1.jpg)、![图片](img_1)\n"
+        refine_prompt += "- ✅ 正确：![产品外观](image_1)、![功能演示](image_2)"
+    
+    return refine_prompt
+
+
+def _resolve_refine_target(current_article: str, request: RefineRequest) -> Optional[Tuple[int, int]]:
+    """局部精修的目标范围 [start, end)；未指定时返回 None（整篇精修）"""
+    if request.section:
+        target = find_section(current_article, request.section)
+        if target is None:
+            raise HTTPException(status_code=400, detail=f"未找到标题: {request.section}")
+        return target
+    if request.range_start is not None or request.range_end is not None:
+        try:
+            return snap_range(
+                current_article,
+                request.range_start or 0,
+                len(current_article) if request.range_end is None else request.range_end
+            )
+        except ValueError:
+            raise HTTPException(status_code=400, detail="修改范围无效")
+    return None
+
+
+def _build_partial_refine_prompt(
+    session: Dict[str, Any],
+    instruction: str,
+    target: Tuple[int, int]
+) -> Tuple[str, List[Dict]]:
+    """
+    局部精修的prompt：只包含待修改部分和其余部分的提纲
+    
+    返回 (prompt, 待修改部分引用到的图片)；其他图片不发送给模型。
+    """
+    current_article = session["current_article"]
+    start, end = target
+    section = current_article[start:end]
+    
+    refine_prompt = f"""当前文章版本（节选，只需修改这一部分）：
+{section}
+
+文章其余部分的提纲（无需修改，仅供了解上下文）：
+{build_outline(current_article, start, end, config.REFINE_CONTEXT_CHARS)}
+
+用户的修改要求：
+{instruction}
+
+请根据用户的要求只修改上面节选的部分，输出修改后的这一部分（使用Markdown格式）。保留原有的标题行，不要输出文章的其他部分。"""
+
+    session_images = session.get("images", [])
+    image_ids = [
+        image_id for image_id in referenced_images(section)
+        if 0 < int(image_id.split("_")[1]) <= len(session_images)
+    ]
+    images = [session_images[int(image_id.split("_")[1]) - 1] for image_id in image_ids]
+    if image_ids:
+        refine_prompt += f"\n\n⚠️ 重要：这一部分引用了 {len(image_ids)} 张图片，附带的图片依次对应 {'、'.join(image_ids)}\n"
+        refine_prompt += "- **必须**保持原有编号，使用精确格式：![图片描述](image_N)\n"
+        refine_prompt += f"- 只能引用 {'、'.join(image_ids)}，不要引用其他编号的图片"
+    
+    return refine_prompt, images
+
+
+def _prepare_refine(
+    session: Dict[str, Any],
+    request: RefineRequest
+) -> Tuple[str, List[Dict], Optional[Tuple[int, int]]]:
+    """
+    构建精修prompt：指定了章节或范围时局部精修，否则整篇精修
+    
+    返回 (prompt, 发送的图片, 局部精修的目标范围)
+    """
+    target = _resolve_refine_target(session["current_article"], request)
+    if target is None:
+        return _build_refine_prompt(session, request.instruction), session.get("images", []), None
+    refine_prompt, images = _build_partial_refine_prompt(session, request.instruction, target)
+    print(f"Partial refine: chars {target[0]}-{target[1]} of {len(session['current_article'])}, {len(images)} images")
+    return refine_prompt, images, target
+
+
+def _get_refine_provider(ai_provider_name: str, prompt: str, images: List[Dict]):
+    """
+    获取精修用的AI提供商及实际发送的prompt、图片
+    """
+    ai_provider = AIProvider.get(ai_provider_name)
+    
+    # 检查是否支持多模态（如果有图片）
+    if images and not ai_provider.supports_multimodal():
+        prompt += f"\n\n⚠️ 注意：当前AI模型（{ai_provider_name}）不支持图片理解，仅能根据文本内容精修。"
+    
+    # 传入图片以保持上下文
+    return ai_provider, prompt, images if ai_provider.supports_multimodal() else []
+
+
+def _refine_timeout_article(current_article: str) -> str:
+    return f"""# ⚠️ AI精修超时
+
+请求超时，请检查网络连接后重试。
+
+当前文章版本：
+{current_article}"""
+
+
+async def _commit_refine(session_id: str, session: Dict[str, Any], refined_text: str) -> None:
+    session["messages"].append({
+        "role": "assistant",
+        "content": refined_text
+    })
+    session["current_article"] = refined_text
+    session["version"] = session.get("version", 1) + 1
+    session.setdefault("field_versions", {})["article_content"] = session["version"]
+    image_store.touch(session.get("images", []))
+    await session_store.set(session_id, session)
+
+
+def _history_messages(session: Dict[str, Any]) -> List[Message]:
+    """把会话历史整理为前端展示用的消息列表"""
+    messages = []
+    for msg in session["messages"][1:]:  # 跳过system消息
+        if msg["role"] in ["user", "assistant"]:
+            # 简化显示
+            if "当前文章版本" in msg["content"]:
+                # 这是精修请求，只显示用户指令部分
+                if msg["role"] == "user":
+                    instruction_part = msg["content"].split("用户的修改要求：")[-1].split("\n\n请根据")[0].strip()
+                    messages.append(Message(role="user", content=instruction_part))
+                else:
+                    messages.append(Message(role="assistant", content="已更新文章"))
+            elif msg["role"] == "user":
+                # 首次创建请求
+                if "用户指示：" in msg["content"]:
+                    instruction = msg["content"].split("用户指示：")[-1].split("\n\n请根据")[0].strip()
+                    messages.append(Message(role="user", content=instruction))
+    return messages
+
+
 @router.post("/refine", response_model=AIResponse)
-async def refine_article(request: RefineRequest):
+async def refine_article(request: RefineRequest, raw_request: Request):
     """
     多轮对话精修文章
     """
+    deadline = Deadline.from_headers(raw_request.headers, config.AI_REQUEST_BUDGET, maximum=config.AI_REQUEST_BUDGET)
     try:
         # 获取会话
-        session = sessions.get(request.session_id)
+        session = await session_store.get(request.session_id)
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
         
         # 构建新的prompt
         current_article = session["current_article"]
-        images = session.get("images", [])
-        
-        refine_prompt = f"""当前文章版本：
-{current_article}
-
-用户的修改要求：
-{request.instruction}
-
-请根据用户的要求对文章进行修改，输出完整的修改后文章（使用Markdown格式）。"""
-
-        if images:
-            refine_prompt += f"\n\n⚠️ 重要：文档中有 {len(images)} 张图片\n"
-            refine_prompt += "- **必须**使用精确格式：![图片描述](image_1)、![图片描述](image_2)...\n"
-            refine_prompt += "- ❌ 错误：![图片](image1.jpg)、![图片](img_1)\n"
-            refine_prompt += "- ✅ 正确：![产品外观](image_1)、![功能演示](image_2)"
+        refine_prompt, session_images, target = _prepare_refine(session, request)
 
         # 添加到消息历史
         session["messages"].append({
@@ -266,78 +736,157 @@ async def refine_article(request: RefineRequest):
         print(f"Refine using AI Provider: {ai_provider_name}")
         
         try:
-            ai_provider = AIProvider.create(ai_provider_name)
-            
-            # 检查是否支持多模态（如果有图片）
-            if images and not ai_provider.supports_multimodal():
-                refine_prompt += f"\n\n⚠️ 注意：当前AI模型（{ai_provider_name}）不支持图片理解，仅能根据文本内容精修。"
+            ai_provider, refine_prompt, images = _get_refine_provider(
+                ai_provider_name, refine_prompt, session_images
+            )
             
-            # 调用AI生成（传入图片以保持上下文）
-            refined_text = ai_provider.generate(refine_prompt, images=images if ai_provider.supports_multimodal() else [], timeout=60)
+            # 调用AI生成（传入图片以保持上下文）；精修是交互式操作，优先于首次生成
+            refined_text = await _generate(
+                ai_provider_name, ai_provider, refine_prompt, images,
+                PRIORITY_REFINE, _session_user(session, raw_request), deadline, raw_request,
+                bypass_cache=request.no_cache
+            )
             print(f"Refined text length: {len(refined_text)}")
             
-            # 修正可能的图片格式错误
-            import re
-            refined_text = re.sub(r'!\[([^\]]*)\]\(image(\d+)\.(?:jpg|png|jpeg|gif)\)', r'![\1](image_\2)', refined_text)
-            refined_text = re.sub(r'!\[([^\]]*)\]\(img_(\d+)\)', r'![\1](image_\2)', refined_text)
-            refined_text = re.sub(r'!\[([^\]]*)\]\(picture(\d+)\)', r'![\1](image_\2)', refined_text)
-            print(f"After format fix: {len(refined_text)}")
+            # 局部精修：把修改后的部分拼回全文
+            if target is not None:
+                refined_text = splice_section(current_article, *target, refined_text)
                 
+        except (ClientDisconnected, HTTPException):
+            raise
+            
         except TimeoutError as e:
             print(f"Refine API call timed out: {e}")
-            refined_text = f"""# ⚠️ AI精修超时
-
-请求超时，请检查网络连接后重试。
-
-当前文章版本：
-{current_article}"""
+            refined_text = _refine_timeout_article(current_article)
             
         except Exception as e:
             print(f"Refine API call failed: {e}")
             raise HTTPException(status_code=500, detail=f"精修失败: {str(e)}")
         
         # 更新会话
-        session["messages"].append({
-            "role": "assistant",
-            "content": refined_text
-        })
-        session["current_article"] = refined_text
-        
-        # 构建消息列表
-        messages = []
-        for msg in session["messages"][1:]:  # 跳过system消息
-            if msg["role"] in ["user", "assistant"]:
-                # 简化显示
-                if "当前文章版本" in msg["content"]:
-                    # 这是精修请求，只显示用户指令部分
-                    if msg["role"] == "user":
-                        instruction_part = msg["content"].split("用户的修改要求：")[-1].split("\n\n请根据")[0].strip()
-                        messages.append(Message(role="user", content=instruction_part))
-                    else:
-                        messages.append(Message(role="assistant", content="已更新文章"))
-                elif msg["role"] == "user":
-                    # 首次创建请求
-                    if "用户指示：" in msg["content"]:
-                        instruction = msg["content"].split("用户指示：")[-1].split("\n\n请根据")[0].strip()
-                        messages.append(Message(role="user", content=instruction))
+        await _commit_refine(request.session_id, session, refined_text)
         
         return AIResponse(
             session_id=request.session_id,
             content=refined_text,
-            messages=messages
+            messages=_history_messages(session)
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"精修失败: {str(e)}")
 
 
+@router.post("/refine/stream")
+async def refine_article_stream(request: RefineRequest, raw_request: Request):
+    """
+    多轮对话精修文章（流式，Server-Sent Events）
+    
+    事件依次为：（局部精修时）section → delta（多次）→ done；出错时发送 error。
+    局部精修时 delta 只是被修改部分的新内容，section 事件给出它替换的原文范围，
+    done 中的 content 为拼接后的全文。
+    客户端断开时 StreamingResponse 会取消本生成器，上游流式连接随之关闭。
+    """
+    deadline = Deadline.from_headers(raw_request.headers, config.AI_REQUEST_BUDGET, maximum=config.AI_REQUEST_BUDGET)
+    session = await session_store.get(request.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    current_article = session["current_article"]
+    refine_prompt, session_images, target = _prepare_refine(session, request)
+    
+    ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
+    print(f"Refine (stream) using AI Provider: {ai_provider_name}")
+    
+    try:
+        ai_provider, prompt, images = _get_refine_provider(
+            ai_provider_name, refine_prompt, session_images
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"精修失败: {str(e)}")
+    
+    cache_key = make_key(ai_provider, prompt, images)
+    cached = None if request.no_cache else await generation_cache.aget(cache_key)
+    
+    # 流开始前完成准入，被拒绝时可以直接返回 429/503 + Retry-After（自动路由时由成员提供商在流中申请）
+    ticket = None
+    if cached is None:
+        ticket = await _admit(ai_provider_name, PRIORITY_REFINE, _session_user(session, raw_request), deadline)
+    
+    session["messages"].append({
+        "role": "user",
+        "content": refine_prompt
+    })
+    
+    async def event_stream():
+        fixer = ImageRefStreamFixer()
+        parts = []
+        if target is not None:
+            yield _sse("section", {"start": target[0], "end": target[1]})
+        try:
+            if cached is not None:
+                yield _sse("delta", {"content": cached})
+                refined_text = cached
+            else:
+                image_data = await _image_parts(images)
+                stream_timeout = deadline.timeout(config.AI_PROVIDER_TIMEOUT)
+                async for chunk in ai_provider.astream(prompt, images=image_data, timeout=stream_timeout):
+                    if deadline.expired():
+                        raise TimeoutError(f"请求超时（{deadline.budget:g}秒）")
+                    fixed = fixer.feed(chunk)
+                    if fixed:
+                        parts.append(fixed)
+                        yield _sse("delta", {"content": fixed})
+                tail = fixer.flush()
+                if tail:
+                    parts.append(tail)
+                    yield _sse("delta", {"content": tail})
+                refined_text = "".join(parts)
+                await generation_cache.aset(cache_key, refined_text)
+            if target is not None:
+                refined_text = splice_section(current_article, *target, refined_text)
+        except HTTPException as e:
+            yield _sse("error", {"status_code": e.status_code, "detail": e.detail})
+            return
+        except AdmissionRejected as e:
+            # 自动路由时成员提供商的名额在流开始后才申请
+            print(f"Admission rejected ({ai_provider_name}): {e.detail}")
+            yield _sse("error", {"status_code": e.status_code, "detail": e.detail, "retry_after": e.retry_after})
+            return
+        except TimeoutError as e:
+            print(f"Refine API stream timed out: {e}")
+            refined_text = _refine_timeout_article(current_article)
+        except Exception as e:
+            print(f"Refine API stream failed: {e}")
+            yield _sse("error", {"detail": f"精修失败: {str(e)}"})
+            return
+        finally:
+            if ticket is not None:
+                ticket.release()
+        
+        await _commit_refine(request.session_id, session, refined_text)
+        yield _sse("done", {
+            "session_id": request.session_id,
+            "content": refined_text,
+            "messages": [m.model_dump() for m in _history_messages(session)]
+        })
+    
+    # 生成器未开始就被取消时 finally 不会执行，由后台任务兜底释放名额
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+        background=BackgroundTask(ticket.release) if ticket is not None else None
+    )
+
+
 @router.delete("/session/{session_id}")
 async def reset_session(session_id: str):
     """
     重置会话
     """
-    if session_id in sessions:
-        del sessions[session_id]
+    if await session_store.delete(session_id):
         return {"message": "会话已重置"}
     raise HTTPException(status_code=404, detail="会话不存在")
 
@@ -347,7 +896,7 @@ async def get_session(session_id: str):
     """
     获取会话信息
     """
-    session = sessions.get(session_id)
+    session = await session_store.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
@@ -359,20 +908,119 @@ async def get_session(session_id: str):
     }
 
 
+def _preview_images(session_id: str, session: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """图片只返回引用，内容通过 /session/{session_id}/images/{sha256} 单独获取（可被浏览器缓存）"""
+    return [
+        {
+            "id": f"image_{idx}",
+            "sha256": img["sha256"],
+            "mime_type": img["mime_type"],
+            "size": img.get("size"),
+            "url": f"/api/ai/session/{session_id}/images/{img['sha256']}"
+        }
+        for idx, img in enumerate(session.get("images", []), 1)
+    ]
+
+
 @router.get("/preview/{session_id}")
-async def preview_article(session_id: str):
+async def preview_article(
+    session_id: str,
+    since: Optional[int] = None,
+    if_none_match: Optional[str] = Header(None)
+):
     """
-    预览重新排版后的文章（包含图片）
-    返回文章内容和图片数据，用于前端渲染
+    预览重新排版后的文章
+    
+    返回文章内容、原始blocks和图片引用（图片数据通过图片接口获取）。
+    传入 since=版本号 时只返回该版本之后变化过的字段；会话未变化时按 ETag 返回 304。
     """
-    session = sessions.get(session_id)
+    session = await session_store.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="会话不存在")
     
-    return {
+    version = session.get("version", 1)
+    etag = f'"{session_id}-{version}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=cache_headers)
+    
+    field_versions = session.get("field_versions", {})
+    fields = {
+        "article_content": lambda: session["current_article"],
+        "images": lambda: _preview_images(session_id, session),
+        "original_blocks": lambda: session.get("original_blocks", [])
+    }
+    result = {
         "session_id": session_id,
         "doc_id": session["doc_id"],
-        "article_content": session["current_article"],
-        "images": session.get("images", []),  # 图片数据（base64）
-        "original_blocks": session.get("original_blocks", [])
-    }
\ No newline at end of file
+        "version": version
+    }
+    for name, value in fields.items():
+        if since is None or field_versions.get(name, 1) > since:
+            result[name] = value()
+    
+    # 直接序列化，跳过 FastAPI 对返回值的逐字段编码（original_blocks 可能很大）
+    return Response(
+        content=json.dumps(result, ensure_ascii=False),
+        media_type="application/json",
+        headers=cache_headers
+    )
+
+
+@router.get("/session/{session_id}/images/{sha256}")
+async def get_session_image(
+    session_id: str,
+    sha256: str,
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    获取会话中的图片（预处理后的版本，按内容寻址）
+    
+    同一sha256的内容永远不变：强ETag + 长期缓存。
+    """
+    session = await session_store.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    ref = next((img for img in session.get("images", []) if img.get("sha256") == sha256), None)
+    if ref is None:
+        raise HTTPException(status_code=404, detail="图片不存在")
+    
+    etag = f'"{sha256}"'
+    headers = {"ETag": etag, "Cache-Control": documents.IMAGE_CACHE_CONTROL}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    try:
+        data = await image_store.read(ref)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="图片已过期")
+    return Response(content=data, media_type=ref["mime_type"], headers=headers)
+
+
+@router.get("/cache/stats")
+async def get_cache_stats():
+    """
+    生成缓存命中统计
+    """
+    return generation_cache.snapshot()
+
+
+@router.get("/sessions/stats")
+async def get_session_stats():
+    """
+    会话存储统计：会话数量、占用字节数、淘汰和过期次数，以及会话图片存储的统计
+    """
+    return {**session_store.snapshot(), "image_store": image_store.snapshot()}
+
+
+@router.get("/providers/status")
+async def get_providers_status():
+    """
+    AI提供商状态：准入队列情况；AI_PROVIDER=auto 时还包含各提供商的熔断状态
+    """
+    ai_provider_name = os.getenv("AI_PROVIDER", "gemini")
+    ai_provider = AIProvider.get(ai_provider_name)
+    status = {"provider": ai_provider_name, "admission": admission.snapshot()}
+    if isinstance(ai_provider, RoutingProvider):
+        status["chain"] = ai_provider.snapshot()
+    return status
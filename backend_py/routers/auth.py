@@ -1,12 +1,17 @@
 """
 飞书OAuth认证路由
 """
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import Optional
 import httpx
 import os
 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from services.feishu_api import get_feishu_client, feishu_request
+from services.app_token import app_token_manager, AppTokenError, INVALID_APP_TOKEN_CODES
+
 router = APIRouter()
 
 
@@ -49,7 +54,10 @@ async def get_auth_url():
 
 
 @router.post("/token", response_model=TokenResponse)
-async def exchange_token(request: TokenRequest):
+async def exchange_token(
+    request: TokenRequest,
+    client: httpx.AsyncClient = Depends(get_feishu_client)
+):
     """
     使用授权码换取access_token
     """
@@ -60,104 +68,88 @@ async def exchange_token(request: TokenRequest):
         raise HTTPException(status_code=500, detail="飞书应用配置缺失")
     
     try:
-        # 1. 获取app_access_token
-        async with httpx.AsyncClient() as client:
-            app_token_response = await client.post(
-                "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
-                json={
-                    "app_id": app_id,
-                    "app_secret": app_secret
-                }
-            )
-            app_token_data = app_token_response.json()
-            
-            if app_token_data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"获取app_access_token失败: {app_token_data.get('msg')}"
-                )
-            
-            app_access_token = app_token_data.get("app_access_token")
-            
-            # 2. 使用 code 换取 user_access_token（Authen v1）
-            token_response = await client.post(
-                "https://open.feishu.cn/open-apis/authen/v1/access_token",
-                headers={
-                    "Authorization": f"Bearer {app_access_token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "grant_type": "authorization_code",
-                    "code": request.code
+        # 1. 获取app_access_token（进程内缓存）
+        app_access_token = await app_token_manager.get()
+        
+        # 2. 使用 code 换取 user_access_token（Authen v1）
+        token_response = await feishu_request(
+            client, "POST", "https://open.feishu.cn/open-apis/authen/v1/access_token",
+            headers={
+                "Authorization": f"Bearer {app_access_token}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "grant_type": "authorization_code",
+                "code": request.code
+            }
+        )
+        
+        token_data = token_response.json()
+        
+        if token_data.get("code") in INVALID_APP_TOKEN_CODES:
+            app_token_manager.invalidate(app_access_token)
+        if token_data.get("code") != 0:
+            # 将飞书原始响应一并返回，便于定位
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "message": "获取access_token失败",
+                    "feishu_response": token_data
                 }
             )
-            
-            token_data = token_response.json()
-            
-            if token_data.get("code") != 0:
-                # 将飞书原始响应一并返回，便于定位
-                raise HTTPException(
-                    status_code=400,
-                    detail={
-                        "message": "获取access_token失败",
-                        "feishu_response": token_data
-                    }
-                )
-            
-            data = token_data.get("data", {})
-            
-            # 3. 获取用户信息
-            user_response = await client.get(
-                "https://open.feishu.cn/open-apis/authen/v1/user_info",
-                headers={"Authorization": f"Bearer {data.get('access_token')}"}
-            )
-            
-            user_data = user_response.json()
-            
-            return TokenResponse(
-                access_token=data.get("access_token"),
-                refresh_token=data.get("refresh_token"),
-                expires_in=data.get("expires_in", 7200),
-                user_info=user_data.get("data", {})
-            )
-            
+        
+        data = token_data.get("data", {})
+        
+        # 3. 获取用户信息
+        user_response = await feishu_request(
+            client, "GET", "https://open.feishu.cn/open-apis/authen/v1/user_info",
+            headers={"Authorization": f"Bearer {data.get('access_token')}"}
+        )
+        
+        user_data = user_response.json()
+        
+        return TokenResponse(
+            access_token=data.get("access_token"),
+            refresh_token=data.get("refresh_token"),
+            expires_in=data.get("expires_in", 7200),
+            user_info=user_data.get("data", {})
+        )
+        
+    except AppTokenError as e:
+        raise HTTPException(status_code=400, detail=f"获取app_access_token失败: {str(e)}")
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"网络请求失败: {str(e)}")
 
 
 @router.post("/refresh")
-async def refresh_token(refresh_token: str):
+async def refresh_token(
+    refresh_token: str,
+    client: httpx.AsyncClient = Depends(get_feishu_client)
+):
     """
     刷新access_token
     """
-    app_id = os.getenv("FEISHU_APP_ID")
-    app_secret = os.getenv("FEISHU_APP_SECRET")
-    
     try:
-        async with httpx.AsyncClient() as client:
-            # 获取app_access_token
-            app_token_response = await client.post(
-                "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal",
-                json={
-                    "app_id": app_id,
-                    "app_secret": app_secret
-                }
-            )
-            app_token_data = app_token_response.json()
-            app_access_token = app_token_data.get("app_access_token")
-            
-            # 刷新token
-            response = await client.post(
-                "https://open.feishu.cn/open-apis/authen/v1/oidc/refresh_access_token",
-                headers={"Authorization": f"Bearer {app_access_token}"},
-                json={
-                    "grant_type": "refresh_token",
-                    "refresh_token": refresh_token
-                }
-            )
-            
-            return response.json()
-            
+        # 获取app_access_token（进程内缓存）
+        app_access_token = await app_token_manager.get()
+        
+        # 刷新token
+        response = await feishu_request(
+            client, "POST", "https://open.feishu.cn/open-apis/authen/v1/oidc/refresh_access_token",
+            headers={"Authorization": f"Bearer {app_access_token}"},
+            json={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token
+            }
+        )
+        
+        data = response.json()
+        if data.get("code") in INVALID_APP_TOKEN_CODES:
+            app_token_manager.invalidate(app_access_token)
+        return data
+        
+    except AppTokenError as e:
+        raise HTTPException(status_code=400, detail=f"获取app_access_token失败: {str(e)}")
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"刷新token失败: {str(e)}")
 
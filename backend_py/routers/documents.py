@@ -1,11 +1,29 @@
 """
 飞书文档操作路由
 """
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, AsyncIterator, Tuple
 import httpx
 import os
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import config
+from services.document_cache import document_cache, make_etag
+from services.image_cache import image_cache, parse_range, CHUNK_SIZE
+from services.image_store import image_store
+from services.feishu_api import (
+    get_feishu_client, feishu_request, feishu_stream, create_children, FeishuWriteError
+)
+from services.image_pipeline import make_variant
+from services.markdown_blocks import acompile_markdown, BLOCK_IMAGE
 
 router = APIRouter()
 
@@ -43,7 +61,8 @@ async def get_documents(
     page_size: int = 20,
     page_token: Optional[str] = None,
     order_by: str = "EditedTime",
-    direction: str = "DESC"
+    direction: str = "DESC",
+    client: httpx.AsyncClient = Depends(get_feishu_client)
 ):
     """
     获取用户的飞书文档列表
@@ -52,243 +71,402 @@ async def get_documents(
         # 提取token
         token = authorization.replace("Bearer ", "")
         
-        async with httpx.AsyncClient() as client:
-            # 获取文档列表
-            params = {
-                "page_size": page_size,
-                "order_by": order_by,
-                "direction": direction
-            }
-            if page_token:
-                params["page_token"] = page_token
-                
-            response = await client.get(
-                "https://open.feishu.cn/open-apis/drive/v1/files",
-                headers={"Authorization": f"Bearer {token}"},
-                params=params
+        # 获取文档列表
+        params = {
+            "page_size": page_size,
+            "order_by": order_by,
+            "direction": direction
+        }
+        if page_token:
+            params["page_token"] = page_token
+            
+        response = await feishu_request(
+            client, "GET", "https://open.feishu.cn/open-apis/drive/v1/files",
+            headers={"Authorization": f"Bearer {token}"},
+            params=params
+        )
+        
+        data = response.json()
+        
+        if data.get("code") != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"获取文档列表失败: {data.get('msg')}"
             )
-            
-            data = response.json()
-            
-            if data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"获取文档列表失败: {data.get('msg')}"
-                )
-            
-            files = data.get("data", {}).get("files", [])
-            has_more = data.get("data", {}).get("has_more", False)
-            
-            # 过滤出文档类型（docx）
-            documents = []
-            for file in files:
-                if file.get("type") == "docx":
-                    # 处理时间戳 - 飞书返回的是毫秒级时间戳
-                    modified_time = file.get("modified_time", "")
-                    if modified_time:
-                        try:
-                            # 飞书时间戳是毫秒级，需要转换为秒级
-                            timestamp = int(modified_time) / 1000
-                            from datetime import datetime
-                            dt = datetime.fromtimestamp(timestamp)
-                            modified_time = dt.strftime("%Y-%m-%d %H:%M:%S")
-                        except (ValueError, TypeError):
-                            modified_time = "未知时间"
-                    else:
+        
+        files = data.get("data", {}).get("files", [])
+        has_more = data.get("data", {}).get("has_more", False)
+        
+        # 过滤出文档类型（docx）
+        documents = []
+        for file in files:
+            if file.get("type") == "docx":
+                # 处理时间戳 - 飞书返回的是毫秒级时间戳
+                modified_time = file.get("modified_time", "")
+                if modified_time:
+                    try:
+                        # 飞书时间戳是毫秒级，需要转换为秒级
+                        timestamp = int(modified_time) / 1000
+                        from datetime import datetime
+                        dt = datetime.fromtimestamp(timestamp)
+                        modified_time = dt.strftime("%Y-%m-%d %H:%M:%S")
+                    except (ValueError, TypeError):
                         modified_time = "未知时间"
-                    
-                    documents.append(Document(
-                        doc_id=file.get("token"),
-                        title=file.get("name", "未命名文档"),
-                        doc_type=file.get("type"),
-                        updated_at=modified_time,
-                        url=file.get("url", "")
-                    ))
-            
-            return DocumentListResponse(
-                documents=documents,
-                has_more=has_more
-            )
-            
+                else:
+                    modified_time = "未知时间"
+                
+                documents.append(Document(
+                    doc_id=file.get("token"),
+                    title=file.get("name", "未命名文档"),
+                    doc_type=file.get("type"),
+                    updated_at=modified_time,
+                    url=file.get("url", "")
+                ))
+        
+        return DocumentListResponse(
+            documents=documents,
+            has_more=has_more
+        )
+        
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"网络请求失败: {str(e)}")
 
 
+def parse_block(block: dict) -> Optional[ContentBlock]:
+    """
+    把飞书原始block解析为ContentBlock，不需要的block返回None
+    """
+    block_type = block.get("block_type")
+    block_id = block.get("block_id")
+    
+    # 处理不同类型的文本块
+    text_content = None
+    
+    if block_type == 1:  # 页面/标题块
+        text_content = block.get("page", {})
+    elif block_type == 2:  # 普通文本块
+        text_content = block.get("text", {})
+    elif block_type == 4:  # 标题块
+        text_content = block.get("heading2", {})
+    elif block_type == 5:  # 其他标题块
+        text_content = block.get("heading1", {}) or block.get("heading3", {})
+    
+    if text_content:
+        elements = text_content.get("elements", [])
+        if elements:
+            text = extract_text_from_elements(elements)
+            if text.strip():
+                return ContentBlock(
+                    block_id=block_id,
+                    block_type="text",
+                    text=text
+                )
+        return None
+    
+    if block_type == 27:  # 图片块
+        image = block.get("image", {})
+        image_token = image.get("token")
+        if image_token:
+            return ContentBlock(
+                block_id=block_id,
+                block_type="image",
+                image_token=image_token
+            )
+        return None
+    
+    print(f"Unhandled block type: {block_type}")
+    return None
+
+
+async def _fetch_blocks_page(
+    client: httpx.AsyncClient,
+    doc_id: str,
+    token: str,
+    page_token: Optional[str],
+    revision_id: int = -1
+) -> dict:
+    params = {
+        "page_size": 500,
+        "document_revision_id": revision_id,  # -1 表示最新版本
+        "user_id_type": "open_id"
+    }
+    if page_token:
+        params["page_token"] = page_token
+    
+    blocks_response = await feishu_request(
+        client, "GET", f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks",
+        headers={"Authorization": f"Bearer {token}"},
+        params=params
+    )
+    blocks_data = blocks_response.json()
+    
+    if blocks_data.get("code") != 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"获取文档blocks失败: {blocks_data.get('msg')} (code: {blocks_data.get('code')})"
+        )
+    return blocks_data.get("data", {})
+
+
+async def iter_document_blocks(
+    client: httpx.AsyncClient,
+    doc_id: str,
+    token: str,
+    revision_id: int = -1
+) -> AsyncIterator[ContentBlock]:
+    """
+    按页获取文档的全部blocks并逐个产出解析结果
+    
+    处理当前页时预取下一页，直到 has_more 为 False。
+    """
+    print(f"Fetching blocks for doc_id: {doc_id}")
+    page = await _fetch_blocks_page(client, doc_id, token, None, revision_id)
+    page_count = 1
+    
+    while True:
+        next_page = None
+        if page.get("has_more") and page.get("page_token"):
+            next_page = asyncio.create_task(
+                _fetch_blocks_page(client, doc_id, token, page["page_token"], revision_id)
+            )
+        
+        try:
+            for block in page.get("items", []):
+                content_block = parse_block(block)
+                if content_block is not None:
+                    yield content_block
+        except BaseException:
+            if next_page is not None:
+                next_page.cancel()
+            raise
+        
+        if next_page is None:
+            break
+        page = await next_page
+        page_count += 1
+    
+    print(f"Fetched {page_count} block page(s) for doc_id: {doc_id}")
+
+
+async def _get_document_meta(client: httpx.AsyncClient, doc_id: str, token: str) -> Tuple[str, int]:
+    """获取文档标题和当前修订版本"""
+    doc_response = await feishu_request(
+        client, "GET", f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    
+    doc_data = doc_response.json()
+    
+    if doc_data.get("code") != 0:
+        raise HTTPException(
+            status_code=400,
+            detail=f"获取文档失败: {doc_data.get('msg')}"
+        )
+    
+    document = doc_data.get("data", {}).get("document", {})
+    return document.get("title", "未命名"), document.get("revision_id", -1)
+
+
+async def _load_blocks(
+    client: httpx.AsyncClient,
+    doc_id: str,
+    token: str,
+    title: str,
+    revision_id: int
+) -> DocumentContent:
+    """
+    获取指定修订版本的文档内容；缓存中有同一修订版本时不再拉取blocks
+    """
+    cached = document_cache.get(token, doc_id, revision_id)
+    if cached is not None:
+        print(f"Document cache hit: {doc_id} (revision {revision_id})")
+        return DocumentContent(doc_id=doc_id, title=title, blocks=cached["blocks"])
+    
+    # 分页获取全部blocks（固定为刚查到的修订版本，保证与ETag一致）
+    content_blocks = [
+        block async for block in iter_document_blocks(client, doc_id, token, revision_id)
+    ]
+    print(f"Total content blocks created: {len(content_blocks)}")
+    
+    document_cache.set(token, doc_id, revision_id, title, [block.model_dump() for block in content_blocks])
+    return DocumentContent(doc_id=doc_id, title=title, blocks=content_blocks)
+
+
+async def load_document_content(doc_id: str, token: str) -> DocumentContent:
+    """
+    获取文档内容（供其他模块调用）
+    """
+    client = get_feishu_client()
+    title, revision_id = await _get_document_meta(client, doc_id, token)
+    return await _load_blocks(client, doc_id, token, title, revision_id)
+
+
 @router.get("/content/{doc_id}", response_model=DocumentContent)
 async def get_document_content(
     doc_id: str,
-    authorization: str = Header(...)
+    response: Response,
+    authorization: str = Header(...),
+    if_none_match: Optional[str] = Header(None),
+    client: httpx.AsyncClient = Depends(get_feishu_client)
 ):
     """
     获取文档内容（文本和图片）
+    
+    先请求元数据拿到 revision_id，支持 ETag / If-None-Match：文档未修改时返回 304。
     """
     try:
         token = authorization.replace("Bearer ", "")
         
-        async with httpx.AsyncClient() as client:
-            # 获取文档元数据
-            doc_response = await client.get(
-                f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            
-            doc_data = doc_response.json()
-            
-            if doc_data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"获取文档失败: {doc_data.get('msg')}"
-                )
-            
-            title = doc_data.get("data", {}).get("document", {}).get("title", "未命名")
-            
-            # 直接使用blocks API获取文档内容（按照官方文档）
-            print(f"Fetching blocks for doc_id: {doc_id}")
-            blocks_response = await client.get(
-                f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks",
-                headers={"Authorization": f"Bearer {token}"},
-                params={
-                    "page_size": 500,
-                    "document_revision_id": -1,  # 获取最新版本
-                    "user_id_type": "open_id"
-                }
-            )
-            
-            blocks_data = blocks_response.json()
-            print(f"Blocks API response code: {blocks_data.get('code')}")
-            print(f"Blocks API response: {blocks_data}")
-            
-            if blocks_data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"获取文档blocks失败: {blocks_data.get('msg')} (code: {blocks_data.get('code')})"
-                )
-            
-            raw_blocks = blocks_data.get("data", {}).get("items", [])
-            print(f"Found {len(raw_blocks)} blocks")
-            
-            # 解析内容块
-            content_blocks = []
-            for i, block in enumerate(raw_blocks):
-                block_type = block.get("block_type")
-                block_id = block.get("block_id")
-                print(f"Block {i}: type={block_type}, id={block_id}")
-                print(f"Block content: {block}")
-                
-                # 处理不同类型的文本块
-                text_content = None
-                text_source = ""
-                
-                if block_type == 1:  # 页面/标题块
-                    text_content = block.get("page", {})
-                    text_source = "page"
-                elif block_type == 2:  # 普通文本块
-                    text_content = block.get("text", {})
-                    text_source = "text"
-                elif block_type == 4:  # 标题块
-                    text_content = block.get("heading2", {})
-                    text_source = "heading2"
-                elif block_type == 5:  # 其他标题块
-                    text_content = block.get("heading1", {}) or block.get("heading3", {})
-                    text_source = "heading1/3"
-                
-                if text_content:
-                    print(f"Block {i} ({text_source}): {text_content}")
-                    elements = text_content.get("elements", [])
-                    print(f"Elements: {elements}")
-                    
-                    if elements:
-                        text = extract_text_from_elements(elements)
-                        print(f"Extracted text: '{text}'")
-                        
-                        if text.strip():
-                            content_blocks.append(ContentBlock(
-                                block_id=block_id,
-                                block_type="text",
-                                text=text
-                            ))
-                            print(f"Added text block: {text[:50]}...")
-                
-                elif block_type == 27:  # 图片块
-                    image = block.get("image", {})
-                    image_token = image.get("token")
-                    if image_token:
-                        content_blocks.append(ContentBlock(
-                            block_id=block_id,
-                            block_type="image",
-                            image_token=image_token
-                        ))
-                        print(f"Added image block: {image_token}")
-                
-                else:
-                    print(f"Unhandled block type: {block_type}")
-            
-            print(f"Total content blocks created: {len(content_blocks)}")
-            
-            return DocumentContent(
-                doc_id=doc_id,
-                title=title,
-                blocks=content_blocks
-            )
-            
+        # 获取文档元数据
+        title, revision_id = await _get_document_meta(client, doc_id, token)
+        etag = make_etag(doc_id, revision_id)
+        cache_headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=cache_headers)
+        
+        content = await _load_blocks(client, doc_id, token, title, revision_id)
+        response.headers.update(cache_headers)
+        return content
+        
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"网络请求失败: {str(e)}")
 
 
+@router.get("/content/{doc_id}/stream")
+async def stream_document_content(
+    doc_id: str,
+    authorization: str = Header(...),
+    client: httpx.AsyncClient = Depends(get_feishu_client)
+):
+    """
+    流式获取文档内容（NDJSON）
+    
+    每行一个JSON：先是 {"type": "meta", ...}，然后每个block一行 {"type": "block", ...}，
+    最后 {"type": "end", "count": N}；出错时输出 {"type": "error", "detail": ...}。
+    """
+    token = authorization.replace("Bearer ", "")
+    
+    async def ndjson_stream():
+        try:
+            title, revision_id = await _get_document_meta(client, doc_id, token)
+            yield json.dumps({"type": "meta", "doc_id": doc_id, "title": title}, ensure_ascii=False) + "\n"
+            
+            count = 0
+            async for block in iter_document_blocks(client, doc_id, token, revision_id):
+                count += 1
+                yield json.dumps(dict(block.model_dump(), type="block"), ensure_ascii=False) + "\n"
+            yield json.dumps({"type": "end", "count": count}) + "\n"
+        except HTTPException as e:
+            yield json.dumps({"type": "error", "detail": e.detail}, ensure_ascii=False) + "\n"
+        except httpx.HTTPError as e:
+            yield json.dumps({"type": "error", "detail": f"网络请求失败: {str(e)}"}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+
 async def get_document_content_fallback(doc_id: str, token: str, title: str):
     """
     回退方法：使用blocks API获取文档内容
     """
+    client = get_feishu_client()
     try:
-        async with httpx.AsyncClient() as client:
-            blocks_response = await client.get(
-                f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks",
-                headers={"Authorization": f"Bearer {token}"},
-                params={"page_size": 500}
-            )
-            
-            blocks_data = blocks_response.json()
-            
-            if blocks_data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"获取文档内容失败: {blocks_data.get('msg')}"
-                )
-            
-            raw_blocks = blocks_data.get("data", {}).get("items", [])
-            
-            # 解析内容块
-            content_blocks = []
-            print(f"Fallback: Total blocks found: {len(raw_blocks)}")
-            
-            for block in raw_blocks:
-                block_type = block.get("block_type")
-                block_id = block.get("block_id")
-                
-                if block_type == 27:  # 图片块
-                    image = block.get("image", {})
-                    image_token = image.get("token")
-                    if image_token:
-                        content_blocks.append(ContentBlock(
-                            block_id=block_id,
-                            block_type="image",
-                            image_token=image_token
-                        ))
-            
-            return DocumentContent(
-                doc_id=doc_id,
-                title=title,
-                blocks=content_blocks
+        blocks_response = await feishu_request(
+            client, "GET", f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks",
+            headers={"Authorization": f"Bearer {token}"},
+            params={"page_size": 500}
+        )
+        
+        blocks_data = blocks_response.json()
+        
+        if blocks_data.get("code") != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"获取文档内容失败: {blocks_data.get('msg')}"
             )
-            
+        
+        raw_blocks = blocks_data.get("data", {}).get("items", [])
+        
+        # 解析内容块
+        content_blocks = []
+        print(f"Fallback: Total blocks found: {len(raw_blocks)}")
+        
+        for block in raw_blocks:
+            block_type = block.get("block_type")
+            block_id = block.get("block_id")
+            
+            if block_type == 27:  # 图片块
+                image = block.get("image", {})
+                image_token = image.get("token")
+                if image_token:
+                    content_blocks.append(ContentBlock(
+                        block_id=block_id,
+                        block_type="image",
+                        image_token=image_token
+                    ))
+        
+        return DocumentContent(
+            doc_id=doc_id,
+            title=title,
+            blocks=content_blocks
+        )
+        
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"回退方法失败: {str(e)}")
 
 
+async def _upload_image(
+    client: httpx.AsyncClient,
+    token: str,
+    doc_id: str,
+    idx: int,
+    img: dict
+) -> Optional[str]:
+    """
+    上传单张图片到文档，返回 file_token（失败返回None）
+    """
+    try:
+        # 图片存储中的引用（批量任务写回）或前端传来的base64
+        img_data = await image_store.read(img)
+        
+        # 上传图片 - 使用正确的multipart/form-data格式
+        # （传bytes而不是文件对象，被限流重试时可以重新发送）
+        files = {
+            'file': (f'image_{idx+1}.jpg', img_data, img.get('mime_type', 'image/jpeg'))
+        }
+        
+        # 注意：parent_type和parent_node必须一起传
+        upload_response = await feishu_request(
+            client, "POST", "https://open.feishu.cn/open-apis/drive/v1/medias/upload_all",
+            headers={"Authorization": f"Bearer {token}"},
+            files=files,
+            data={
+                "file_name": f'image_{idx+1}.jpg',
+                "parent_type": "docx_image",
+                "parent_node": doc_id,
+                "size": str(len(img_data))
+            }
+        )
+        
+        upload_data = upload_response.json()
+        print(f"Upload image {idx+1} response: {upload_data}")
+        
+        if upload_data.get("code") == 0:
+            file_token = upload_data.get("data", {}).get("file_token")
+            print(f"Image {idx+1} uploaded successfully: {file_token}")
+            return file_token
+        print(f"Image {idx+1} upload failed: {upload_data.get('msg')}")
+            
+    except Exception as e:
+        print(f"Error uploading image {idx+1}: {e}")
+    return None
+
+
 @router.post("/create")
 async def create_feishu_document(
     request: dict,
-    authorization: str = Header(...)
+    authorization: str = Header(...),
+    client: httpx.AsyncClient = Depends(get_feishu_client)
 ):
     """
     创建新的飞书文档并写入内容
@@ -297,231 +475,118 @@ async def create_feishu_document(
         token = authorization.replace("Bearer ", "")
         title = request.get("title", "AI生成的文章")
         content = request.get("content", "")
-        images = request.get("images", [])  # [{mime_type: str, data: str (base64)}]
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            # 1. 创建新文档 - 清理标题中的特殊字符
-            import re
-            # 移除或替换特殊字符，避免GBK编码问题
-            clean_title = re.sub(r'[^\w\s\-_\.\(\)\[\]（）【】]', '', title)
-            if not clean_title.strip():
-                clean_title = "AI创作文档"
-            
-            print(f"Original title: {title}")
-            print(f"Clean title: {clean_title}")
-            
-            create_response = await client.post(
-                "https://open.feishu.cn/open-apis/docx/v1/documents",
-                headers={
-                    "Authorization": f"Bearer {token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "title": clean_title,
-                    "folder_token": ""  # 创建在根目录
-                }
+        images = request.get("images", [])  # [{mime_type: str, data: str (base64)}] 或图片存储中的引用
+        
+        # 1. 创建新文档 - 清理标题中的特殊字符
+        import re
+        # 移除或替换特殊字符，避免GBK编码问题
+        clean_title = re.sub(r'[^\w\s\-_\.\(\)\[\]（）【】]', '', title)
+        if not clean_title.strip():
+            clean_title = "AI创作文档"
+        
+        print(f"Original title: {title}")
+        print(f"Clean title: {clean_title}")
+        
+        create_response = await feishu_request(
+            client, "POST", "https://open.feishu.cn/open-apis/docx/v1/documents",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "title": clean_title,
+                "folder_token": ""  # 创建在根目录
+            }
+        )
+        
+        create_data = create_response.json()
+        print(f"Create document response: {create_data}")
+        
+        if create_data.get("code") != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"创建文档失败: {create_data.get('msg')}"
             )
-            
-            create_data = create_response.json()
-            print(f"Create document response: {create_data}")
-            
-            if create_data.get("code") != 0:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"创建文档失败: {create_data.get('msg')}"
-                )
-            
-            doc_id = create_data.get("data", {}).get("document", {}).get("document_id")
-            doc_url = f"https://feishu.cn/docx/{doc_id}"
-            
-            # 2. 上传图片到飞书（如果有）
-            image_tokens = {}
-            for idx, img in enumerate(images):
-                try:
-                    import io
-                    import base64
-                    import time
-                    
-                    # 解码base64图片
-                    img_data = base64.b64decode(img['data'])
-                    
-                    # 上传图片 - 使用正确的multipart/form-data格式
-                    files = {
-                        'file': (f'image_{idx+1}.jpg', io.BytesIO(img_data), img.get('mime_type', 'image/jpeg'))
-                    }
-                    
-                    # 注意：parent_type和parent_node必须一起传
-                    upload_response = await client.post(
-                        "https://open.feishu.cn/open-apis/drive/v1/medias/upload_all",
-                        headers={"Authorization": f"Bearer {token}"},
-                        files=files,
-                        data={
-                            "file_name": f'image_{idx+1}.jpg',
-                            "parent_type": "docx_image",
-                            "parent_node": doc_id,
-                            "size": str(len(img_data))
-                        }
-                    )
-                    
-                    # 限速：避免触发频率限制
-                    time.sleep(0.3)
-                    
-                    upload_data = upload_response.json()
-                    print(f"Upload image {idx+1} response: {upload_data}")
-                    
-                    if upload_data.get("code") == 0:
-                        file_token = upload_data.get("data", {}).get("file_token")
-                        image_tokens[f"image_{idx+1}"] = file_token
-                        print(f"Image {idx+1} uploaded successfully: {file_token}")
-                    else:
-                        print(f"Image {idx+1} upload failed: {upload_data.get('msg')}")
-                        
-                except Exception as e:
-                    print(f"Error uploading image {idx+1}: {e}")
-            
-            # 3. 解析Markdown并转换为飞书blocks
-            # 将 ![描述](image_N) 替换为实际的图片token
-            import re
-            
-            # 按行处理内容
-            lines = content.split('\n')
-            blocks_to_create = []
-            
-            for line in lines:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                # 检查是否是图片标记
-                img_match = re.match(r'!\[([^\]]*)\]\(image_(\d+)\)', line)
-                if img_match:
-                    img_num = img_match.group(2)
-                    img_key = f"image_{img_num}"
-                    
-                    if img_key in image_tokens:
-                        # 添加图片块
-                        blocks_to_create.append({
-                            "block_type": 27,  # 图片类型
-                            "image": {
-                                "token": image_tokens[img_key]
-                            }
-                        })
+        
+        doc_id = create_data.get("data", {}).get("document", {}).get("document_id")
+        doc_url = f"https://feishu.cn/docx/{doc_id}"
+        
+        # 2. 上传图片到飞书（如果有）
+        # 上传在后台并发进行（并发数受限，且经过限流），与下面的Markdown解析交替进行：
+        # 解析每段之间让出事件循环，上传任务在此期间发出请求
+        semaphore = asyncio.Semaphore(config.FEISHU_UPLOAD_CONCURRENCY)
+        
+        async def upload(idx: int, img: dict) -> Optional[str]:
+            async with semaphore:
+                return await _upload_image(client, token, doc_id, idx, img)
+        
+        # image_N -> 上传任务，编号与AI输出中的引用一一对应，与完成顺序无关
+        upload_tasks = {
+            f"image_{idx+1}": asyncio.create_task(upload(idx, img))
+            for idx, img in enumerate(images)
+        }
+        
+        try:
+            # 3. 解析Markdown并转换为飞书blocks（图片仍在上传）
+            # ![描述](image_N) 先生成图片占位块，上传完成后填入file_token
+            blocks_to_create = [
+                block async for block in acompile_markdown([content])
+                if block["block_type"] != BLOCK_IMAGE or block["image_ref"] in upload_tasks
+            ]
+            
+            # 等待图片上传完成并填入file_token，上传失败的图片不生成图片块
+            uploaded = await asyncio.gather(*upload_tasks.values())
+        finally:
+            # 解析出错或上传失败时取消尚未完成的上传
+            for task in upload_tasks.values():
+                task.cancel()
+        image_tokens = {key: file_token for key, file_token in zip(upload_tasks, uploaded) if file_token}
+        print(f"Uploaded {len(image_tokens)}/{len(upload_tasks)} images")
+        resolved_blocks = []
+        for block in blocks_to_create:
+            if block["block_type"] == BLOCK_IMAGE:
+                file_token = image_tokens.get(block.pop("image_ref"))
+                if not file_token:
                     continue
-                
-                # 检查是否是标题(从最长的开始检查,避免误匹配)
-                if line.startswith('####'):
-                    # 四级标题在飞书中不存在,转为三级标题
-                    blocks_to_create.append({
-                        "block_type": 5,  # 三级标题
-                        "heading3": {
-                            "elements": [{"text_run": {"content": line[5:].strip()}}]
-                        }
-                    })
-                elif line.startswith('###'):
-                    blocks_to_create.append({
-                        "block_type": 5,  # 三级标题
-                        "heading3": {
-                            "elements": [{"text_run": {"content": line[4:].strip()}}]
-                        }
-                    })
-                elif line.startswith('##'):
-                    blocks_to_create.append({
-                        "block_type": 4,  # 二级标题
-                        "heading2": {
-                            "elements": [{"text_run": {"content": line[3:].strip()}}]
-                        }
-                    })
-                elif line.startswith('#'):
-                    blocks_to_create.append({
-                        "block_type": 3,  # 一级标题
-                        "heading1": {
-                            "elements": [{"text_run": {"content": line[2:].strip()}}]
-                        }
-                    })
-                else:
-                    # 普通文本
-                    blocks_to_create.append({
-                        "block_type": 2,  # 文本块类型是2
-                        "paragraph": {
-                            "elements": [{"text_run": {"content": line}}]
-                        }
-                    })
+                block["image"]["token"] = file_token
+            resolved_blocks.append(block)
+        blocks_to_create = resolved_blocks
+        
+        # 4. 分批创建blocks（飞书限制每次最多50个）
+        blocks_written = 0
+        if blocks_to_create:
+            # 获取文档根block_id
+            doc_info_response = await feishu_request(
+                client, "GET", f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}",
+                headers={"Authorization": f"Bearer {token}"}
+            )
             
-            # 4. 分批创建blocks（飞书限制每次最多50个）
-            if blocks_to_create:
-                # 获取文档根block_id
-                doc_info_response = await client.get(
-                    f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}",
-                    headers={"Authorization": f"Bearer {token}"}
-                )
+            doc_info = doc_info_response.json()
+            if doc_info.get("code") == 0:
+                root_block_id = doc_info.get("data", {}).get("document", {}).get("block_id")
                 
-                doc_info = doc_info_response.json()
-                if doc_info.get("code") == 0:
-                    root_block_id = doc_info.get("data", {}).get("document", {}).get("block_id")
-                    
-                    # 分批创建（每批最多50个）
-                    batch_size = 50
-                    total_batches = (len(blocks_to_create) + batch_size - 1) // batch_size
-                    
-                    for batch_idx in range(total_batches):
-                        start_idx = batch_idx * batch_size
-                        end_idx = min(start_idx + batch_size, len(blocks_to_create))
-                        batch_blocks = blocks_to_create[start_idx:end_idx]
-                        
-                        print(f"Creating batch {batch_idx + 1}/{total_batches}: {len(batch_blocks)} blocks")
-                        
-                        # 调试：打印前3个block的结构
-                        if batch_blocks:
-                            import json
-                            for i, block in enumerate(batch_blocks[:3]):
-                                print(f"Block {i+1} structure: {json.dumps(block, ensure_ascii=False, indent=2)}")
-                        
-                        # 测试：只发送第一个block
-                        test_block = [{
-                            "block_type": 2,
-                            "text": {
-                                "elements": [{"text_run": {"content": "测试文本"}}],
-                                "style": {}
-                            }
-                        }]
-                        
-                        print(f"Testing with simple block: {json.dumps(test_block, ensure_ascii=False, indent=2)}")
-                        
-                        children_response = await client.post(
-                            f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks/{root_block_id}/children",
-                            headers={
-                                "Authorization": f"Bearer {token}",
-                                "Content-Type": "application/json"
-                            },
-                            json={
-                                "children": test_block
-                            }
-                        )
-                        
-                        children_data = children_response.json()
-                        print(f"Batch {batch_idx + 1} response: {children_data}")
-                        
-                        if children_data.get("code") != 0:
-                            # 安全处理错误消息，避免GBK编码问题
-                            error_msg = children_data.get('msg', 'Unknown error')
-                            try:
-                                print(f"Batch {batch_idx + 1} failed: {error_msg}")
-                            except UnicodeEncodeError:
-                                print(f"Batch {batch_idx + 1} failed: [Error message contains special characters]")
-                            break
-                        else:
-                            print(f"Batch {batch_idx + 1} created successfully")
-                        
-                        # 批次间延迟，避免触发频率限制
-                        if batch_idx < total_batches - 1:
-                            time.sleep(0.5)
-            
-            return {
-                "doc_id": doc_id,
-                "doc_url": doc_url,
-                "message": "文档创建成功"
-            }
-            
+                # 分批流水线写入（每批最多50个），保持顺序
+                try:
+                    blocks_written = await create_children(
+                        client, token, doc_id, root_block_id, blocks_to_create
+                    )
+                except FeishuWriteError as e:
+                    # 安全处理错误消息，避免GBK编码问题
+                    try:
+                        print(f"Write blocks failed: {e}")
+                    except UnicodeEncodeError:
+                        print("Write blocks failed: [Error message contains special characters]")
+                    blocks_written = e.written
+                print(f"Blocks written: {blocks_written}/{len(blocks_to_create)}")
+        
+        return {
+            "doc_id": doc_id,
+            "doc_url": doc_url,
+            "blocks_written": blocks_written,
+            "blocks_total": len(blocks_to_create),
+            "message": "文档创建成功"
+        }
+        
     except Exception as e:
         # 安全处理异常消息，避免GBK编码问题
         try:
@@ -533,15 +598,158 @@ async def create_feishu_document(
             raise HTTPException(status_code=500, detail="创建文档失败: 文档内容包含特殊字符，请检查输入")
 
 
+# image_token 对应的图片内容不会变化，浏览器可以长期缓存（需要认证，所以是 private）
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+
+async def fetch_image(image_token: str, token: str, writer) -> str:
+    """从飞书流式下载图片写入缓存文件，返回上游的 content-type"""
+    async with feishu_stream(
+        get_feishu_client(), "GET",
+        f"https://open.feishu.cn/open-apis/drive/v1/medias/{image_token}/download",
+        headers={"Authorization": f"Bearer {token}"}
+    ) as response:
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail="图片下载失败")
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            await writer.write(chunk)
+        return response.headers.get("content-type", "image/jpeg")
+
+
+# 已向飞书确认过的访问权限：(token摘要, image_token) -> 过期时间
+_image_grants: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+_IMAGE_GRANTS_MAX = 10000
+
+
+async def check_image_access(image_token: str, token: str) -> None:
+    """
+    确认 token 对应的用户能访问该图片，无权访问时抛出 HTTPException
+
+    图片缓存按 image_token 在所有用户间共享，缓存命中时没有经过飞书的权限校验；
+    这里用获取临时下载链接的接口（不下载图片内容）校验，结果保留 IMAGE_ACCESS_CHECK_TTL 秒。
+    """
+    key = (hashlib.sha256(token.encode()).hexdigest(), image_token)
+    expires_at = _image_grants.get(key)
+    if expires_at is not None and expires_at > time.monotonic():
+        _image_grants.move_to_end(key)
+        return
+    
+    response = await feishu_request(
+        get_feishu_client(), "GET",
+        "https://open.feishu.cn/open-apis/drive/v1/medias/batch_get_tmp_download_url",
+        params={"file_tokens": image_token},
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    if response.status_code == 401:
+        raise HTTPException(status_code=401, detail="认证失败，请重新登录")
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    urls = (data.get("data") or {}).get("tmp_download_urls") or []
+    if data.get("code") != 0 or not any(item.get("file_token") == image_token for item in urls):
+        _image_grants.pop(key, None)
+        raise HTTPException(status_code=403, detail="无权访问该图片")
+    
+    _image_grants[key] = time.monotonic() + config.IMAGE_ACCESS_CHECK_TTL
+    _image_grants.move_to_end(key)
+    while len(_image_grants) > _IMAGE_GRANTS_MAX:
+        _image_grants.popitem(last=False)
+
+
+async def get_cached_image(image_token: str, token: str) -> dict:
+    """
+    经磁盘缓存获取原图；不是由本次请求下载的（缓存命中或合并到他人的下载）需先校验访问权限
+    """
+    downloaded = False
+    
+    async def fetch(writer) -> str:
+        nonlocal downloaded
+        downloaded = True
+        return await fetch_image(image_token, token, writer)
+    
+    entry = await image_cache.get_or_fetch(image_token, fetch)
+    if not downloaded:
+        await check_image_access(image_token, token)
+    return entry
+
+
+def _cached_image_response(entry: dict, range_header: Optional[str], if_none_match: Optional[str]) -> Response:
+    """从磁盘缓存构造图片响应，支持 ETag 和单段 Range"""
+    etag = f'"{entry["sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMAGE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes"
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    size = entry["size"]
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(image_cache.iter_file(entry), media_type=entry["mime_type"], headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        image_cache.iter_file(entry, start, end),
+        status_code=206,
+        media_type=entry["mime_type"],
+        headers=headers
+    )
+
+
+def _variant_width(width: int) -> int:
+    """把请求的宽度向上取到配置的档位"""
+    for allowed in sorted(config.IMAGE_VARIANT_WIDTHS):
+        if width <= allowed:
+            return allowed
+    return max(config.IMAGE_VARIANT_WIDTHS)
+
+
+async def _get_image_variant(
+    image_token: str,
+    token: str,
+    width: int,
+    fmt: str
+) -> dict:
+    """获取缩放后的图片变体：由缓存中的原图在进程池中生成，生成结果同样进入缓存"""
+    original = await get_cached_image(image_token, token)
+    
+    async def render(writer) -> str:
+        variant = await make_variant(await image_cache.read(original), width, fmt)
+        await writer.write(variant["data"])
+        return variant["mime_type"]
+    
+    return await image_cache.get_or_fetch(f"{image_token}@{width}w.{fmt}", render)
+
+
 @router.get("/image/{doc_id}/{image_token}")
 async def get_image(
     doc_id: str,
     image_token: str,
     token: str = None,
-    authorization: str = Header(None)
+    w: Optional[int] = Query(None, ge=1, description="缩略图宽度（像素），向上取到最近的档位"),
+    format: Optional[str] = Query(None, pattern="^(webp|jpeg)$", description="缩略图格式，默认按 Accept 头选择"),
+    authorization: str = Header(None),
+    accept: Optional[str] = Header(None),
+    range_header: Optional[str] = Header(None, alias="Range"),
+    if_none_match: Optional[str] = Header(None)
 ):
     """
-    获取图片数据（返回图片URL或base64）
+    获取图片数据（可选缩略图变体）
+    
+    图片按 image_token 缓存在本地磁盘，同一图片的并发请求只下载一次；
+    缓存命中时先向飞书确认当前用户有权访问该图片；
+    响应从磁盘流式返回，带强ETag和长期 Cache-Control，支持 Range 请求。
+    传入 w 时返回指定宽度的 WebP/JPEG 缩略图。
     """
     try:
         # 优先从query parameter获取token，如果没有则从header获取
@@ -551,27 +759,31 @@ async def get_image(
         if not token:
             raise HTTPException(status_code=401, detail="缺少认证token")
         
-        async with httpx.AsyncClient() as client:
-            # 下载图片
-            response = await client.get(
-                f"https://open.feishu.cn/open-apis/drive/v1/medias/{image_token}/download",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=400, detail="图片下载失败")
-            
-            # 返回图片二进制数据
-            from fastapi.responses import Response
-            return Response(
-                content=response.content,
-                media_type=response.headers.get("content-type", "image/jpeg")
-            )
+        if w is None and format is None:
+            entry = await get_cached_image(image_token, token)
+            return _cached_image_response(entry, range_header, if_none_match)
+        
+        width = _variant_width(w) if w else max(config.IMAGE_VARIANT_WIDTHS)
+        fmt = format or ("webp" if accept and "image/webp" in accept else "jpeg")
+        entry = await _get_image_variant(image_token, token, width, fmt)
+        response = _cached_image_response(entry, range_header, if_none_match)
+        if format is None:
+            # 格式由 Accept 头决定，中间缓存需要区分
+            response.headers["Vary"] = "Accept"
+        return response
             
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"图片下载失败: {str(e)}")
 
 
+@router.get("/image-cache/stats")
+async def get_image_cache_stats():
+    """
+    图片缓存统计
+    """
+    return image_cache.snapshot()
+
+
 def extract_text_from_elements(elements: List[dict]) -> str:
     """
     从飞书文档元素中提取文本
@@ -0,0 +1,254 @@
+"""
+批量生成任务路由
+"""
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any, Tuple
+import os
+import json
+import time
+import asyncio
+import hashlib
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import config
+from routers import ai, documents
+from services.admission import PRIORITY_BATCH
+from services.batch_jobs import batch_jobs, BatchJob, FINISHED_STATES
+from services.deadline import Deadline
+from services.feishu_api import get_feishu_client, feishu_request
+
+router = APIRouter()
+
+
+class BatchCreateRequest(BaseModel):
+    instruction: str
+    doc_ids: List[str] = []
+    folder_token: Optional[str] = None  # 处理该文件夹下的所有docx文档
+    write_back: bool = False  # 是否把生成结果写回为新的飞书文档
+
+
+class BatchCreateResponse(BaseModel):
+    job_id: str
+    total: int
+
+
+# token摘要 -> (open_id, 过期时间)
+_owners: Dict[str, Tuple[str, float]] = {}
+_OWNER_CACHE_TTL = 600
+
+
+async def _job_owner(token: str) -> str:
+    """
+    token 对应的飞书用户 open_id，作为任务所有者标识
+
+    access_token 会刷新，不能直接用token比较；结果按token缓存一段时间。
+    """
+    key = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    cached = _owners.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    response = await feishu_request(
+        get_feishu_client(), "GET", "https://open.feishu.cn/open-apis/authen/v1/user_info",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    open_id = (data.get("data") or {}).get("open_id")
+    if data.get("code") != 0 or not open_id:
+        raise HTTPException(status_code=401, detail="认证失败，请重新登录")
+
+    if len(_owners) > 1000:
+        for expired in [k for k, (_, expires_at) in _owners.items() if expires_at <= now]:
+            del _owners[expired]
+    _owners[key] = (open_id, now + _OWNER_CACHE_TTL)
+    return open_id
+
+
+def _request_token(token: Optional[str], authorization: Optional[str]) -> str:
+    """优先从query parameter获取token（EventSource 无法设置请求头），否则从header获取"""
+    if not token and authorization:
+        token = authorization.replace("Bearer ", "")
+    if not token:
+        raise HTTPException(status_code=401, detail="缺少认证token")
+    return token
+
+
+async def _owned_job(job_id: str, token: str) -> BatchJob:
+    """读取任务并确认属于当前用户（不属于时同样返回404，不暴露任务是否存在）"""
+    job = await batch_jobs.get(job_id)
+    if not job or job.owner != await _job_owner(token):
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+async def _list_folder_docs(token: str, folder_token: str) -> List[str]:
+    """分页列出文件夹下的所有docx文档"""
+    client = get_feishu_client()
+    doc_ids = []
+    page_token = None
+    while True:
+        params = {"folder_token": folder_token, "page_size": 200}
+        if page_token:
+            params["page_token"] = page_token
+        response = await feishu_request(
+            client, "GET", "https://open.feishu.cn/open-apis/drive/v1/files",
+            headers={"Authorization": f"Bearer {token}"},
+            params=params
+        )
+        data = response.json()
+        if data.get("code") != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"获取文件夹文档失败: {data.get('msg')}"
+            )
+        files = data.get("data", {}).get("files", [])
+        doc_ids.extend(f.get("token") for f in files if f.get("type") == "docx")
+        if not data.get("data", {}).get("has_more"):
+            break
+        page_token = data.get("data", {}).get("next_page_token")
+    return doc_ids
+
+
+async def process_document(job: BatchJob, item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    批量任务中处理单篇文档：获取内容 → 下载图片 → 生成 →（可选）写回
+    """
+    authorization = f"Bearer {job.token}"
+    content = await documents.load_document_content(item["doc_id"], job.token)
+    create_request = ai.CreateRequest(
+        doc_id=item["doc_id"],
+        blocks=[block.model_dump() for block in content.blocks],
+        instruction=job.instruction
+    )
+
+    # 被准入控制拒绝时按 Retry-After 等待后重试
+    for attempt in range(config.BATCH_JOB_MAX_RETRIES + 1):
+        try:
+            generated = await ai.generate_for_document(
+                create_request,
+                job.token,
+                Deadline(config.AI_REQUEST_BUDGET),
+                priority=PRIORITY_BATCH,
+                user=f"batch:{job.job_id}"
+            )
+            break
+        except HTTPException as e:
+            if e.status_code not in (429, 503) or attempt == config.BATCH_JOB_MAX_RETRIES:
+                raise
+            retry_after = int((e.headers or {}).get("Retry-After", 5))
+            print(f"Batch job {job.job_id}: doc {item['doc_id']} throttled, retry in {retry_after}s")
+            await asyncio.sleep(retry_after)
+
+    result = {
+        "title": content.title,
+        "session_id": generated["session_id"],
+        "failed_images": generated["failed_images"]
+    }
+
+    if job.write_back:
+        created = await documents.create_feishu_document(
+            {
+                "title": f"{content.title}（AI创作）",
+                "content": generated["content"],
+                "images": generated["images"]
+            },
+            authorization=authorization,
+            client=get_feishu_client()
+        )
+        result["new_doc_id"] = created["doc_id"]
+        result["new_doc_url"] = created["doc_url"]
+
+    return result
+
+
+batch_jobs.set_processor(process_document)
+
+
+@router.post("/batch-create", response_model=BatchCreateResponse)
+async def submit_batch_create(
+    request: BatchCreateRequest,
+    authorization: str = Header(...)
+):
+    """
+    提交批量生成任务，立即返回任务ID
+    """
+    token = authorization.replace("Bearer ", "")
+    owner = await _job_owner(token)
+
+    doc_ids = list(request.doc_ids)
+    if request.folder_token:
+        doc_ids.extend(await _list_folder_docs(token, request.folder_token))
+    # 去重并保持顺序
+    doc_ids = list(dict.fromkeys(doc_ids))
+
+    if not doc_ids:
+        raise HTTPException(status_code=400, detail="没有需要处理的文档")
+
+    job = await batch_jobs.submit(token, owner, request.instruction, doc_ids, request.write_back)
+    print(f"Batch job {job.job_id} submitted: {len(doc_ids)} documents")
+    return BatchCreateResponse(job_id=job.job_id, total=len(doc_ids))
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, token: str = None, authorization: str = Header(None)):
+    """
+    查询任务进度（任意worker均可查询）
+    """
+    job = await _owned_job(job_id, _request_token(token, authorization))
+    return job.progress()
+
+
+@router.get("/{job_id}/events")
+async def stream_job_events(job_id: str, token: str = None, authorization: str = Header(None)):
+    """
+    订阅任务进度（Server-Sent Events），任务结束或暂停后关闭
+    """
+    job = await _owned_job(job_id, _request_token(token, authorization))
+
+    async def event_stream():
+        current = job
+        last_version = -1
+        last_status = None
+        while True:
+            if current.version != last_version or current.status != last_status:
+                last_version, last_status = current.version, current.status
+                yield f"event: progress\ndata: {json.dumps(current.progress(), ensure_ascii=False)}\n\n"
+            if current.status in FINISHED_STATES or current.status == "paused":
+                return
+            current = await batch_jobs.wait_changed(current, timeout=15)
+            if current.version == last_version and current.status == last_status:
+                # 保持连接
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=ai.SSE_HEADERS)
+
+
+@router.post("/{job_id}/resume")
+async def resume_job(job_id: str, authorization: str = Header(...)):
+    """
+    用当前用户的token继续执行已暂停的任务（进程重启后token不会保留）
+    """
+    token = authorization.replace("Bearer ", "")
+    await _owned_job(job_id, token)
+    job = await batch_jobs.resume(job_id, token)
+    if job is None:
+        raise HTTPException(status_code=409, detail="任务正在其他进程中执行")
+    return job.progress()
+
+
+@router.delete("/{job_id}")
+async def cancel_job(job_id: str, token: str = None, authorization: str = Header(None)):
+    """
+    取消任务（已完成的文档结果保留）；任务在其他worker上执行时由执行者在续期租约时停止
+    """
+    await _owned_job(job_id, _request_token(token, authorization))
+    if not await batch_jobs.cancel(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return {"message": "任务已取消"}
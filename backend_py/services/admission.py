@@ -0,0 +1,228 @@
+"""
+AI调用准入控制
+
+每个AI提供商一个控制器：
+- 并发上限：同时进行的调用数
+- 有界等待队列：精修（交互式）优先于首次生成
+- 按用户公平：同一优先级内，已占用较多名额的用户排在后面；单用户名额有上限
+- 队列已满或单用户超限时立即拒绝，并给出 Retry-After
+
+自动路由（AI_PROVIDER=auto）时，名额按路由实际调用的成员提供商申请：
+请求处理时用 set_routed_request 记录优先级、用户和截止时间，RoutingProvider 选定成员后调用 acquire_member。
+"""
+import time
+import heapq
+import asyncio
+import itertools
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple
+
+import config
+
+# 优先级：数值越小越优先
+PRIORITY_REFINE = 0
+PRIORITY_CREATE = 1
+PRIORITY_BATCH = 2  # 后台批量任务，排在所有交互式请求之后
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（应返回 429/503 + Retry-After）"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一次准入的名额，release 可重复调用（controller 为 None 时不占用任何名额）"""
+
+    def __init__(self, controller: Optional["AdmissionController"], user: str):
+        self._controller = controller
+        self._user = user
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        if self._controller is not None:
+            self._controller._release(self._user, time.monotonic() - self._started)
+
+    async def __aenter__(self) -> "Ticket":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class AdmissionController:
+    """单个提供商的并发限制 + 优先级等待队列"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_per_user: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.running = 0
+        self._queue: List[tuple] = []  # (priority, user_load, seq, user, future)
+        self._seq = itertools.count()
+        self._user_load: Dict[str, int] = {}  # 用户的进行中 + 排队中请求数
+        self._avg_service_time = 20.0  # 平均调用耗时（EWMA），用于估算 Retry-After
+        self.rejected = 0
+
+    def _retry_after(self) -> int:
+        waiting = len(self._queue) + 1
+        estimate = self._avg_service_time * waiting / max(self.max_concurrency, 1)
+        return max(1, int(estimate))
+
+    async def acquire(self, priority: int, user: str, timeout: Optional[float] = None) -> Ticket:
+        load = self._user_load.get(user, 0)
+        if load >= self.max_per_user:
+            self.rejected += 1
+            raise AdmissionRejected(429, "请求过于频繁，请等待当前生成完成后再试", self._retry_after())
+
+        if self.running < self.max_concurrency and not self._queue:
+            self._admit(user)
+            return Ticket(self, user)
+
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(503, "AI服务繁忙，请稍后重试", self._retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, load, next(self._seq), user, future)
+        heapq.heappush(self._queue, entry)
+        self._user_load[user] = load + 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 已被分配名额但调用方放弃，归还名额
+                Ticket(self, user).release()
+            else:
+                future.cancel()
+                self._remove(entry)
+                self._decrement(user)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise AdmissionRejected(503, "排队等待超时，AI服务繁忙，请稍后重试", self._retry_after())
+            raise
+        return Ticket(self, user)
+
+    def try_acquire(self, priority: int, user: str) -> Optional[Ticket]:
+        """不排队：有空闲名额时立即占用，否则返回 None"""
+        if self._user_load.get(user, 0) >= self.max_per_user:
+            return None
+        if self.running >= self.max_concurrency or self._queue:
+            return None
+        self._admit(user)
+        return Ticket(self, user)
+
+    def _admit(self, user: str) -> None:
+        self.running += 1
+        self._user_load[user] = self._user_load.get(user, 0) + 1
+
+    def _remove(self, entry: tuple) -> None:
+        try:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+        except ValueError:
+            pass
+
+    def _decrement(self, user: str) -> None:
+        load = self._user_load.get(user, 0) - 1
+        if load > 0:
+            self._user_load[user] = load
+        else:
+            self._user_load.pop(user, None)
+
+    def _release(self, user: str, service_time: float) -> None:
+        self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * service_time
+        self.running -= 1
+        self._decrement(user)
+        while self._queue and self.running < self.max_concurrency:
+            _, _, _, _, future = heapq.heappop(self._queue)
+            if future.cancelled():
+                continue
+            # 排队时已计入用户占用，这里只增加运行数
+            self.running += 1
+            future.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queued": len(self._queue),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "avg_service_time": round(self._avg_service_time, 2)
+        }
+
+
+def _parse_limits(spec: str) -> Dict[str, int]:
+    """解析 "qwen=4,deepseek=8" 形式的配置"""
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, value = item.split("=", 1)
+            limits[name.strip().lower()] = int(value)
+    return limits
+
+
+_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_controller(provider_name: str) -> AdmissionController:
+    name = provider_name.lower()
+    controller = _controllers.get(name)
+    if controller is None:
+        limits = _parse_limits(config.AI_CONCURRENCY_LIMITS)
+        controller = AdmissionController(
+            name,
+            max_concurrency=limits.get(name, config.AI_MAX_CONCURRENCY),
+            max_queue=config.AI_MAX_QUEUE,
+            max_per_user=config.AI_MAX_PER_USER
+        )
+        _controllers[name] = controller
+    return controller
+
+
+# 当前请求的 (优先级, 用户, 截止时间)，截止时间为 time.monotonic() 时间
+_routed_request: ContextVar[Optional[Tuple[int, str, float]]] = ContextVar("routed_request", default=None)
+
+
+def set_routed_request(priority: int, user: str, deadline: float) -> Ticket:
+    """
+    记录当前请求的准入信息，名额由路由提供商选定成员后再申请
+
+    返回不占用名额的 Ticket，调用方可以与普通准入同样使用。
+    """
+    _routed_request.set((priority, user, deadline))
+    return Ticket(None, user)
+
+
+async def acquire_member(provider_name: str, wait: bool = True) -> Optional[Ticket]:
+    """
+    路由提供商调用成员前申请该成员的名额
+
+    没有记录请求信息（例如脚本直接调用提供商）时不做准入，返回 None；
+    wait=False 时不排队，没有空闲名额直接拒绝（用于对冲请求）。
+    """
+    request = _routed_request.get()
+    if request is None:
+        return None
+    priority, user, deadline = request
+    controller = get_controller(provider_name)
+    if not wait:
+        ticket = controller.try_acquire(priority, user)
+        if ticket is None:
+            raise AdmissionRejected(503, "AI服务繁忙，请稍后重试", controller._retry_after())
+        return ticket
+    return await controller.acquire(priority, user, timeout=max(deadline - time.monotonic(), 0))
+
+
+def snapshot() -> Dict[str, Any]:
+    return {name: controller.snapshot() for name, controller in _controllers.items()}
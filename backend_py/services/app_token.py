@@ -0,0 +1,130 @@
+"""
+应用级 app_access_token 缓存
+
+app_access_token 有效期约2小时，不需要每次登录/刷新都重新获取：
+- 按返回的 expire 字段缓存，过期前由后台任务提前刷新
+- 进入提前刷新窗口后仍返回旧token（仍有效），同时触发刷新，不让调用方等待
+- 并发调用共享同一次刷新请求
+"""
+import os
+import time
+import asyncio
+from typing import Optional
+
+import config
+from services.feishu_api import get_feishu_client, feishu_request
+
+APP_ACCESS_TOKEN_URL = "https://open.feishu.cn/open-apis/auth/v3/app_access_token/internal"
+
+# 飞书返回的 app_access_token 无效/过期业务码，遇到时丢弃缓存
+INVALID_APP_TOKEN_CODES = {99991663, 99991664}
+
+# 后台刷新失败后的重试间隔，以及两次刷新之间的最短间隔（秒）
+_RETRY_INTERVAL = 30
+_MIN_REFRESH_INTERVAL = 30
+
+
+class AppTokenError(Exception):
+    """获取 app_access_token 失败（应用配置缺失或飞书返回错误）"""
+
+
+class AppTokenManager:
+    """app_access_token 的进程内缓存，带单飞刷新和后台提前刷新"""
+
+    def __init__(self, refresh_margin: float):
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0  # time.monotonic() 时间
+        self._inflight: Optional[asyncio.Task] = None
+        self._background: Optional[asyncio.Task] = None
+
+    def _remaining(self) -> float:
+        return self._expires_at - time.monotonic()
+
+    async def get(self) -> str:
+        """返回可用的 app_access_token，必要时等待刷新"""
+        remaining = self._remaining()
+        if self._token and remaining > 0:
+            if remaining <= self.refresh_margin:
+                # 即将过期：先返回旧token，后台刷新
+                self._refresh()
+            return self._token
+        return await asyncio.shield(self._refresh())
+
+    def invalidate(self, token: Optional[str] = None) -> None:
+        """丢弃缓存的token（token 不为空时仅当它仍是当前token才丢弃）"""
+        if token is None or token == self._token:
+            self._token = None
+            self._expires_at = 0.0
+
+    def _refresh(self) -> asyncio.Task:
+        """启动一次刷新；已有刷新在进行时复用同一个任务"""
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._fetch())
+            self._inflight.add_done_callback(self._refresh_done)
+        return self._inflight
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._inflight = None
+        if not task.cancelled():
+            # 没有等待者时（后台触发的刷新），避免未读取异常的告警
+            task.exception()
+
+    async def _fetch(self) -> str:
+        app_id = os.getenv("FEISHU_APP_ID")
+        app_secret = os.getenv("FEISHU_APP_SECRET")
+        if not app_id or not app_secret:
+            raise AppTokenError("飞书应用配置缺失")
+
+        response = await feishu_request(
+            get_feishu_client(), "POST", APP_ACCESS_TOKEN_URL,
+            json={
+                "app_id": app_id,
+                "app_secret": app_secret
+            }
+        )
+        data = response.json()
+        if data.get("code") != 0 or not data.get("app_access_token"):
+            raise AppTokenError(data.get("msg") or "飞书未返回app_access_token")
+
+        self._token = data["app_access_token"]
+        self._expires_at = time.monotonic() + int(data.get("expire", 7200))
+        print(f"app_access_token refreshed, expires in {data.get('expire', 7200)}s")
+        return self._token
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.shield(self._refresh())
+                # 飞书在剩余有效期不足30分钟时才会签发新token，这里保证不会频繁空转
+                delay = max(self._remaining() - self.refresh_margin, _MIN_REFRESH_INTERVAL)
+            except Exception as e:
+                # 任何失败（含飞书返回非JSON的错误页）都只是稍后重试，后台刷新只在取消时退出
+                print(f"⚠️ Warning: app_access_token refresh failed: {e!r}")
+                delay = _RETRY_INTERVAL
+            await asyncio.sleep(delay)
+
+    def start(self) -> None:
+        """应用启动时预取token并开始后台刷新"""
+        if not os.getenv("FEISHU_APP_ID") or not os.getenv("FEISHU_APP_SECRET"):
+            print("⚠️ Warning: Feishu app credentials missing, app_access_token background refresh disabled")
+            return
+        if self._background is None or self._background.done():
+            self._background = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        """应用关闭时停止后台刷新"""
+        tasks = [task for task in (self._background, self._inflight) if task is not None and not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._background = None
+
+
+app_token_manager = AppTokenManager(config.FEISHU_APP_TOKEN_REFRESH_MARGIN)
+
+
+async def get_app_access_token() -> str:
+    """供其他模块调用应用级飞书接口时使用"""
+    return await app_token_manager.get()
@@ -0,0 +1,102 @@
+"""
+文章局部精修
+
+只把需要修改的章节（按标题或字符范围定位）发给模型，其余部分只提供提纲作为上下文，
+模型返回修改后的章节后再拼回全文。prompt 大小和耗时只与修改范围相关，与全文长度无关。
+"""
+import re
+from typing import List, Optional, Tuple
+
+_HEADING = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t]*#*[ \t]*$")
+_FENCE = re.compile(r"^[ \t]*(```|~~~)")
+_IMAGE_REF = re.compile(r"!\[[^\]]*\]\((image_\d+)\)")
+# 模型有时把输出整体包在 ```markdown 代码块里
+_WRAPPED = re.compile(r"\A\s*```(?:markdown|md)?[ \t]*\n(.*)\n```\s*\Z", re.S)
+
+
+def parse_headings(text: str) -> List[Tuple[int, int, str]]:
+    """返回 [(行首偏移, 标题级别, 标题文字)]，忽略代码块中的 # 行"""
+    headings = []
+    in_fence = False
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        if _FENCE.match(line):
+            in_fence = not in_fence
+        elif not in_fence:
+            match = _HEADING.match(line.rstrip("\r\n"))
+            if match:
+                headings.append((offset, len(match.group(1)), match.group(2)))
+        offset += len(line)
+    return headings
+
+
+def find_section(text: str, heading: str) -> Optional[Tuple[int, int]]:
+    """
+    按标题定位章节，返回 [start, end) 偏移；章节到下一个同级或更高级标题为止
+
+    先按标题文字精确匹配，找不到时按包含关系匹配第一个。
+    """
+    wanted = heading.strip().lstrip("#").strip()
+    headings = parse_headings(text)
+    index = next((i for i, (_, _, title) in enumerate(headings) if title == wanted), None)
+    if index is None:
+        index = next((i for i, (_, _, title) in enumerate(headings) if wanted and wanted in title), None)
+    if index is None:
+        return None
+    start, level, _ = headings[index]
+    end = next((offset for offset, lvl, _ in headings[index + 1:] if lvl <= level), len(text))
+    return start, end
+
+
+def snap_range(text: str, start: int, end: int) -> Tuple[int, int]:
+    """把字符范围扩展到整行，避免从一个词或Markdown标记中间截断"""
+    start = max(0, min(start, len(text)))
+    end = max(0, min(end, len(text)))
+    if end <= start:
+        raise ValueError("empty range")
+    start = text.rfind("\n", 0, start) + 1
+    if text[end - 1] != "\n":
+        newline = text.find("\n", end)
+        end = len(text) if newline == -1 else newline + 1
+    return start, end
+
+
+def build_outline(text: str, start: int, end: int, context_chars: int = 200) -> str:
+    """
+    生成其余部分的简要上下文：全文标题提纲（标出待修改部分的位置），以及紧邻章节前后的少量原文
+    """
+    lines = []
+    marked = False
+    for offset, level, title in parse_headings(text):
+        if not marked and offset >= start:
+            lines.append("  " * (level - 1) + "- 【待修改部分】")
+            marked = True
+        if start <= offset < end:
+            continue
+        lines.append("  " * (level - 1) + f"- {title}")
+    if not marked:
+        lines.append("- 【待修改部分】")
+
+    parts = ["\n".join(lines)]
+    before = text[max(0, start - context_chars):start].strip()
+    after = text[end:end + context_chars].strip()
+    if before:
+        parts.append(f"紧邻的前文：\n…{before}")
+    if after:
+        parts.append(f"紧邻的后文：\n{after}…")
+    return "\n\n".join(parts)
+
+
+def referenced_images(section: str) -> List[str]:
+    """章节中引用的图片编号（按首次出现顺序去重），如 ["image_2", "image_5"]"""
+    return list(dict.fromkeys(_IMAGE_REF.findall(section)))
+
+
+def splice_section(text: str, start: int, end: int, replacement: str) -> str:
+    """用修改后的章节替换 [start, end)，保持原章节末尾的换行"""
+    match = _WRAPPED.match(replacement)
+    if match:
+        replacement = match.group(1)
+    original = text[start:end]
+    trailing = original[len(original.rstrip("\n")):]
+    return text[:start] + replacement.strip("\n") + trailing + text[end:]
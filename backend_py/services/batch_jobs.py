@@ -0,0 +1,422 @@
+"""
+后台批量生成任务
+
+一个任务包含多篇文档，每篇文档依次执行：获取内容 → 下载图片 → AI生成 →（可选）写回飞书。
+- 任务提交后立即返回任务ID，由后台协程按有界并发处理
+- 任务状态保存在 BATCH_JOB_DIR 下的SQLite数据库（WAL模式）中，同机的多个worker共享，
+  任意worker都能查询进度、订阅进度事件和取消任务
+- 执行任务的worker持有租约并定期续期，同一任务同时只由一个worker执行；
+  其他worker上发起的取消通过数据库中的取消标记通知执行者
+- 每篇文档完成后更新任务状态，中断后已完成的文档不会重复处理
+
+用户的access_token只保存在执行任务的进程内存中，不写入磁盘。进程重启或租约过期后，
+未完成的任务显示为 paused，由任务所有者带上新的token调用恢复接口继续执行。
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import sqlite3
+import threading
+from typing import Optional, List, Dict, Any, Callable, Awaitable
+
+import config
+
+# 单篇文档处理函数：(任务, 文档项) -> 结果字段
+ItemProcessor = Callable[["BatchJob", Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+FINISHED_STATES = ("completed", "failed", "cancelled")
+
+# 订阅其他worker上执行的任务时，轮询数据库的间隔（秒）
+_POLL_INTERVAL = 1.0
+
+
+class BatchJob:
+    """批量任务状态"""
+
+    def __init__(self, job_id: str, token: Optional[str], instruction: str, doc_ids: List[str],
+                 write_back: bool, created_at: Optional[float] = None, owner: str = ""):
+        self.job_id = job_id
+        self.token = token  # 只在执行任务的进程内存中
+        self.owner = owner  # 提交任务的飞书用户 open_id
+        self.instruction = instruction
+        self.write_back = write_back
+        self.status = "pending"
+        self.created_at = created_at or time.time()
+        self.updated_at = self.created_at
+        self.items: List[Dict[str, Any]] = [
+            {"doc_id": doc_id, "status": "pending"} for doc_id in doc_ids
+        ]
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    def progress(self) -> Dict[str, Any]:
+        counts = {"pending": 0, "running": 0, "completed": 0, "failed": 0}
+        for item in self.items:
+            counts[item["status"]] = counts.get(item["status"], 0) + 1
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "version": self.version,
+            "total": len(self.items),
+            "counts": counts,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "items": self.items
+        }
+
+    def to_checkpoint(self) -> Dict[str, Any]:
+        """持久化的任务状态（不含token）"""
+        return {
+            "job_id": self.job_id,
+            "owner": self.owner,
+            "instruction": self.instruction,
+            "write_back": self.write_back,
+            "status": self.status,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "items": self.items
+        }
+
+    @classmethod
+    def from_checkpoint(cls, data: Dict[str, Any], version: int = 0) -> "BatchJob":
+        job = cls(data["job_id"], None, data["instruction"], [],
+                  data.get("write_back", False), data.get("created_at"), data.get("owner", ""))
+        job.status = data.get("status", "pending")
+        job.updated_at = data.get("updated_at", job.created_at)
+        job.items = data.get("items", [])
+        job.version = version
+        return job
+
+    def touch(self) -> None:
+        self.version += 1
+        self.updated_at = time.time()
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_changed(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class JobStore:
+    """
+    任务状态的SQLite存储，同机多进程共享
+
+    除任务状态外还记录执行租约（lease_owner / lease_expires）和取消标记。
+    所有方法都是同步的，由 BatchJobManager 放到线程池中调用。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._init_lock:
+            if not self._initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS jobs ("
+                    "job_id TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL, data TEXT NOT NULL, "
+                    "version INTEGER NOT NULL DEFAULT 0, lease_owner TEXT, lease_expires REAL NOT NULL DEFAULT 0, "
+                    "cancel_requested INTEGER NOT NULL DEFAULT 0)"
+                )
+                self._initialized = True
+        self._local.conn = conn
+        return conn
+
+    def insert(self, job: BatchJob, worker: str, lease_expires: float) -> None:
+        """保存新任务，提交任务的worker直接持有租约"""
+        self._conn().execute(
+            "INSERT INTO jobs (job_id, owner, status, data, version, lease_owner, lease_expires) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job.job_id, job.owner, job.status, json.dumps(job.to_checkpoint(), ensure_ascii=False),
+             job.version, worker, lease_expires)
+        )
+
+    def load(self, job_id: str) -> Optional[sqlite3.Row]:
+        return self._conn().execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+    def claim(self, job_id: str, worker: str, lease_expires: float, now: float) -> Optional[sqlite3.Row]:
+        """没有worker持有有效租约时取得租约，返回任务记录；租约被占用时返回 None"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET lease_owner = ?, lease_expires = ? "
+            "WHERE job_id = ? AND (lease_owner IS NULL OR lease_expires <= ?)",
+            (worker, lease_expires, job_id, now)
+        )
+        return self.load(job_id) if cursor.rowcount else None
+
+    def renew(self, job_id: str, worker: str, lease_expires: float) -> Optional[bool]:
+        """续期租约，返回是否有取消请求；租约已不属于本worker时返回 None"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND lease_owner = ?",
+            (lease_expires, job_id, worker)
+        )
+        if not cursor.rowcount:
+            return None
+        row = self._conn().execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def save(self, job: BatchJob, worker: str) -> bool:
+        """持有租约时保存任务状态"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = ?, data = ?, version = ? WHERE job_id = ? AND lease_owner = ?",
+            (job.status, json.dumps(job.to_checkpoint(), ensure_ascii=False), job.version, job.job_id, worker)
+        )
+        return cursor.rowcount > 0
+
+    def release(self, job_id: str, worker: str) -> None:
+        self._conn().execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = 0 WHERE job_id = ? AND lease_owner = ?",
+            (job_id, worker)
+        )
+
+    def request_cancel(self, job_id: str) -> None:
+        self._conn().execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,))
+
+    def count_unfinished(self, now: float) -> int:
+        """没有worker在执行的未完成任务数"""
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running') "
+            "AND (lease_owner IS NULL OR lease_expires <= ?)",
+            (now,)
+        ).fetchone()[0]
+
+
+class BatchJobManager:
+    """批量任务管理：提交、执行、租约、取消和恢复"""
+
+    def __init__(self, checkpoint_dir: str, concurrency: int, lease: float):
+        self.checkpoint_dir = checkpoint_dir
+        self.concurrency = concurrency
+        self.lease = lease
+        self.store = JobStore(os.path.join(checkpoint_dir, "jobs.db"))
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.jobs: Dict[str, BatchJob] = {}  # 本worker正在执行的任务
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._processor: Optional[ItemProcessor] = None
+
+    def set_processor(self, processor: ItemProcessor) -> None:
+        self._processor = processor
+
+    async def _save(self, job: BatchJob) -> None:
+        if not await asyncio.to_thread(self.store.save, job, self.worker_id):
+            print(f"⚠️ Warning: batch job {job.job_id}: lease lost, progress not saved")
+
+    async def _update(self, job: BatchJob) -> None:
+        job.touch()
+        await self._save(job)
+
+    def _from_row(self, row: sqlite3.Row) -> BatchJob:
+        job = BatchJob.from_checkpoint(json.loads(row["data"]), version=row["version"])
+        if job.status not in FINISHED_STATES and (row["lease_owner"] is None or row["lease_expires"] <= time.time()):
+            # 没有worker在执行：等待所有者恢复
+            job.status = "paused"
+        return job
+
+    async def submit(self, token: str, owner: str, instruction: str, doc_ids: List[str],
+                     write_back: bool) -> BatchJob:
+        job = BatchJob(uuid.uuid4().hex, token, instruction, doc_ids, write_back, owner=owner)
+        await asyncio.to_thread(self.store.insert, job, self.worker_id, time.time() + self.lease)
+        self._start(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[BatchJob]:
+        """本worker执行中的任务直接返回；否则从共享存储读取当前状态的快照"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        row = await asyncio.to_thread(self.store.load, job_id)
+        return self._from_row(row) if row is not None else None
+
+    async def wait_changed(self, job: BatchJob, timeout: float) -> BatchJob:
+        """等待任务状态变化（或超时），返回最新状态"""
+        local = self.jobs.get(job.job_id)
+        if local is not None:
+            await local.wait_changed(timeout)
+            return local
+        deadline = time.monotonic() + timeout
+        while True:
+            await asyncio.sleep(min(_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+            latest = await self.get(job.job_id)
+            if latest is None:
+                return job
+            if latest.version != job.version or latest.status != job.status or time.monotonic() >= deadline:
+                return latest
+
+    async def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            task = self._tasks.get(job_id)
+            if job.status not in FINISHED_STATES and task is not None and not task.done():
+                job.status = "cancelled"
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                if self.jobs.get(job_id) is job:
+                    # 任务协程还没开始运行就被取消，没有执行到清理代码
+                    await self._update(job)
+                    await self._finish(job)
+            return True
+
+        row = await asyncio.to_thread(self.store.load, job_id)
+        if row is None:
+            return False
+        # 执行者在下次续期时看到取消标记后停止；没有执行者时直接更新状态
+        await asyncio.to_thread(self.store.request_cancel, job_id)
+        now = time.time()
+        row = await asyncio.to_thread(self.store.claim, job_id, self.worker_id, now + self.lease, now)
+        if row is not None:
+            job = BatchJob.from_checkpoint(json.loads(row["data"]), version=row["version"])
+            try:
+                if job.status not in FINISHED_STATES:
+                    job.status = "cancelled"
+                    await self._update(job)
+            finally:
+                await asyncio.to_thread(self.store.release, job_id, self.worker_id)
+        return True
+
+    async def resume(self, job_id: str, token: str) -> Optional[BatchJob]:
+        """
+        用新的token继续执行已暂停的任务
+
+        任务正由本worker执行时只更新token；由其他worker执行时（租约有效）返回 None。
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job.token = token
+            return job
+        now = time.time()
+        row = await asyncio.to_thread(self.store.claim, job_id, self.worker_id, now + self.lease, now)
+        if row is None:
+            return None
+        job = BatchJob.from_checkpoint(json.loads(row["data"]), version=row["version"])
+        if job.status in FINISHED_STATES or row["cancel_requested"]:
+            # 已结束，或执行者停止前已被请求取消
+            if job.status not in FINISHED_STATES:
+                job.status = "cancelled"
+                await self._update(job)
+            await asyncio.to_thread(self.store.release, job_id, self.worker_id)
+            return job
+        job.token = token
+        for item in job.items:
+            # 中断时正在处理的文档重新处理
+            if item["status"] == "running":
+                item["status"] = "pending"
+        print(f"Resuming batch job {job_id}")
+        self._start(job)
+        return job
+
+    def _start(self, job: BatchJob) -> None:
+        self.jobs[job.job_id] = job
+        self._tasks[job.job_id] = asyncio.create_task(self._run(job))
+
+    async def _heartbeat(self, job: BatchJob, runner: asyncio.Task) -> None:
+        """定期续期租约；租约丢失或收到其他worker的取消请求时停止执行"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            cancel_requested = await asyncio.to_thread(
+                self.store.renew, job.job_id, self.worker_id, time.time() + self.lease
+            )
+            if cancel_requested is None:
+                print(f"⚠️ Warning: batch job {job.job_id}: lease lost, stopping")
+                runner.cancel()
+                return
+            if cancel_requested:
+                print(f"Batch job {job.job_id} cancelled")
+                job.status = "cancelled"
+                runner.cancel()
+                return
+
+    async def _finish(self, job: BatchJob) -> None:
+        """交出租约，不再由本worker执行"""
+        await asyncio.to_thread(self.store.release, job.job_id, self.worker_id)
+        if self.jobs.get(job.job_id) is job:
+            del self.jobs[job.job_id]
+            self._tasks.pop(job.job_id, None)
+
+    async def _run(self, job: BatchJob) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job, asyncio.current_task()))
+        try:
+            if self._processor is None:
+                raise RuntimeError("Batch job processor is not configured")
+            job.status = "running"
+            await self._update(job)
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def run_item(item: Dict[str, Any]) -> None:
+                async with semaphore:
+                    item["status"] = "running"
+                    item.pop("error", None)
+                    await self._update(job)
+                    try:
+                        result = await self._processor(job, item)
+                        item.update(result)
+                        item["status"] = "completed"
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        print(f"Batch job {job.job_id}: doc {item['doc_id']} failed: {e}")
+                        item["status"] = "failed"
+                        item["error"] = str(e)
+                    await self._update(job)
+
+            pending = [item for item in job.items if item["status"] == "pending"]
+            print(f"Batch job {job.job_id}: processing {len(pending)}/{len(job.items)} documents")
+            await asyncio.gather(*[run_item(item) for item in pending])
+
+            failed = sum(1 for item in job.items if item["status"] == "failed")
+            job.status = "failed" if failed == len(job.items) and job.items else "completed"
+            await self._update(job)
+            print(f"Batch job {job.job_id} finished: {job.status} ({failed} failed)")
+        except asyncio.CancelledError:
+            # 取消、关闭或失去租约：正在处理的文档退回 pending，保存后交出租约
+            for item in job.items:
+                if item["status"] == "running":
+                    item["status"] = "pending"
+            await self._update(job)
+            raise
+        finally:
+            heartbeat.cancel()
+            await self._finish(job)
+
+    async def load_checkpoints(self) -> None:
+        """
+        启动时检查任务存储
+
+        旧版本的JSON检查点中保存了明文token，直接删除；未完成的任务需要所有者恢复。
+        """
+        if os.path.isdir(self.checkpoint_dir):
+            for name in os.listdir(self.checkpoint_dir):
+                if name.endswith(".json") or name.endswith(".json.tmp"):
+                    print(f"Removing legacy batch job checkpoint {name} (contains access token)")
+                    try:
+                        os.remove(os.path.join(self.checkpoint_dir, name))
+                    except OSError:
+                        pass
+        paused = await asyncio.to_thread(self.store.count_unfinished, time.time())
+        if paused:
+            print(f"{paused} unfinished batch jobs are paused until their owners resume them")
+
+    async def shutdown(self) -> None:
+        """停止本worker执行的任务并交出租约；任务状态保留，所有者恢复后继续"""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+batch_jobs = BatchJobManager(config.BATCH_JOB_DIR, config.BATCH_JOB_CONCURRENCY, config.BATCH_JOB_LEASE)
@@ -0,0 +1,115 @@
+"""
+请求截止时间与取消
+
+一次HTTP请求的总时间预算（Deadline）从路由一路传给AI提供商调用：
+下载图片等前序步骤消耗的时间会从提供商可用的超时中扣除。
+超时或客户端断开时，真正取消正在进行的调用并释放上游连接。
+"""
+import math
+import time
+import asyncio
+from typing import Optional, Awaitable, TypeVar, Mapping
+
+T = TypeVar("T")
+
+# 客户端可通过该请求头声明本次请求的时间预算（秒）
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class ClientDisconnected(Exception):
+    """客户端在结果返回前断开连接"""
+
+
+class Deadline:
+    """单调时钟上的截止时间"""
+
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_headers(cls, headers: Mapping[str, str], default: float, maximum: Optional[float] = None) -> "Deadline":
+        """
+        从请求头读取预算，缺失或非法（非数字、nan、inf、负数）时使用默认值
+
+        maximum 为服务端允许的最大预算，客户端只能缩短、不能延长。
+        """
+        seconds = default
+        value = headers.get(DEADLINE_HEADER)
+        if value:
+            try:
+                requested = float(value)
+            except ValueError:
+                requested = None
+            if requested is not None and math.isfinite(requested) and requested >= 0:
+                seconds = requested
+            else:
+                print(f"Invalid {DEADLINE_HEADER} header: {value}")
+        if maximum is not None:
+            seconds = min(seconds, maximum)
+        return cls(max(seconds, 0.0))
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """下游调用可用的超时：剩余预算，可再受 cap 限制"""
+        remaining = self.remaining()
+        return min(remaining, cap) if cap is not None else remaining
+
+
+async def _wait_for_disconnect(request, poll_interval: float, stop: asyncio.Event) -> bool:
+    """
+    轮询客户端是否断开，断开时返回 True；stop 被设置后返回 False
+
+    不能只靠取消来结束轮询：Starlette 的 is_disconnected() 在 anyio CancelScope 中读取消息，
+    恰好在其中到达的取消会被吞掉，循环会继续下去。
+    """
+    while not stop.is_set():
+        if await request.is_disconnected():
+            return True
+        try:
+            await asyncio.wait_for(stop.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+    return False
+
+
+async def run_with_deadline(
+    awaitable: Awaitable[T],
+    deadline: Deadline,
+    request=None,
+    poll_interval: float = 0.5
+) -> T:
+    """
+    在截止时间内执行 awaitable，并在客户端断开时提前取消
+
+    超时抛出 TimeoutError，客户端断开抛出 ClientDisconnected；
+    两种情况下 awaitable 都会被取消（httpx 会随之关闭上游连接）。
+    """
+    task = asyncio.ensure_future(awaitable)
+    stop = asyncio.Event()
+    watcher = None
+    if request is not None:
+        watcher = asyncio.ensure_future(_wait_for_disconnect(request, poll_interval, stop))
+    waiting = {task} if watcher is None else {task, watcher}
+
+    try:
+        done, _ = await asyncio.wait(waiting, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+        if watcher is not None and watcher in done and watcher.result():
+            print("Client disconnected, cancelling AI call")
+            raise ClientDisconnected()
+        print(f"Request deadline exceeded ({deadline.budget}s), cancelling AI call")
+        raise TimeoutError(f"请求超时（{deadline.budget:g}秒）")
+    finally:
+        stop.set()
+        pending = [t for t in waiting if not t.done()]
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,83 @@
+"""
+文档内容缓存（按修订版本校验）
+
+飞书 docx/v1/documents/{id} 返回文档当前的 revision_id。缓存解析后的blocks，
+每次只需一次元数据请求：修订版本未变则直接使用缓存，变化时才重新拉取全部blocks。
+
+- 按用户隔离：键包含token摘要，不同用户之间不共享缓存
+- 内存有上限：按估算字节数做LRU淘汰
+"""
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+
+import config
+
+
+def user_key(token: str) -> str:
+    """token摘要，作为缓存的用户隔离键"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def make_etag(doc_id: str, revision_id: Any) -> str:
+    """文档内容只由 doc_id + revision_id 决定，可以用作强ETag"""
+    return f'"{doc_id}-{revision_id}"'
+
+
+class DocumentContentCache:
+    """按字节数限制的LRU缓存：(用户, doc_id) -> 某一修订版本的解析结果"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()  # (用户, doc_id) -> 条目
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str, doc_id: str, revision_id: Any) -> Optional[Dict[str, Any]]:
+        key = (user_key(token), doc_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["revision_id"] != revision_id:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, token: str, doc_id: str, revision_id: Any, title: str, blocks: list) -> None:
+        """blocks 为 dict 列表（ContentBlock.model_dump() 的结果），大小按JSON长度估算"""
+        key = (user_key(token), doc_id)
+        size = len(json.dumps(blocks, ensure_ascii=False).encode()) + len(title.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old["size"]
+            self._entries[key] = {
+                "revision_id": revision_id,
+                "title": title,
+                "blocks": blocks,
+                "size": size
+            }
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted["size"]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+document_cache = DocumentContentCache(config.DOCUMENT_CACHE_MAX_MB * 1024 * 1024)
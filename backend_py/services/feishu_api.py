@@ -0,0 +1,364 @@
+"""
+飞书开放平台（open.feishu.cn）调用的限流与重试
+
+- 令牌桶限流：整个应用一个总桶，另按接口各一个桶（飞书对不同接口有单独的QPS限制）
+- 触发频率限制（HTTP 429 或业务码 99991400）时按响应头给出的重置时间或指数退避+抖动重试，
+  同时暂停对应的桶，避免其他请求继续撞上限制
+- 全部为异步等待，不阻塞事件循环
+- 写入文档blocks：分批流水线发送，保持顺序，失败重试不会重复插入
+- 进程内共享一个连接池（可用时启用HTTP/2），由应用生命周期创建和关闭，各路由通过依赖注入获取
+"""
+import re
+import time
+import uuid
+import random
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Tuple, AsyncIterator
+
+import httpx
+
+import config
+
+# HTTP/2 依赖 h2 包，未安装时回退到 HTTP/1.1 长连接
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 飞书返回的频率限制业务码
+FREQUENCY_LIMIT_CODES = {99991400}
+
+# 按接口的QPS限制：(名称, 方法（None表示任意）, 路径正则, 每秒请求数)，按顺序匹配第一条
+_ENDPOINT_LIMITS: List[Tuple[str, Optional[str], "re.Pattern", float]] = [
+    ("docx.blocks.create", "POST", re.compile(r"/docx/v1/documents/[^/]+/blocks/[^/]+/(children|descendant)$"), 3),
+    ("docx.documents.create", "POST", re.compile(r"/docx/v1/documents$"), 3),
+    ("docx.read", None, re.compile(r"/docx/v1/documents/"), 5),
+    ("drive.medias.upload", "POST", re.compile(r"/drive/v1/medias/upload_all$"), 5),
+    ("drive.medias.download", "GET", re.compile(r"/drive/v1/medias/[^/]+/download$"), 5),
+    ("drive.medias.tmp_url", "GET", re.compile(r"/drive/v1/medias/batch_get_tmp_download_url$"), 5),
+    ("drive.files", None, re.compile(r"/drive/v1/files"), 5),
+]
+
+# 按接口的读超时（秒），其余接口使用 FEISHU_TIMEOUT
+_ENDPOINT_TIMEOUTS: List[Tuple[Optional[str], "re.Pattern", str]] = [
+    ("POST", re.compile(r"/drive/v1/medias/upload_all$"), "FEISHU_UPLOAD_TIMEOUT"),
+    ("GET", re.compile(r"/drive/v1/medias/[^/]+/download$"), "FEISHU_DOWNLOAD_TIMEOUT"),
+    ("POST", re.compile(r"/docx/v1/documents/[^/]+/blocks/[^/]+/(children|descendant)$"), "FEISHU_WRITE_TIMEOUT"),
+]
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_feishu_client() -> httpx.AsyncClient:
+    """
+    进程内共享的飞书API客户端（也用作FastAPI依赖）
+
+    正常由 start_client 在应用启动时创建；在生命周期之外（例如脚本）首次使用时按需创建。
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        http2 = config.FEISHU_HTTP2 and HTTP2_AVAILABLE
+        if config.FEISHU_HTTP2 and not HTTP2_AVAILABLE:
+            print("⚠️ Warning: h2 not installed, Feishu HTTP client falls back to HTTP/1.1")
+        _client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(config.FEISHU_TIMEOUT, connect=config.FEISHU_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=config.FEISHU_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.FEISHU_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=config.FEISHU_HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _client
+
+
+async def start_client() -> None:
+    """应用启动时创建连接池，并预先建立到 open.feishu.cn 的连接"""
+    client = get_feishu_client()
+    try:
+        await client.head("https://open.feishu.cn/", timeout=5)
+    except httpx.HTTPError as e:
+        print(f"Feishu connection warmup failed: {e}")
+
+
+async def close_client() -> None:
+    """应用关闭时释放连接池"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _timeout_for(method: str, url: str) -> Optional[httpx.Timeout]:
+    path = httpx.URL(url).path
+    for rule_method, pattern, setting in _ENDPOINT_TIMEOUTS:
+        if rule_method == method.upper() and pattern.search(path):
+            return httpx.Timeout(getattr(config, setting), connect=config.FEISHU_CONNECT_TIMEOUT)
+    return None
+
+
+class TokenBucket:
+    """异步令牌桶，等待者按先来后到获得令牌"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """被限流后暂停发放令牌一段时间"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class FeishuRateLimiter:
+    """应用级总桶 + 按接口的桶"""
+
+    def __init__(self, app_qps: float):
+        self.app_bucket = TokenBucket(app_qps)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0}
+
+    def _endpoint_bucket(self, method: str, url: str) -> Optional[TokenBucket]:
+        path = httpx.URL(url).path
+        for name, rule_method, pattern, qps in _ENDPOINT_LIMITS:
+            if rule_method and rule_method != method.upper():
+                continue
+            if pattern.search(path):
+                bucket = self._buckets.get(name)
+                if bucket is None:
+                    bucket = self._buckets[name] = TokenBucket(qps)
+                return bucket
+        return None
+
+    async def acquire(self, method: str, url: str) -> Optional[TokenBucket]:
+        """获取发送一次请求的许可，返回对应的接口桶（供限流时暂停）"""
+        bucket = self._endpoint_bucket(method, url)
+        if bucket is not None:
+            await bucket.acquire()
+        await self.app_bucket.acquire()
+        self.stats["requests"] += 1
+        return bucket
+
+    def throttled(self, bucket: Optional[TokenBucket], delay: float) -> None:
+        self.stats["throttled"] += 1
+        (bucket or self.app_bucket).pause(delay)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.stats, endpoints=sorted(self._buckets))
+
+
+feishu_limiter = FeishuRateLimiter(config.FEISHU_APP_QPS)
+
+
+def _backoff(attempt: int) -> float:
+    """指数退避 + 抖动"""
+    delay = min(config.FEISHU_RETRY_MAX_DELAY, config.FEISHU_RETRY_BASE_DELAY * (2 ** attempt))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def _rate_limit_delay(response: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    判断响应是否为频率限制，是则返回建议的等待秒数
+
+    飞书在 x-ogw-ratelimit-reset 头中给出限制重置的秒数。
+    """
+    limited = response.status_code == 429
+    if not limited and "application/json" in response.headers.get("content-type", ""):
+        try:
+            limited = response.json().get("code") in FREQUENCY_LIMIT_CODES
+        except ValueError:
+            limited = False
+    if not limited:
+        return None
+    reset = response.headers.get("x-ogw-ratelimit-reset") or response.headers.get("retry-after")
+    try:
+        return float(reset) + random.uniform(0, 0.5)
+    except (TypeError, ValueError):
+        return _backoff(attempt)
+
+
+async def feishu_request(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    经过限流发送飞书API请求，频率限制时自动重试
+
+    重试会重新发送请求体：上传文件时请传 bytes 而不是文件对象。
+    """
+    if "timeout" not in kwargs:
+        timeout = _timeout_for(method, url)
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+    attempt = 0
+    while True:
+        bucket = await feishu_limiter.acquire(method, url)
+        response = await client.request(method, url, **kwargs)
+        delay = _rate_limit_delay(response, attempt)
+        if delay is None or attempt >= config.FEISHU_MAX_RETRIES:
+            return response
+        feishu_limiter.throttled(bucket, delay)
+        feishu_limiter.stats["retries"] += 1
+        # 桶已暂停，下一次 acquire 会等到限制解除
+        print(f"Feishu rate limited: {method} {httpx.URL(url).path}, retry in {delay:.2f}s")
+        attempt += 1
+
+
+@asynccontextmanager
+async def feishu_stream(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+    """流式版本的 feishu_request（用于下载），只按HTTP 429判断频率限制"""
+    if "timeout" not in kwargs:
+        timeout = _timeout_for(method, url)
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+    attempt = 0
+    while True:
+        bucket = await feishu_limiter.acquire(method, url)
+        async with client.stream(method, url, **kwargs) as response:
+            if response.status_code != 429 or attempt >= config.FEISHU_MAX_RETRIES:
+                yield response
+                return
+            delay = _rate_limit_delay(response, attempt)
+        feishu_limiter.throttled(bucket, delay)
+        feishu_limiter.stats["retries"] += 1
+        # 桶已暂停，下一次 acquire 会等到限制解除
+        print(f"Feishu rate limited: {method} {httpx.URL(url).path}, retry in {delay:.2f}s")
+        attempt += 1
+
+
+def _split_batches(blocks: List[Dict[str, Any]], batch_size: int) -> List[List[Dict[str, Any]]]:
+    """按顺序分批：普通块每批最多 batch_size 个，带 descendants 的块单独一批"""
+    batches: List[List[Dict[str, Any]]] = []
+    for block in blocks:
+        nested = "descendants" in block
+        if batches and not nested and "descendants" not in batches[-1][0] and len(batches[-1]) < batch_size:
+            batches[-1].append(block)
+        else:
+            batches.append([block])
+    return batches
+
+
+class FeishuWriteError(Exception):
+    """写入文档blocks失败（written 为已成功写入的块数）"""
+
+    def __init__(self, message: str, written: int):
+        super().__init__(message)
+        self.written = written
+
+
+async def child_count(client: httpx.AsyncClient, token: str, doc_id: str, block_id: str) -> int:
+    """块当前的子块数量"""
+    response = await feishu_request(
+        client, "GET", f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks/{block_id}",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    data = response.json()
+    if data.get("code") != 0:
+        raise FeishuWriteError(f"获取父块失败: {data.get('msg')}", 0)
+    return len(data.get("data", {}).get("block", {}).get("children") or [])
+
+
+async def create_children(
+    client: httpx.AsyncClient,
+    token: str,
+    doc_id: str,
+    parent_block_id: str,
+    blocks: List[Dict[str, Any]],
+    batch_size: int = 50,
+    window: Optional[int] = None,
+    start_index: Optional[int] = None
+) -> int:
+    """
+    按顺序把 blocks 分批写入 parent_block_id 的子块末尾，返回写入的块数
+
+    - start_index 为第一个块的位置，默认查询父块当前的子块数量（即追加到末尾）；
+      写入期间不应有其他写入方修改同一父块的子块
+    - 每批带显式的 index（start_index 加之前各批的块数之和），服务端先处理了后一批也不会打乱顺序：
+      前一批尚未落地时 index 越界，该批等待前一批完成后重试
+    - 每批有固定的 client_token，超时或失败后重试由服务端去重，不会重复插入
+    - 同时最多 window 批在途；第 k 批在第 k-window 批成功后才发出
+    - 带 descendants 的块（表格）单独成批，通过“创建嵌套块”接口写入
+    """
+    window = max(1, window or config.FEISHU_WRITE_WINDOW)
+    batches = _split_batches(blocks, batch_size)
+    if not batches:
+        return 0
+    base_url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_id}/blocks/{parent_block_id}"
+    if start_index is None:
+        start_index = await child_count(client, token, doc_id, parent_block_id)
+    offsets = list(itertools.accumulate([start_index] + [len(batch) for batch in batches]))
+    done = [asyncio.Event() for _ in batches]
+
+    async def send(k: int) -> None:
+        params = {"document_revision_id": -1, "client_token": str(uuid.uuid4())}
+        if "descendants" in batches[k][0]:
+            nested = batches[k][0]
+            top = {key: value for key, value in nested.items() if key != "descendants"}
+            url = f"{base_url}/descendant"
+            payload = {
+                "children_id": [nested["block_id"]],
+                "descendants": [top] + nested["descendants"],
+                "index": offsets[k]
+            }
+        else:
+            url = f"{base_url}/children"
+            payload = {"children": batches[k], "index": offsets[k]}
+        failures = 0
+        while True:
+            try:
+                response = await feishu_request(
+                    client, "POST", url,
+                    headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+                    params=params,
+                    json=payload
+                )
+                data = response.json()
+            except (httpx.HTTPError, ValueError) as e:
+                data = {"code": -1, "msg": str(e)}
+            if data.get("code") == 0:
+                print(f"Batch {k + 1}/{len(batches)} created: {len(batches[k])} blocks")
+                done[k].set()
+                return
+            print(f"Batch {k + 1}/{len(batches)} failed: code={data.get('code')} msg={data.get('msg')!r}")
+            if k > 0 and not done[k - 1].is_set():
+                # 前一批还没写入，等它完成后用同一 client_token 重试（不计入重试次数）
+                await done[k - 1].wait()
+                continue
+            failures += 1
+            if failures > config.FEISHU_WRITE_RETRIES:
+                break
+            await asyncio.sleep(_backoff(failures - 1))
+        raise FeishuWriteError(f"第{k + 1}批blocks写入失败: {data.get('msg')}", 0)
+
+    tasks: List[asyncio.Task] = []
+    try:
+        for k in range(len(batches)):
+            if k >= window:
+                await tasks[k - window]
+            tasks.append(asyncio.create_task(send(k)))
+        await asyncio.gather(*tasks)
+    except BaseException as e:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(e, FeishuWriteError):
+            e.written = sum(len(batch) for batch, event in zip(batches, done) if event.is_set())
+        raise
+    return len(blocks)
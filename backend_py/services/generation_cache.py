@@ -0,0 +1,167 @@
+"""
+AI生成结果缓存
+
+按 提供商 + 模型 + prompt + 每张图片的SHA-256 做内容寻址：
+- 内存LRU层：进程内最近使用的结果
+- 磁盘层（可选，SQLite）：带TTL和总大小上限，重启后仍可命中
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any
+
+import config
+
+
+def image_digest(image: Dict[str, Any]) -> str:
+    """图片内容的SHA-256（已有摘要时直接复用）"""
+    if image.get("sha256"):
+        return image["sha256"]
+    return hashlib.sha256(image["data"].encode()).hexdigest()
+
+
+def make_key(provider: Any, prompt: str, images: Optional[List[Dict[str, Any]]] = None) -> str:
+    """生成缓存键"""
+    model = getattr(provider, "model_name", None) or getattr(provider, "model", "")
+    material = json.dumps({
+        "provider": type(provider).__name__,
+        "model": str(model),
+        "prompt": prompt,
+        "images": [image_digest(img) for img in images or []],
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class GenerationCache:
+    """两级生成结果缓存（内存LRU + 可选SQLite磁盘）"""
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        disk_path: Optional[str] = None,
+        ttl: float = 86400,
+        max_disk_bytes: int = 200 * 1024 * 1024
+    ):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.ttl = ttl
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS idx_generations_accessed ON generations(accessed_at)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM generations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if now - created_at <= self.ttl:
+                        self._db.execute("UPDATE generations SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._db.commit()
+                        self._remember(key, value, created_at)
+                        self.stats["disk_hits"] += 1
+                        return value
+                    self._db.execute("DELETE FROM generations WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self.stats["stores"] += 1
+
+            if self._db is not None:
+                size = len(value.encode())
+                self._db.execute(
+                    "INSERT OR REPLACE INTO generations (key, value, size, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now)
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    async def aget(self, key: str) -> Optional[str]:
+        """异步读取（磁盘层在线程中执行）"""
+        if self._db is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: str) -> None:
+        """异步写入（磁盘层在线程中执行）"""
+        if self._db is None:
+            self.set(key, value)
+            return
+        await asyncio.to_thread(self.set, key, value)
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _evict_disk(self, now: float) -> None:
+        """删除过期条目，并按最近访问时间淘汰到总大小以内"""
+        self._db.execute("DELETE FROM generations WHERE created_at < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM generations").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM generations ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            self._db.execute("DELETE FROM generations WHERE key = ?", (key,))
+            total -= size
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """命中统计"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["disk_enabled"] = self._db is not None
+        return stats
+
+
+generation_cache = GenerationCache(
+    max_entries=config.GENERATION_CACHE_SIZE,
+    disk_path=config.GENERATION_CACHE_DISK_PATH or None,
+    ttl=config.GENERATION_CACHE_TTL,
+    max_disk_bytes=config.GENERATION_CACHE_MAX_DISK_MB * 1024 * 1024
+)
+
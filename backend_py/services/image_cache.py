@@ -0,0 +1,276 @@
+"""
+图片代理磁盘缓存
+
+飞书的 image_token 一经生成内容就不会再变，可以长期缓存：
+- 内容寻址：图片文件按内容SHA-256存放，同一图片只存一份；键（image_token）到摘要的映射单独记录
+- 按总字节数做LRU淘汰
+- 同一个键的并发请求合并为一次上游下载
+- 响应直接从磁盘分块读取，不把整张图片读进内存
+"""
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple, Callable, Awaitable, AsyncIterator
+
+import aiofiles
+
+import config
+from services.image_pipeline import sniff_mime
+
+# 下载函数：把图片写入传入的文件对象，返回上游声明的 content-type
+Fetcher = Callable[[Any], Awaitable[str]]
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _key_digest(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单段 Range 请求头，返回闭区间 (start, end)
+
+    无 Range 头或格式不支持时返回 None（按完整内容响应）；范围无法满足时抛出 ValueError。
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, sep, end_text = header[len("bytes="):].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            # bytes=-500：最后500字节
+            suffix = int(end_text)
+            start, end = max(size - suffix, 0), size - 1
+            if suffix <= 0:
+                start = size
+    except ValueError:
+        # 格式错误的 Range 按规范忽略
+        return None
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+
+class _HashingWriter:
+    """写入临时文件的同时计算摘要、大小，并保留文件头用于识别格式"""
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    async def write(self, data: bytes) -> None:
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self._hash.update(data)
+        self.size += len(data)
+        await self._f.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class ImageCache:
+    """内容寻址的图片磁盘缓存（按字节数LRU）"""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._refs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # 键 -> 条目
+        self._blob_refs: Dict[str, int] = {}  # 内容摘要 -> 引用该文件的键数量
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._loaded = False
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, "blobs", sha256[:2], sha256)
+
+    def _ref_path(self, key: str) -> str:
+        return os.path.join(self.directory, "refs", f"{_key_digest(key)}.json")
+
+    def _load(self) -> None:
+        """首次使用时从磁盘重建索引（按写入时间排列LRU顺序）"""
+        if self._loaded:
+            return
+        self._loaded = True
+        # 清理上次中断时遗留的临时文件
+        tmp_dir = os.path.join(self.directory, "tmp")
+        if os.path.isdir(tmp_dir):
+            for name in os.listdir(tmp_dir):
+                self._unlink(os.path.join(tmp_dir, name))
+        refs_dir = os.path.join(self.directory, "refs")
+        if not os.path.isdir(refs_dir):
+            return
+        records = []
+        for name in os.listdir(refs_dir):
+            path = os.path.join(refs_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+                if os.path.getsize(self._blob_path(entry["sha256"])) != entry["size"]:
+                    raise ValueError("blob size mismatch")
+                entry["path"] = self._blob_path(entry["sha256"])
+                records.append((os.path.getmtime(path), entry))
+            except (OSError, ValueError, KeyError):
+                # 残缺的记录直接丢弃
+                self._unlink(path)
+        for _, entry in sorted(records, key=lambda record: record[0]):
+            self._index(entry)
+        self._evict()
+        print(f"Image cache loaded: {len(self._refs)} entries, {self.total_bytes} bytes")
+
+    def _index(self, entry: Dict[str, Any]) -> None:
+        old = self._refs.pop(entry["key"], None)
+        if old is not None:
+            self._drop_blob_ref(old["sha256"], old["size"])
+        self._refs[entry["key"]] = entry
+        count = self._blob_refs.get(entry["sha256"], 0)
+        if count == 0:
+            self.total_bytes += entry["size"]
+        self._blob_refs[entry["sha256"]] = count + 1
+
+    def _drop_blob_ref(self, sha256: str, size: int) -> None:
+        count = self._blob_refs.get(sha256, 0) - 1
+        if count > 0:
+            self._blob_refs[sha256] = count
+            return
+        self._blob_refs.pop(sha256, None)
+        self.total_bytes -= size
+        self._unlink(self._blob_path(sha256))
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """淘汰最久未使用的条目，直到总大小不超过上限（keep 为刚写入的键，不淘汰）"""
+        for key in list(self._refs):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = self._refs.pop(key)
+            self._unlink(self._ref_path(key))
+            self._drop_blob_ref(entry["sha256"], entry["size"])
+            self.stats["evictions"] += 1
+
+    @staticmethod
+    def _unlink(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            # 文件不存在，或在Windows上仍被正在进行的响应占用
+            pass
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """查找缓存条目（不触发下载）"""
+        self._load()
+        entry = self._refs.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(entry["path"]):
+            # 文件被外部删除
+            del self._refs[key]
+            self._drop_blob_ref(entry["sha256"], entry["size"])
+            return None
+        self._refs.move_to_end(key)
+        return entry
+
+    async def get_or_fetch(self, key: str, fetch: Fetcher) -> Dict[str, Any]:
+        """
+        返回缓存条目 {"key", "sha256", "mime_type", "size", "path"}，未命中时调用 fetch 下载
+
+        下载在独立任务中进行：发起请求的客户端断开不会中断其他等待者共享的下载。
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["misses"] += 1
+            task = asyncio.create_task(self._download(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._download_done(key, t))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _download_done(self, key: str, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # 所有等待者都已离开时，避免未读取异常的告警
+            task.exception()
+
+    async def _download(self, key: str, fetch: Fetcher) -> Dict[str, Any]:
+        tmp_dir = os.path.join(self.directory, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                writer = _HashingWriter(f)
+                declared_type = await fetch(writer)
+            sha256 = writer.hexdigest()
+            mime_type = sniff_mime(writer.head)
+            if mime_type == "application/octet-stream" and declared_type:
+                mime_type = declared_type
+            return self._commit(key, tmp_path, sha256, writer.size, mime_type)
+        finally:
+            self._unlink(tmp_path)
+
+    def _commit(self, key: str, tmp_path: str, sha256: str, size: int, mime_type: str) -> Dict[str, Any]:
+        """把临时文件移入内容寻址目录并记录映射"""
+        blob_path = self._blob_path(sha256)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+
+        entry = {"key": key, "sha256": sha256, "mime_type": mime_type, "size": size, "path": blob_path}
+        ref_path = self._ref_path(key)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        with open(f"{ref_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(f"{ref_path}.tmp", ref_path)
+
+        self._index(entry)
+        self._evict(keep=key)
+        return entry
+
+    async def read(self, entry: Dict[str, Any]) -> bytes:
+        """读取完整图片数据"""
+        async with aiofiles.open(entry["path"], "rb") as f:
+            return await f.read()
+
+    async def iter_file(self, entry: Dict[str, Any], start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+        """按块读取文件的 [start, end] 区间"""
+        if end is None:
+            end = entry["size"] - 1
+        remaining = end - start + 1
+        async with aiofiles.open(entry["path"], "rb") as f:
+            await f.seek(start)
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._load()
+        return {
+            **self.stats,
+            "entries": len(self._refs),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight)
+        }
+
+
+image_cache = ImageCache(config.IMAGE_CACHE_DIR, config.IMAGE_CACHE_MAX_MB * 1024 * 1024)
@@ -0,0 +1,213 @@
+"""
+图片预处理（多模态调用前的压缩去重，以及前端预览用的缩略图）
+
+- 根据文件头识别真实格式（不再一律标记为 image/jpeg）
+- 按最长边缩放，并重新编码为 JPEG 或 WebP
+- 去除完全相同以及感知哈希（dHash）相近的重复图片
+- 为前端预览生成指定宽度的缩略图变体
+
+图片解码/编码是CPU密集操作，放在进程池中执行，避免阻塞事件循环。
+"""
+import io
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, List, Dict, Any, Tuple
+
+import config
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def sniff_mime(data: bytes) -> str:
+    """根据文件头判断图片类型"""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data.startswith(b"BM"):
+        return "image/bmp"
+    return "application/octet-stream"
+
+
+def _dhash(img, size: int = 8) -> int:
+    """64位差值哈希，用于识别近似重复图片"""
+    from PIL import Image
+
+    gray = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def _encode(img, fmt: str, quality: int) -> Tuple[bytes, str]:
+    """把图片编码为 JPEG 或 WebP，返回 (数据, mime_type)"""
+    from PIL import Image
+
+    if fmt == "webp":
+        mime_type = "image/webp"
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+        save_kwargs = {"format": "WEBP", "quality": quality, "method": 4}
+    else:
+        mime_type = "image/jpeg"
+        if img.mode != "RGB":
+            # JPEG不支持透明通道，铺白色背景
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            rgba = img.convert("RGBA")
+            background.paste(rgba, mask=rgba.getchannel("A"))
+            img = background
+        save_kwargs = {"format": "JPEG", "quality": quality, "optimize": True, "progressive": True}
+
+    out = io.BytesIO()
+    img.save(out, **save_kwargs)
+    return out.getvalue(), mime_type
+
+
+def _open(data: bytes):
+    from PIL import Image, ImageOps
+
+    img = Image.open(io.BytesIO(data))
+    img.seek(0)  # GIF等多帧图片只取第一帧
+    return ImageOps.exif_transpose(img)
+
+
+def process_image(data: bytes, max_edge: int, fmt: str, quality: int) -> Dict[str, Any]:
+    """
+    缩放并重新编码单张图片（在子进程中执行）
+
+    返回 {"data": bytes, "mime_type": str, "dhash": int | None}
+    """
+    from PIL import Image
+
+    original_mime = sniff_mime(data)
+    try:
+        img = _open(data)
+    except Exception as e:
+        print(f"图片解码失败，保留原图: {e}")
+        return {"data": data, "mime_type": original_mime, "dhash": None}
+
+    dhash = _dhash(img)
+
+    resized = max(img.size) > max_edge
+    if resized:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    encoded, mime_type = _encode(img, fmt, quality)
+
+    # 未缩放且重新编码后反而更大时，保留原图
+    if not resized and len(encoded) >= len(data) and original_mime in ("image/jpeg", "image/png", "image/webp"):
+        return {"data": data, "mime_type": original_mime, "dhash": dhash}
+
+    return {"data": encoded, "mime_type": mime_type, "dhash": dhash}
+
+
+def resize_image(data: bytes, width: int, fmt: str, quality: int) -> Dict[str, Any]:
+    """
+    生成指定宽度的缩略图（在子进程中执行），保持宽高比，不放大
+
+    返回 {"data": bytes, "mime_type": str}；无法解码时返回原图
+    """
+    from PIL import Image
+
+    try:
+        img = _open(data)
+    except Exception as e:
+        print(f"图片解码失败，返回原图: {e}")
+        return {"data": data, "mime_type": sniff_mime(data)}
+
+    if img.width > width:
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.LANCZOS)
+
+    encoded, mime_type = _encode(img, fmt, quality)
+    return {"data": encoded, "mime_type": mime_type}
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=config.IMAGE_WORKERS)
+    return _executor
+
+
+def shutdown_executor() -> None:
+    """应用关闭时释放进程池"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def preprocess_images(raw_images: List[bytes]) -> List[Dict[str, Any]]:
+    """
+    预处理一组原始图片，按原顺序返回去重后的结果
+
+    每项格式：{"mime_type": str, "content": bytes, "sha256": str}
+    """
+    if not raw_images:
+        return []
+
+    # 原始字节完全相同的图片无需重复处理
+    unique_raw = []
+    raw_digests = set()
+    for data in raw_images:
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in raw_digests:
+            raw_digests.add(digest)
+            unique_raw.append(data)
+
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    processed = await asyncio.gather(*[
+        loop.run_in_executor(
+            executor, process_image, data,
+            config.IMAGE_MAX_EDGE, config.IMAGE_FORMAT, config.IMAGE_QUALITY
+        )
+        for data in unique_raw
+    ])
+
+    results = []
+    seen_digests = set()
+    seen_hashes: List[int] = []
+    for idx, item in enumerate(processed, 1):
+        digest = hashlib.sha256(item["data"]).hexdigest()
+        if digest in seen_digests:
+            print(f"Image {idx} is an exact duplicate, skipped")
+            continue
+
+        dhash = item["dhash"]
+        if dhash is not None and config.IMAGE_DEDUP_DISTANCE >= 0:
+            if any(bin(dhash ^ other).count("1") <= config.IMAGE_DEDUP_DISTANCE for other in seen_hashes):
+                print(f"Image {idx} is a near duplicate, skipped")
+                continue
+            seen_hashes.append(dhash)
+
+        seen_digests.add(digest)
+        results.append({
+            "mime_type": item["mime_type"],
+            "content": item["data"],
+            "sha256": digest
+        })
+
+    total_in = sum(len(data) for data in raw_images)
+    total_out = sum(len(img["content"]) for img in results)
+    print(f"Image preprocessing: {len(raw_images)} -> {len(results)} images, {total_in} -> {total_out} bytes")
+    return results
+
+
+async def make_variant(data: bytes, width: int, fmt: str) -> Dict[str, Any]:
+    """在进程池中生成缩略图/缩放变体"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), resize_image, data, width, fmt, config.IMAGE_VARIANT_QUALITY
+    )
@@ -0,0 +1,56 @@
+"""
+AI输出中的图片标记修正
+
+模型有时不按 ![描述](image_N) 的格式输出图片标记，这里统一修正为标准格式。
+同时提供流式版本，可在模型逐段输出时增量修正。
+"""
+import re
+
+# (错误格式, 替换) 列表
+_FIXES = [
+    # 修正 image1.jpg -> image_1
+    (re.compile(r'!\[([^\]]*)\]\(image(\d+)\.(?:jpg|png|jpeg|gif)\)'), r'![\1](image_\2)'),
+    # 修正 img_1 -> image_1
+    (re.compile(r'!\[([^\]]*)\]\(img_(\d+)\)'), r'![\1](image_\2)'),
+    # 修正 picture1 -> image_1
+    (re.compile(r'!\[([^\]]*)\]\(picture(\d+)\)'), r'![\1](image_\2)'),
+]
+
+# 文本末尾可能尚未输出完整的图片标记，如 "![产品"、"![产品](img_"
+_PARTIAL_REF = re.compile(r'!(?:\[[^\]]*(?:\](?:\([^)]*)?)?)?\Z')
+
+# 未闭合的图片标记最多暂存的字符数，超过则视为普通文本直接输出
+_MAX_PENDING = 300
+
+
+def fix_image_refs(text: str) -> str:
+    """修正完整文本中的图片标记格式"""
+    for pattern, repl in _FIXES:
+        text = pattern.sub(repl, text)
+    return text
+
+
+class ImageRefStreamFixer:
+    """
+    流式图片标记修正器
+
+    feed() 接收模型输出的增量文本，返回可以安全下发的已修正文本；
+    可能属于未完成图片标记的尾部会暂存，直到标记闭合或 flush()。
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        buffer = self._pending + chunk
+        match = _PARTIAL_REF.search(buffer)
+        if match and len(buffer) - match.start() <= _MAX_PENDING:
+            self._pending = buffer[match.start():]
+            buffer = buffer[:match.start()]
+        else:
+            self._pending = ""
+        return fix_image_refs(buffer)
+
+    def flush(self) -> str:
+        buffer, self._pending = self._pending, ""
+        return fix_image_refs(buffer)
@@ -0,0 +1,137 @@
+"""
+会话图片的内容寻址存储
+
+预处理后的图片按内容SHA-256以原始字节存放在磁盘上，同一图片只存一份，
+多个会话（同一文档多次创作）共享；会话中只保存引用 {"mime_type", "sha256", "size"}。
+base64 只在发给AI提供商（或返回给前端）时才临时生成。
+
+存储目录可被同机的多个worker共享。文件的修改时间作为最近使用时间，
+超过 IMAGE_STORE_TTL 未被使用的图片会被清理（此时引用它的会话早已过期）。
+"""
+import os
+import time
+import uuid
+import base64
+import asyncio
+from typing import Dict, Any, List, Iterable, Optional
+
+import aiofiles
+
+import config
+
+# 两次清理之间的最短间隔（秒）
+_GC_INTERVAL = 600
+
+
+class ImageMissingError(Exception):
+    """会话引用的图片文件已被清理（按位置编号的 image_N 无法再对应上）"""
+
+
+class ImageStore:
+    """按SHA-256寻址的图片文件存储"""
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_gc = 0.0
+        self._gc_task: Optional[asyncio.Task] = None
+        self.stats = {"stores": 0, "dedup_hits": 0, "reads": 0, "missing": 0, "removed": 0}
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    async def put(self, data: bytes, mime_type: str, sha256: str) -> Dict[str, Any]:
+        """保存图片（内容已存在时只刷新使用时间），返回会话中保存的引用"""
+        path = self._path(sha256)
+        if os.path.exists(path):
+            self.stats["dedup_hits"] += 1
+            self._touch_path(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(data)
+            os.replace(tmp_path, path)
+            self.stats["stores"] += 1
+        self._maybe_gc()
+        return {"mime_type": mime_type, "sha256": sha256, "size": len(data)}
+
+    async def read(self, ref: Dict[str, Any]) -> bytes:
+        """读取引用对应的原始字节（旧会话中内联的base64数据直接解码）"""
+        if ref.get("data") is not None:
+            return base64.b64decode(ref["data"])
+        path = self._path(ref["sha256"])
+        async with aiofiles.open(path, "rb") as f:
+            data = await f.read()
+        self._touch_path(path)
+        self.stats["reads"] += 1
+        return data
+
+    async def to_parts(self, refs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        把引用转换为AI提供商使用的格式 [{"mime_type", "data": base64_str, "sha256"}]
+
+        文章中的 image_N 按位置对应图片，不能跳过缺失的图片；
+        任一图片文件已被清理时抛出 ImageMissingError。
+        """
+        parts = []
+        for index, ref in enumerate(refs):
+            try:
+                data = await self.read(ref)
+            except FileNotFoundError:
+                self.stats["missing"] += 1
+                print(f"⚠️ Warning: image {ref.get('sha256', '')[:12]} missing from image store")
+                raise ImageMissingError(f"image_{index + 1} 已从图片存储中清理")
+            parts.append({
+                "mime_type": ref["mime_type"],
+                "data": base64.b64encode(data).decode(),
+                "sha256": ref["sha256"]
+            })
+        return parts
+
+    def touch(self, refs: Iterable[Dict[str, Any]]) -> None:
+        """刷新一组图片的使用时间（会话仍在使用时避免被清理）"""
+        for ref in refs:
+            if ref.get("sha256") and ref.get("data") is None:
+                self._touch_path(self._path(ref["sha256"]))
+
+    @staticmethod
+    def _touch_path(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _maybe_gc(self) -> None:
+        """到了清理间隔时在线程池中清理过期图片（目录遍历和删除不阻塞事件循环）"""
+        now = time.time()
+        if now - self._last_gc < _GC_INTERVAL:
+            return
+        if self._gc_task is not None and not self._gc_task.done():
+            return
+        self._last_gc = now
+        self._gc_task = asyncio.create_task(asyncio.to_thread(self._gc, now))
+
+    def _gc(self, now: float) -> None:
+        cutoff = now - self.ttl
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, name)
+                try:
+                    # 清理过期图片，以及写入中断遗留的临时文件
+                    if os.path.getmtime(path) < cutoff or (name.endswith(".tmp") and os.path.getmtime(path) < now - 60):
+                        os.remove(path)
+                        self.stats["removed"] += 1
+                except OSError:
+                    pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self.stats, "directory": self.directory, "ttl": self.ttl}
+
+
+image_store = ImageStore(config.IMAGE_STORE_DIR, config.IMAGE_STORE_TTL or config.SESSION_TTL * 2)
@@ -0,0 +1,353 @@
+"""
+Markdown → 飞书文档 blocks 转换
+
+增量式：可以分块喂入文本（例如直接接AI的流式输出），每遇到完整的一行就产出对应的block，
+不需要等全文生成完毕。支持：
+
+- 标题（# ~ ######，三级以下按三级标题处理）
+- 段落：每个非空行一个文本块
+- 图片引用 ![描述](image_N)：产出图片块占位，image_ref 为 "image_N"，由调用方填入file_token后删除该字段
+- 无序列表 / 有序列表 / 待办（- [ ] / - [x]）
+- 引用（> ）、分割线（--- / *** / ___）
+- 代码块（``` 或 ~~~，保留缩进）
+- 表格（| a | b | 加分隔行）：产出表格块，子块放在 descendants 中，需通过“创建嵌套块”接口写入
+- 行内样式：**粗体**、*斜体*、~~删除线~~、`行内代码`、[链接](url)；
+  行中间的图片引用飞书无法内联显示，按普通文本保留
+"""
+import re
+import asyncio
+import itertools
+from urllib.parse import quote
+from typing import Optional, List, Dict, Any, Iterator, Iterable, AsyncIterator
+
+# 飞书 block_type
+BLOCK_TEXT = 2
+BLOCK_HEADING1 = 3
+BLOCK_BULLET = 12
+BLOCK_ORDERED = 13
+BLOCK_CODE = 14
+BLOCK_QUOTE = 15
+BLOCK_TODO = 17
+BLOCK_DIVIDER = 22
+BLOCK_IMAGE = 27
+BLOCK_TABLE = 31
+BLOCK_TABLE_CELL = 32
+
+# 标题最多用到三级
+MAX_HEADING_LEVEL = 3
+
+# compile_markdown 每次喂给编译器的最大字符数
+_FEED_SIZE = 16 * 1024
+
+# 飞书代码块语言枚举（常用部分，其余按纯文本）
+CODE_LANGUAGES = {
+    "": 1, "text": 1, "plaintext": 1, "bash": 7, "sh": 7, "csharp": 8, "c#": 8, "cpp": 9, "c++": 9,
+    "c": 10, "css": 12, "dart": 15, "dockerfile": 18, "go": 22, "html": 24, "http": 26,
+    "json": 28, "java": 29, "javascript": 30, "js": 30, "kotlin": 32, "lua": 36,
+    "makefile": 38, "markdown": 39, "md": 39, "nginx": 40, "php": 43, "perl": 44,
+    "powershell": 46, "python": 49, "py": 49, "r": 50, "ruby": 52, "rust": 53, "scss": 55,
+    "sql": 56, "scala": 57, "shell": 60, "swift": 61, "typescript": 63, "ts": 63,
+    "xml": 66, "yaml": 67, "yml": 67,
+}
+
+_HEADING = re.compile(r"(#{1,6})\s+(.+?)(?:\s+#+)?\s*$")
+_IMAGE_REF = re.compile(r"!\[([^\]]*)\]\((image_\d+)\)")
+_FENCE = re.compile(r"(`{3,}|~{3,})\s*([\w#+.-]*)")
+_TODO = re.compile(r"[-*+]\s+\[([ xX])\]\s+(.*)")
+_BULLET = re.compile(r"[-*+]\s+(.*)")
+_ORDERED = re.compile(r"\d{1,9}[.)]\s+(.*)")
+_DIVIDER = re.compile(r"(?:-{3,}|\*{3,}|_{3,})")
+_TABLE_SEPARATOR = re.compile(r"\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?")
+
+# 行内样式：依次为 粗斜体、粗体、斜体、删除线、行内代码、行内图片引用、链接
+# （开头的先行断言让不含标记字符的位置快速跳过；斜体内容取最短匹配且不跨行，
+# 避免 "_a_ 和 _b_" 被当成一整段斜体）
+_INLINE = re.compile(
+    r"(?=[*_~`\[!])(?:"
+    r"\*\*\*(?P<bold_italic>.+?)\*\*\*"
+    r"|\*\*(?P<bold>.+?)\*\*"
+    r"|(?<!\w)__(?P<bold2>.+?)__(?!\w)"
+    r"|\*(?P<italic>[^\s*](?:[^\n]*?[^\s*])??)\*"
+    r"|(?<!\w)_(?P<italic2>[^\s_](?:[^\n]*?[^\s_])??)_(?!\w)"
+    r"|~~(?P<strike>.+?)~~"
+    r"|`(?P<code>[^`]+)`"
+    r"|(?P<image>!\[[^\]]*\]\([^)\s]*\))"
+    r"|\[(?P<link_text>[^\]]+)\]\((?P<link_url>[^)\s]+)\)"
+    r")"
+)
+
+# 可能包含行内样式的字符；不含这些字符的文本不必走正则
+_INLINE_MARKERS = re.compile(r"[*_~`\[]")
+
+
+# 各行内样式对应的 text_element_style
+_INLINE_STYLES = {
+    "bold_italic": {"bold": True, "italic": True},
+    "bold": {"bold": True},
+    "bold2": {"bold": True},
+    "italic": {"italic": True},
+    "italic2": {"italic": True},
+    "strike": {"strikethrough": True},
+}
+
+
+def _text_run(content: str, style: Dict[str, Any]) -> Dict[str, Any]:
+    if style:
+        return {"text_run": {"content": content, "text_element_style": style}}
+    return {"text_run": {"content": content}}
+
+
+def parse_inline(text: str, style: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """把一行Markdown的行内样式转换为飞书 text_run 元素列表"""
+    style = style or {}
+    if not _INLINE_MARKERS.search(text):
+        return [_text_run(text, style)] if text else []
+    elements: List[Dict[str, Any]] = []
+    pos = 0
+    for match in _INLINE.finditer(text):
+        kind = match.lastgroup
+        if kind == "image":
+            # 行内图片引用按原文保留（不能当作链接，飞书会拒绝 image_N 这样的URL）
+            continue
+        start = match.start()
+        if start > pos:
+            elements.append(_text_run(text[pos:start], style))
+        pos = match.end()
+
+        if kind == "code":
+            elements.append(_text_run(match.group(kind), {**style, "inline_code": True}))
+            continue
+        if kind == "link_url":
+            inner = match.group("link_text")
+            inner_style = {**style, "link": {"url": quote(match.group(kind), safe="")}}
+        else:
+            inner = match.group(kind)
+            inner_style = {**style, **_INLINE_STYLES[kind]}
+        # 样式可以嵌套，例如 **粗体里的*斜体***
+        if _INLINE_MARKERS.search(inner):
+            elements.extend(parse_inline(inner, inner_style))
+        else:
+            elements.append(_text_run(inner, inner_style))
+    if pos < len(text):
+        elements.append(_text_run(text[pos:], style))
+    return elements
+
+
+def _text_block(block_type: int, key: str, text: str, **extra) -> Dict[str, Any]:
+    # 飞书不接受空的 elements
+    body: Dict[str, Any] = {"elements": parse_inline(text) or [_text_run("", {})]}
+    body.update(extra)
+    return {"block_type": block_type, key: body}
+
+
+def _split_row(line: str) -> List[str]:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip().replace("\\|", "|") for cell in re.split(r"(?<!\\)\|", line)]
+
+
+class MarkdownBlockCompiler:
+    """
+    增量式 Markdown → 飞书 blocks 编译器
+
+    用法：
+        compiler = MarkdownBlockCompiler()
+        for chunk in chunks:
+            blocks = compiler.feed(chunk)
+            ...
+        blocks = compiler.close()
+
+    feed/close 调用时立即处理输入并返回block列表，调用方不使用返回值也不会丢失输入状态。
+    """
+
+    def __init__(self):
+        self._pending: List[str] = []  # 尚未遇到换行的文本片段
+        self._code: Optional[Dict[str, Any]] = None  # 进行中的代码块 {"fence", "language", "lines"}
+        self._table_rows: List[str] = []  # 可能是表格的连续行
+        self._table_ids = itertools.count(1)
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """喂入一段文本，返回其中已完整的行对应的blocks"""
+        # 没有换行时只暂存，避免长行被逐块重复拼接
+        self._pending.append(chunk)
+        if "\n" not in chunk:
+            return []
+        text = "".join(self._pending)
+        *lines, rest = text.split("\n")
+        self._pending = [rest] if rest else []
+        out: List[Dict[str, Any]] = []
+        for line in lines:
+            self._line(line, out)
+        return out
+
+    def close(self) -> List[Dict[str, Any]]:
+        """输入结束：处理最后一行以及未闭合的代码块/表格"""
+        out: List[Dict[str, Any]] = []
+        if self._pending:
+            line = "".join(self._pending)
+            self._pending = []
+            self._line(line, out)
+        if self._code is not None:
+            out.append(self._code_block())
+        self._flush_table(out)
+        return out
+
+    def _line(self, raw: str, out: List[Dict[str, Any]]) -> None:
+        """处理一行，产出的blocks追加到 out"""
+        raw = raw.rstrip("\r")
+
+        # 代码块内部：原样保留，直到遇到同类型的闭合围栏
+        if self._code is not None:
+            stripped = raw.strip()
+            fence = self._code["fence"]
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                out.append(self._code_block())
+            else:
+                self._code["lines"].append(raw)
+            return
+
+        line = raw.strip()
+
+        if line.startswith("|"):
+            self._table_rows.append(line)
+            return
+        if self._table_rows:
+            self._flush_table(out)
+
+        if not line:
+            return
+
+        if line[0] in "`~":
+            fence = _FENCE.match(line)
+            if fence and fence.end() == len(line):
+                self._code = {"fence": fence.group(1), "language": fence.group(2).lower(), "lines": []}
+                return
+
+        block = self._block(line)
+        if block is not None:
+            out.append(block)
+
+    def _block(self, line: str) -> Optional[Dict[str, Any]]:
+        """单行块：标题、图片、列表、引用、分割线、段落"""
+        first = line[0]
+
+        if first == "#":
+            heading = _HEADING.match(line)
+            if heading:
+                level = min(len(heading.group(1)), MAX_HEADING_LEVEL)
+                return _text_block(BLOCK_HEADING1 + level - 1, f"heading{level}", heading.group(2))
+
+        elif first == "!":
+            image = _IMAGE_REF.match(line)
+            if image:
+                return {"block_type": BLOCK_IMAGE, "image": {}, "image_ref": image.group(2)}
+
+        elif first == ">":
+            text = line.lstrip(">").strip()
+            return _text_block(BLOCK_QUOTE, "quote", text) if text else None
+
+        elif first in "-*+_":
+            if _DIVIDER.fullmatch(line.replace(" ", "")):
+                return {"block_type": BLOCK_DIVIDER, "divider": {}}
+            todo = _TODO.match(line)
+            if todo:
+                return _text_block(BLOCK_TODO, "todo", todo.group(2), style={"done": todo.group(1) != " "})
+            bullet = _BULLET.match(line)
+            if bullet:
+                return _text_block(BLOCK_BULLET, "bullet", bullet.group(1))
+
+        elif first.isdigit():
+            ordered = _ORDERED.match(line)
+            if ordered:
+                return _text_block(BLOCK_ORDERED, "ordered", ordered.group(1))
+
+        return _text_block(BLOCK_TEXT, "text", line)
+
+    def _code_block(self) -> Dict[str, Any]:
+        code, self._code = self._code, None
+        language = CODE_LANGUAGES.get(code["language"], 1)
+        return {
+            "block_type": BLOCK_CODE,
+            "code": {
+                "elements": [_text_run("\n".join(code["lines"]), {})],
+                "style": {"language": language}
+            }
+        }
+
+    def _flush_table(self, out: List[Dict[str, Any]]) -> None:
+        """连续的 | 行：第二行是分隔行时按表格输出，否则按段落输出"""
+        if not self._table_rows:
+            return
+        rows, self._table_rows = self._table_rows, []
+        if len(rows) >= 2 and _TABLE_SEPARATOR.fullmatch(rows[1]):
+            out.append(self._table_block([_split_row(rows[0])] + [_split_row(row) for row in rows[2:]]))
+            return
+        for row in rows:
+            block = self._block(row)
+            if block is not None:
+                out.append(block)
+
+    def _table_block(self, rows: List[List[str]]) -> Dict[str, Any]:
+        """
+        表格块：飞书需要用“创建嵌套块”接口一次写入表格、单元格和单元格内的文本，
+        单元格等子块放在 descendants 中（block_id 为临时ID）
+        """
+        column_size = max(len(row) for row in rows)
+        table_id = f"table_{next(self._table_ids)}"
+        cell_ids: List[str] = []
+        descendants: List[Dict[str, Any]] = []
+        for r, row in enumerate(rows):
+            for c in range(column_size):
+                cell_id = f"{table_id}_cell_{r}_{c}"
+                text_id = f"{cell_id}_text"
+                cell_ids.append(cell_id)
+                descendants.append({
+                    "block_id": cell_id,
+                    "block_type": BLOCK_TABLE_CELL,
+                    "table_cell": {},
+                    "children": [text_id]
+                })
+                text = row[c] if c < len(row) else ""
+                descendants.append(dict(_text_block(BLOCK_TEXT, "text", text), block_id=text_id, children=[]))
+        return {
+            "block_id": table_id,
+            "block_type": BLOCK_TABLE,
+            "table": {
+                "property": {
+                    "row_size": len(rows),
+                    "column_size": column_size,
+                    "header_row": True
+                }
+            },
+            "children": cell_ids,
+            "descendants": descendants
+        }
+
+
+def compile_markdown(chunks: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """把一组文本块（或整篇文本组成的单元素列表）转换为blocks"""
+    compiler = MarkdownBlockCompiler()
+    for chunk in chunks:
+        # 整篇长文分段喂入，blocks边转换边产出，不必一次性生成整篇的block列表
+        for start in range(0, len(chunk), _FEED_SIZE):
+            yield from compiler.feed(chunk[start:start + _FEED_SIZE])
+    yield from compiler.close()
+
+
+async def acompile_markdown(chunks: Iterable[str]) -> AsyncIterator[Dict[str, Any]]:
+    """
+    compile_markdown 的异步版本：每段喂入前让出事件循环
+
+    调用方在解析期间启动的任务（如图片上传）可以在段与段之间运行，与解析交替进行。
+    """
+    compiler = MarkdownBlockCompiler()
+    for chunk in chunks:
+        for start in range(0, len(chunk), _FEED_SIZE):
+            await asyncio.sleep(0)
+            for block in compiler.feed(chunk[start:start + _FEED_SIZE]):
+                yield block
+    for block in compiler.close():
+        yield block
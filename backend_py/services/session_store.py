@@ -0,0 +1,296 @@
+"""
+AI创作会话存储
+
+会话包含完整的消息历史、原始blocks和图片数据，体积可能很大，不能无限制地留在内存里：
+- SessionStore 定义统一的异步接口，具体后端可替换
+- MemorySessionStore：进程内存储，每个会话闲置超过TTL后过期，总字节数超出上限时按LRU淘汰
+- SharedSessionStore：会话序列化后存入外部键值存储，多个uvicorn worker共享同一份会话。
+  键值存储使用 redis.asyncio 客户端接口（get/set/delete/expire）的子集，
+  可以直接用Redis，也可以用本地的 SQLiteKV（WAL模式，同机多进程并发读写）
+
+会话以普通dict读写；修改会话后需要再次调用 set 保存（同时更新大小统计）。
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Union
+
+import config
+
+
+def estimate_size(value: Any) -> int:
+    """粗略估算会话占用的字节数（字符串按UTF-8长度计，主要开销来自base64图片和文章正文）"""
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(k)) + estimate_size(v) for k, v in value.items()) + 16
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value) + 16
+    return 8
+
+
+class SessionStore:
+    """会话存储接口"""
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """读取会话；不存在或已过期时返回 None"""
+        raise NotImplementedError
+
+    async def set(self, session_id: str, session: Dict[str, Any]) -> None:
+        """保存（创建或更新）会话，并刷新其过期时间"""
+        raise NotImplementedError
+
+    async def delete(self, session_id: str) -> bool:
+        """删除会话，返回会话是否存在"""
+        raise NotImplementedError
+
+    def snapshot(self) -> Dict[str, Any]:
+        """会话数量、占用字节数等统计"""
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """进程内会话存储：闲置TTL + 按字节数LRU淘汰"""
+
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # 会话ID -> (会话, 估算大小, 过期时间)；按最近访问排序，TTL统一时也就是按过期时间排序
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def _remove(self, session_id: str) -> None:
+        _, size, _ = self._entries.pop(session_id)
+        self.total_bytes -= size
+
+    def _purge_expired(self, now: float) -> None:
+        while self._entries:
+            session_id, (_, _, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            self._remove(session_id)
+            self.stats["expirations"] += 1
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        self._purge_expired(now)
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        session, size, _ = entry
+        self._entries[session_id] = (session, size, now + self.ttl)
+        self._entries.move_to_end(session_id)
+        self.stats["hits"] += 1
+        return session
+
+    async def set(self, session_id: str, session: Dict[str, Any]) -> None:
+        now = time.time()
+        if session_id in self._entries:
+            self._remove(session_id)
+        size = estimate_size(session)
+        self._entries[session_id] = (session, size, now + self.ttl)
+        self.total_bytes += size
+        self._purge_expired(now)
+        # 淘汰最久未使用的会话（刚保存的会话即使超过上限也保留）
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_id = next(iter(self._entries))
+            self._remove(evicted_id)
+            self.stats["evictions"] += 1
+            print(f"Session {evicted_id} evicted (session store over {self.max_bytes} bytes)")
+
+    async def delete(self, session_id: str) -> bool:
+        if session_id not in self._entries:
+            return False
+        self._remove(session_id)
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._purge_expired(time.time())
+        return {
+            **self.stats,
+            "backend": "memory",
+            "sessions": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl
+        }
+
+
+class SQLiteKV:
+    """
+    本地SQLite键值存储，异步接口与 redis.asyncio 客户端的 get/set/delete/expire 一致
+
+    数据库使用WAL模式：读写互不阻塞，多个进程可以同时访问同一个文件。
+    每个线程一个连接，SQLite调用在线程池中执行，不阻塞事件循环。
+    总大小超过上限时按最近访问时间淘汰（相当于Redis的 allkeys-lru 策略）。
+    """
+
+    # 每写入多少次清理一次过期数据并检查总大小
+    _MAINTENANCE_INTERVAL = 32
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+        self.stats = {"evictions": 0}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._init_lock:
+            if not self._initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS kv ("
+                    "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                    "expires_at REAL, accessed_at REAL NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_accessed ON kv(accessed_at)")
+                self._initialized = True
+        self._local.conn = conn
+        return conn
+
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self._conn().execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self._conn().execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            return None
+        return bytes(value)
+
+    def _set(self, key: str, value: bytes, ex: Optional[float]) -> bool:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + ex if ex else None, now)
+        )
+        if random.randrange(self._MAINTENANCE_INTERVAL) == 0:
+            self._maintain(conn, now, keep=key)
+        return True
+
+    def _maintain(self, conn: sqlite3.Connection, now: float, keep: str) -> None:
+        """删除过期数据，并按最近访问时间淘汰到总大小以内"""
+        conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM kv").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM kv ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            total -= size
+            self.stats["evictions"] += 1
+
+    def _delete(self, keys: tuple) -> int:
+        conn = self._conn()
+        deleted = 0
+        for key in keys:
+            deleted += conn.execute("DELETE FROM kv WHERE key = ?", (key,)).rowcount
+        return deleted
+
+    def _expire(self, key: str, seconds: float) -> bool:
+        now = time.time()
+        cursor = self._conn().execute(
+            "UPDATE kv SET expires_at = ?, accessed_at = ? WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (now + seconds, now, key, now)
+        )
+        return cursor.rowcount > 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Union[str, bytes], ex: Optional[float] = None) -> bool:
+        if isinstance(value, str):
+            value = value.encode()
+        return await asyncio.to_thread(self._set, key, value, ex)
+
+    async def delete(self, *keys: str) -> int:
+        return await asyncio.to_thread(self._delete, keys)
+
+    async def expire(self, key: str, seconds: float) -> bool:
+        return await asyncio.to_thread(self._expire, key, seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        count, total = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM kv WHERE expires_at IS NULL OR expires_at > ?",
+            (time.time(),)
+        ).fetchone()
+        return {**self.stats, "keys": count, "bytes": total, "max_bytes": self.max_bytes, "path": self.path}
+
+
+class SharedSessionStore(SessionStore):
+    """会话以JSON存入共享的键值存储（Redis 或 SQLiteKV），任意worker都能读写"""
+
+    def __init__(self, client: Any, ttl: float, prefix: str = "miaobi:session:", backend: str = "shared"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.backend = backend
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        key = self.prefix + session_id
+        raw = await self.client.get(key)
+        if raw is None:
+            self.stats["misses"] += 1
+            return None
+        # 闲置TTL：每次访问都顺延过期时间
+        await self.client.expire(key, int(self.ttl))
+        self.stats["hits"] += 1
+        return json.loads(raw)
+
+    async def set(self, session_id: str, session: Dict[str, Any]) -> None:
+        await self.client.set(
+            self.prefix + session_id,
+            json.dumps(session, ensure_ascii=False),
+            ex=int(self.ttl)
+        )
+
+    async def delete(self, session_id: str) -> bool:
+        return await self.client.delete(self.prefix + session_id) > 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        stats = {**self.stats, "backend": self.backend, "ttl": self.ttl}
+        if hasattr(self.client, "snapshot"):
+            stats.update(self.client.snapshot())
+        return stats
+
+
+def create_session_store() -> SessionStore:
+    """按 SESSION_STORE_BACKEND 创建会话存储"""
+    backend = config.SESSION_STORE_BACKEND
+    max_bytes = config.SESSION_STORE_MAX_MB * 1024 * 1024
+    if backend == "redis":
+        try:
+            import redis.asyncio as redis
+            return SharedSessionStore(redis.from_url(config.SESSION_REDIS_URL), config.SESSION_TTL, backend="redis")
+        except ImportError:
+            print("⚠️ Warning: redis package not installed, session store falls back to SQLite")
+            backend = "sqlite"
+    if backend == "sqlite":
+        return SharedSessionStore(SQLiteKV(config.SESSION_STORE_PATH, max_bytes), config.SESSION_TTL, backend="sqlite")
+    return MemorySessionStore(ttl=config.SESSION_TTL, max_bytes=max_bytes)
+
+
+session_store: SessionStore = create_session_store()
@@ -0,0 +1,77 @@
+"""
+测试公共设置
+
+- 把 backend_py 加入导入路径（与 routers 中的 sys.path 处理一致）
+- 缓存、任务检查点等数据目录指向临时目录，不污染 data/
+- feishu_client：用 httpx.MockTransport 模拟飞书开放平台
+"""
+import os
+import sys
+import tempfile
+
+import httpx
+import pytest
+
+_DATA_DIR = tempfile.mkdtemp(prefix="miaobi-test-")
+for _name, _sub in [
+    ("BATCH_JOB_DIR", "jobs"),
+    ("IMAGE_CACHE_DIR", "images"),
+    ("IMAGE_STORE_DIR", "session_images"),
+    ("SESSION_STORE_PATH", "sessions.db"),
+]:
+    os.environ[_name] = os.path.join(_DATA_DIR, _sub)
+os.environ["SESSION_STORE_BACKEND"] = "memory"
+os.environ["GENERATION_CACHE_DISK_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FeishuMock:
+    """按 (方法, 路径) 注册响应，并记录收到的请求（json 可以是接收请求、返回响应体的函数）"""
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+
+    def add(self, method: str, path: str, json=None, status_code: int = 200, content: bytes = None, headers=None):
+        self.routes[(method, path)] = (status_code, json, content, headers or {})
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        route = self.routes.get((request.method, request.url.path))
+        if route is None:
+            return httpx.Response(404, json={"code": 404, "msg": f"no mock for {request.method} {request.url.path}"})
+        status_code, json, content, headers = route
+        if callable(json):
+            json = json(request)
+        if json is not None:
+            return httpx.Response(status_code, json=json, headers=headers)
+        return httpx.Response(status_code, content=content, headers=headers)
+
+    def count(self, method: str, path: str) -> int:
+        return sum(1 for r in self.requests if r.method == method and r.url.path == path)
+
+
+@pytest.fixture
+def feishu():
+    return FeishuMock()
+
+
+@pytest.fixture
+def feishu_client(feishu):
+    return httpx.AsyncClient(transport=httpx.MockTransport(feishu.handler))
+
+
+@pytest.fixture
+def api(feishu_client, monkeypatch):
+    """整个应用的 TestClient（不运行生命周期钩子），飞书请求全部走 feishu_client"""
+    from fastapi.testclient import TestClient
+    import main
+    from services import feishu_api
+
+    monkeypatch.setattr(feishu_api, "_client", feishu_client)
+    main.app.dependency_overrides[feishu_api.get_feishu_client] = lambda: feishu_client
+    try:
+        yield TestClient(main.app)
+    finally:
+        main.app.dependency_overrides.clear()
@@ -0,0 +1,94 @@
+"""
+准入控制：并发上限、优先级队列、单用户限制、排队超时
+"""
+import asyncio
+
+import pytest
+
+from services.admission import AdmissionController, AdmissionRejected, PRIORITY_CREATE, PRIORITY_REFINE
+
+
+def _controller(max_concurrency=1, max_queue=4, max_per_user=4):
+    return AdmissionController("test", max_concurrency=max_concurrency, max_queue=max_queue, max_per_user=max_per_user)
+
+
+def test_queue_is_served_by_priority():
+    controller = _controller()
+    order = []
+
+    async def wait(priority, user):
+        ticket = await controller.acquire(priority, user, timeout=5)
+        order.append(user)
+        ticket.release()
+
+    async def main():
+        running = await controller.acquire(PRIORITY_CREATE, "first")
+        waiters = [
+            asyncio.ensure_future(wait(PRIORITY_CREATE, "create")),
+            asyncio.ensure_future(wait(PRIORITY_REFINE, "refine")),
+        ]
+        await asyncio.sleep(0.01)
+        assert controller.snapshot()["queued"] == 2
+        running.release()
+        await asyncio.gather(*waiters)
+
+    asyncio.run(main())
+    # 精修（交互中的会话）先于新的创作请求
+    assert order == ["refine", "create"]
+    assert controller.running == 0 and controller.snapshot()["queued"] == 0
+
+
+def test_full_queue_rejects_with_retry_after():
+    controller = _controller(max_queue=0)
+
+    async def main():
+        ticket = await controller.acquire(PRIORITY_CREATE, "a")
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire(PRIORITY_CREATE, "b")
+        ticket.release()
+        return info.value
+
+    rejected = asyncio.run(main())
+    assert rejected.status_code == 503 and rejected.retry_after >= 1
+    assert controller.rejected == 1
+
+
+def test_per_user_limit():
+    controller = _controller(max_concurrency=4, max_per_user=1)
+
+    async def main():
+        ticket = await controller.acquire(PRIORITY_CREATE, "a")
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire(PRIORITY_CREATE, "a")
+        other = await controller.acquire(PRIORITY_CREATE, "b")
+        ticket.release()
+        other.release()
+        return info.value
+
+    assert asyncio.run(main()).status_code == 429
+    assert controller.running == 0
+
+
+def test_queue_timeout_leaves_no_slot_behind():
+    controller = _controller()
+
+    async def main():
+        ticket = await controller.acquire(PRIORITY_CREATE, "a")
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire(PRIORITY_CREATE, "b", timeout=0.01)
+        ticket.release()
+        ticket.release()  # 重复释放无副作用
+
+    asyncio.run(main())
+    assert controller.running == 0
+    assert controller.snapshot()["queued"] == 0
+    assert controller._user_load == {}
+
+
+def test_try_acquire_does_not_queue():
+    controller = _controller()
+    ticket = controller.try_acquire(PRIORITY_CREATE, "a")
+    assert ticket is not None
+    assert controller.try_acquire(PRIORITY_CREATE, "b") is None
+    ticket.release()
+    assert controller.running == 0
@@ -0,0 +1,52 @@
+"""
+生成缓存：普通接口与流式接口缓存同一种（已修正图片标记的）文本
+"""
+import ai_provider
+
+RAW = "# 标题\n\n![配图](img_1)"
+FIXED = "# 标题\n\n![配图](image_1)"
+
+
+class RawRefProvider(ai_provider.AIProvider):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    async def agenerate(self, prompt, images=None, timeout=30):
+        self.calls += 1
+        return RAW
+
+    async def astream(self, prompt, images=None, timeout=30):
+        self.calls += 1
+        yield RAW
+
+
+def _body(doc_id):
+    # 素材随文档变化，两个用例不共用缓存键
+    return {"doc_id": doc_id, "blocks": [{"block_type": "text", "text": f"素材 {doc_id}"}], "instruction": "写一篇文章"}
+
+
+def test_stream_hit_after_create_has_fixed_refs(api, monkeypatch):
+    provider = RawRefProvider()
+    monkeypatch.setenv("AI_PROVIDER", "test-raw-refs")
+    monkeypatch.setitem(ai_provider._registry, "test-raw-refs", provider)
+    headers = {"Authorization": "Bearer user-cache"}
+
+    response = api.post("/api/ai/create", json=_body("doc_cache_a"), headers=headers)
+    assert response.json()["content"] == FIXED
+
+    response = api.post("/api/ai/create/stream", json=_body("doc_cache_a"), headers=headers)
+    assert provider.calls == 1  # 命中 /create 写入的缓存
+    assert "image_1" in response.text and "img_1" not in response.text
+
+
+def test_create_hit_after_stream_has_fixed_refs(api, monkeypatch):
+    provider = RawRefProvider()
+    monkeypatch.setenv("AI_PROVIDER", "test-raw-refs")
+    monkeypatch.setitem(ai_provider._registry, "test-raw-refs", provider)
+    headers = {"Authorization": "Bearer user-cache"}
+
+    api.post("/api/ai/create/stream", json=_body("doc_cache_b"), headers=headers)
+    response = api.post("/api/ai/create", json=_body("doc_cache_b"), headers=headers)
+    assert provider.calls == 1
+    assert response.json()["content"] == FIXED
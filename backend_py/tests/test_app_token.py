@@ -0,0 +1,36 @@
+"""
+app_access_token 后台刷新：任何错误后都继续重试
+"""
+import asyncio
+
+from services import app_token
+from services.app_token import AppTokenManager
+
+
+def test_refresh_loop_survives_unexpected_errors(monkeypatch):
+    monkeypatch.setattr(app_token, "_RETRY_INTERVAL", 0.01)
+    manager = AppTokenManager(refresh_margin=60)
+    errors = [ValueError("Expecting value"), KeyError("app_access_token")]
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        manager._token = "app-token"
+        manager._expires_at = float("inf")
+        return manager._token
+
+    monkeypatch.setattr(manager, "_fetch", fetch)
+
+    async def main():
+        task = asyncio.create_task(manager._refresh_loop())
+        while len(calls) < 3:
+            await asyncio.sleep(0.01)
+        assert not task.done()
+        assert await manager.get() == "app-token"
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+    asyncio.run(main())
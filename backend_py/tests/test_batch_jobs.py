@@ -0,0 +1,140 @@
+"""
+批量任务：多worker共享状态、租约、取消、token不落盘、所有者校验
+"""
+import asyncio
+
+from services.batch_jobs import BatchJobManager
+
+LEASE = 0.3
+
+
+def _workers(tmp_path, processor):
+    workers = [BatchJobManager(str(tmp_path), concurrency=2, lease=LEASE) for _ in range(2)]
+    for worker in workers:
+        worker.set_processor(processor)
+    return workers
+
+
+async def _wait_status(manager, job_id, *statuses, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        job = await manager.get(job_id)
+        if job.status in statuses:
+            return job
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not reach {statuses}")
+
+
+def test_job_runs_once_and_is_visible_from_other_worker(tmp_path):
+    calls = []
+    release = asyncio.Event()
+
+    async def processor(job, item):
+        calls.append((job.token, item["doc_id"]))
+        await release.wait()
+        return {"title": item["doc_id"]}
+
+    a, b = _workers(tmp_path, processor)
+
+    async def main():
+        job = await a.submit("secret-token", "ou_owner", "写文章", ["d1", "d2"], False)
+        await asyncio.sleep(0.05)
+        remote = await b.get(job.job_id)
+        assert remote.status == "running" and remote.owner == "ou_owner"
+        # 另一个worker不能在租约有效期内接手
+        assert await b.resume(job.job_id, "other-token") is None
+        await asyncio.sleep(LEASE * 2)  # 期间租约被续期
+        assert await b.resume(job.job_id, "other-token") is None
+        release.set()
+        done = await _wait_status(b, job.job_id, "completed")
+        assert [item["title"] for item in done.items] == ["d1", "d2"]
+
+    asyncio.run(main())
+    assert sorted(calls) == [("secret-token", "d1"), ("secret-token", "d2")]
+    for path in tmp_path.iterdir():  # jobs.db 及 WAL 文件
+        assert b"secret-token" not in path.read_bytes()
+
+
+def test_cancel_from_other_worker(tmp_path):
+    async def processor(job, item):
+        await asyncio.sleep(60)
+
+    a, b = _workers(tmp_path, processor)
+
+    async def main():
+        job = await a.submit("t", "ou_owner", "写文章", ["d1"], False)
+        await asyncio.sleep(0.05)
+        assert await b.cancel(job.job_id)
+        cancelled = await _wait_status(b, job.job_id, "cancelled")
+        assert cancelled.items[0]["status"] == "pending"
+        assert job.job_id not in a.jobs
+
+    asyncio.run(main())
+
+
+def test_interrupted_job_pauses_until_owner_resumes(tmp_path):
+    blocked = asyncio.Event()
+    calls = []
+
+    async def processor(job, item):
+        calls.append((job.token, item["doc_id"]))
+        if item["doc_id"] == "d2" and job.token == "old-token":
+            await blocked.wait()
+        return {}
+
+    a, b = _workers(tmp_path, processor)
+    a.concurrency = 1
+
+    async def main():
+        job = await a.submit("old-token", "ou_owner", "写文章", ["d1", "d2"], False)
+        while len(calls) < 2:
+            await asyncio.sleep(0.01)
+        await a.shutdown()  # 模拟进程重启
+        paused = await b.get(job.job_id)
+        assert paused.status == "paused"
+        assert [item["status"] for item in paused.items] == ["completed", "pending"]
+
+        resumed = await b.resume(job.job_id, "new-token")
+        assert resumed is not None
+        await _wait_status(a, job.job_id, "completed")
+
+    asyncio.run(main())
+    # 已完成的文档不重复处理，恢复后使用新token
+    assert calls == [("old-token", "d1"), ("old-token", "d2"), ("new-token", "d2")]
+
+
+def test_endpoints_check_owner(api, feishu, tmp_path, monkeypatch):
+    from routers import jobs
+
+    manager = BatchJobManager(str(tmp_path), concurrency=1, lease=LEASE)
+
+    async def processor(job, item):
+        return {}
+
+    manager.set_processor(processor)
+    monkeypatch.setattr(jobs, "batch_jobs", manager)
+    users = {"Bearer token-a": "ou_a", "Bearer token-b": "ou_b"}
+    feishu.add(
+        "GET", "/open-apis/authen/v1/user_info",
+        json=lambda request: {"code": 0, "data": {"open_id": users[request.headers["Authorization"]]}}
+    )
+
+    async def submit():
+        job = await manager.submit("token-a", "ou_a", "写文章", ["d1"], False)
+        await _wait_status(manager, job.job_id, "completed")
+        return job.job_id
+
+    job_id = asyncio.run(submit())
+
+    assert api.get(f"/api/jobs/{job_id}", headers={"Authorization": "Bearer token-b"}).status_code == 404
+    assert api.delete(f"/api/jobs/{job_id}", headers={"Authorization": "Bearer token-b"}).status_code == 404
+    assert api.get(f"/api/jobs/{job_id}/events?token=token-b").status_code == 404
+    assert api.get(f"/api/jobs/{job_id}").status_code == 401
+
+    response = api.get(f"/api/jobs/{job_id}", headers={"Authorization": "Bearer token-a"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+    events = api.get(f"/api/jobs/{job_id}/events?token=token-a")
+    assert events.status_code == 200
+    assert '"status": "completed"' in events.text
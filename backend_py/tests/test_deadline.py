@@ -0,0 +1,111 @@
+"""
+请求截止时间：预算解析、超时/断开取消，以及快速返回的AI调用不会卡住请求
+"""
+import asyncio
+
+import pytest
+from starlette.requests import Request
+
+import ai_provider
+from services import admission
+from services.deadline import Deadline, ClientDisconnected, run_with_deadline
+
+
+def _request(receive):
+    return Request({"type": "http", "method": "POST", "path": "/", "headers": []}, receive)
+
+
+async def _never_disconnect():
+    await asyncio.Event().wait()
+
+
+def test_from_headers_clamps_and_rejects_invalid():
+    assert Deadline.from_headers({}, 30, maximum=30).budget == 30
+    assert Deadline.from_headers({"X-Request-Timeout": "5"}, 30, maximum=30).budget == 5
+    assert Deadline.from_headers({"X-Request-Timeout": "600"}, 30, maximum=30).budget == 30
+    for value in ("nan", "inf", "-inf", "-3", "abc"):
+        assert Deadline.from_headers({"X-Request-Timeout": value}, 30, maximum=30).budget == 30
+
+
+def test_instant_result_with_request_watcher():
+    """回归：结果在第一次断开检查期间就返回时，run_with_deadline 不能挂起"""
+    async def instant():
+        return "ok"
+
+    async def main():
+        for _ in range(20):
+            result = await asyncio.wait_for(
+                run_with_deadline(instant(), Deadline(10), _request(_never_disconnect)), 2
+            )
+            assert result == "ok"
+
+    asyncio.run(main())
+
+
+def test_instant_failure_with_request_watcher():
+    async def fail():
+        raise RuntimeError("upstream error")
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(run_with_deadline(fail(), Deadline(10), _request(_never_disconnect)), 2)
+
+    asyncio.run(main())
+
+
+def test_deadline_exceeded_cancels_call():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        with pytest.raises(TimeoutError):
+            await run_with_deadline(slow(), Deadline(0.05), _request(_never_disconnect), poll_interval=0.01)
+
+    asyncio.run(main())
+    assert cancelled == [True]
+
+
+def test_client_disconnect_cancels_call():
+    async def disconnect():
+        return {"type": "http.disconnect"}
+
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def main():
+        with pytest.raises(ClientDisconnected):
+            await run_with_deadline(slow(), Deadline(5), _request(disconnect), poll_interval=0.01)
+
+    asyncio.run(main())
+
+
+class InstantProvider(ai_provider.AIProvider):
+    async def agenerate(self, prompt, images=None, timeout=30):
+        return "# 标题\n\n正文"
+
+
+def test_create_endpoint_with_instant_provider(api, monkeypatch):
+    """回归：提供商立即返回时 /api/ai/create 正常响应并释放准入名额"""
+    monkeypatch.setenv("AI_PROVIDER", "test-instant")
+    monkeypatch.setitem(ai_provider._registry, "test-instant", InstantProvider())
+
+    for _ in range(3):
+        response = api.post(
+            "/api/ai/create",
+            json={
+                "doc_id": "doc_instant",
+                "blocks": [{"block_type": "text", "text": "素材"}],
+                "instruction": "写一篇文章",
+                "no_cache": True
+            },
+            headers={"Authorization": "Bearer user-instant"}
+        )
+        assert response.status_code == 200
+        assert response.json()["content"] == "# 标题\n\n正文"
+    assert admission.snapshot()["test-instant"]["running"] == 0
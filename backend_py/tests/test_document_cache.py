@@ -0,0 +1,51 @@
+"""
+文档内容缓存：按修订版本校验、按用户隔离、按字节数LRU淘汰
+"""
+from services.document_cache import DocumentContentCache, make_etag
+
+BLOCKS = [{"block_type": "text", "text": "第一段"}]
+
+
+def test_hit_requires_same_revision():
+    cache = DocumentContentCache(max_bytes=1024 * 1024)
+    cache.set("user-a", "doc1", 3, "标题", BLOCKS)
+
+    entry = cache.get("user-a", "doc1", 3)
+    assert entry["title"] == "标题" and entry["blocks"] == BLOCKS
+    assert cache.get("user-a", "doc1", 4) is None
+    assert cache.snapshot()["hits"] == 1 and cache.snapshot()["misses"] == 1
+
+
+def test_entries_are_isolated_per_user():
+    cache = DocumentContentCache(max_bytes=1024 * 1024)
+    cache.set("user-a", "doc1", 3, "标题", BLOCKS)
+    assert cache.get("user-b", "doc1", 3) is None
+
+
+def test_lru_eviction_by_bytes():
+    cache = DocumentContentCache(max_bytes=200)
+    blocks = [{"text": "x" * 50}]
+    for doc_id in ("d1", "d2", "d3"):
+        cache.set("u", doc_id, 1, "", blocks)
+    assert cache.get("u", "d1", 1) is not None  # d1 变为最近使用
+    cache.set("u", "d4", 1, "", blocks)
+
+    assert cache.get("u", "d2", 1) is None
+    assert all(cache.get("u", doc_id, 1) is not None for doc_id in ("d1", "d3", "d4"))
+    assert cache.snapshot()["bytes"] <= 200
+
+
+def test_oversized_entry_is_not_cached():
+    cache = DocumentContentCache(max_bytes=10)
+    cache.set("u", "doc1", 1, "标题", BLOCKS)
+    assert cache.get("u", "doc1", 1) is None
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_update_replaces_size():
+    cache = DocumentContentCache(max_bytes=1024)
+    cache.set("u", "doc1", 1, "", [{"text": "x" * 100}])
+    cache.set("u", "doc1", 2, "", BLOCKS)
+    snapshot = cache.snapshot()
+    assert snapshot["entries"] == 1 and snapshot["bytes"] < 100
+    assert make_etag("doc1", 2) == '"doc1-2"'
@@ -0,0 +1,89 @@
+"""
+文档内容接口（端到端，飞书接口由 MockTransport 模拟）
+"""
+import asyncio
+
+DOC_PATH = "/open-apis/docx/v1/documents/{doc_id}"
+BLOCKS_PATH = "/open-apis/docx/v1/documents/{doc_id}/blocks"
+
+
+def _mock_document(feishu, doc_id: str, revision_id: int = 3):
+    feishu.add("GET", DOC_PATH.format(doc_id=doc_id), json={
+        "code": 0,
+        "data": {"document": {"document_id": doc_id, "title": "测试文档", "revision_id": revision_id}}
+    })
+    feishu.add("GET", BLOCKS_PATH.format(doc_id=doc_id), json={
+        "code": 0,
+        "data": {
+            "has_more": False,
+            "items": [
+                {"block_id": "b1", "block_type": 2, "text": {"elements": [{"text_run": {"content": "第一段"}}]}},
+                {"block_id": "b2", "block_type": 27, "image": {"token": "img_1"}},
+            ]
+        }
+    })
+
+
+def test_get_document_content(api, feishu):
+    _mock_document(feishu, "doc_e2e")
+    headers = {"Authorization": "Bearer user-a"}
+
+    response = api.get("/api/documents/content/doc_e2e", headers=headers)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["title"] == "测试文档"
+    assert [b["block_type"] for b in body["blocks"]] == ["text", "image"]
+    assert body["blocks"][0]["text"] == "第一段"
+    etag = response.headers["ETag"]
+
+    # 同一修订版本：命中缓存，不再拉取blocks
+    response = api.get("/api/documents/content/doc_e2e", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == body
+    assert feishu.count("GET", BLOCKS_PATH.format(doc_id="doc_e2e")) == 1
+
+    response = api.get("/api/documents/content/doc_e2e", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_load_document_content(api, feishu):
+    """批量任务使用的入口"""
+    from routers import documents
+
+    _mock_document(feishu, "doc_batch")
+    for _ in range(2):
+        content = asyncio.run(documents.load_document_content("doc_batch", "user-b"))
+        assert content.title == "测试文档"
+        assert content.blocks[1].image_token == "img_1"
+    assert feishu.count("GET", BLOCKS_PATH.format(doc_id="doc_batch")) == 1
+
+
+def test_create_document_cancels_uploads_when_compile_fails(api, feishu, monkeypatch):
+    from routers import documents
+
+    feishu.add("POST", "/open-apis/docx/v1/documents", json={"code": 0, "data": {"document": {"document_id": "doc_new"}}})
+    events = []
+
+    async def upload_image(client, token, doc_id, idx, img):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            events.append("upload cancelled")
+            raise
+
+    async def broken_compile(chunks):
+        await asyncio.sleep(0)
+        raise RuntimeError("compile failed")
+        yield
+
+    monkeypatch.setattr(documents, "_upload_image", upload_image)
+    monkeypatch.setattr(documents, "acompile_markdown", broken_compile)
+
+    response = api.post(
+        "/api/documents/create",
+        json={"title": "标题", "content": "![图](image_1)", "images": [{"mime_type": "image/png", "data": ""}]},
+        headers={"Authorization": "Bearer user-a"}
+    )
+    events.append("response")
+    assert response.status_code == 500
+    assert events == ["upload cancelled", "response"]
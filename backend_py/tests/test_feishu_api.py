@@ -0,0 +1,45 @@
+import json
+import asyncio
+
+from services.feishu_api import FeishuRateLimiter, create_children
+
+DOC = "/open-apis/docx/v1/documents/doc1/blocks"
+
+
+def _text(content):
+    return {"block_type": 2, "text": {"elements": [{"text_run": {"content": content}}]}}
+
+
+def _table():
+    return {"block_id": "table_1", "block_type": 31, "table": {}, "children": [], "descendants": []}
+
+
+def test_create_children_appends_after_existing_children(feishu, feishu_client):
+    feishu.add("GET", f"{DOC}/root", json={"code": 0, "data": {"block": {"children": ["a", "b"]}}})
+    feishu.add("POST", f"{DOC}/root/children", json={"code": 0})
+    feishu.add("POST", f"{DOC}/root/descendant", json={"code": 0})
+
+    blocks = [_text("1"), _text("2"), _text("3"), _table(), _text("4")]
+    written = asyncio.run(create_children(feishu_client, "t", "doc1", "root", blocks, batch_size=2, window=1))
+
+    assert written == 5
+    indexes = [json.loads(r.content)["index"] for r in feishu.requests if r.method == "POST"]
+    assert indexes == [2, 4, 5, 6]
+
+
+def test_create_children_explicit_start_index(feishu, feishu_client):
+    feishu.add("POST", f"{DOC}/root/children", json={"code": 0})
+
+    asyncio.run(create_children(feishu_client, "t", "doc1", "root", [_text("1")], start_index=0))
+
+    assert feishu.count("GET", f"{DOC}/root") == 0
+    assert json.loads(feishu.requests[0].content)["index"] == 0
+
+
+def test_descendant_uses_block_create_bucket():
+    limiter = FeishuRateLimiter(50)
+    base = "https://open.feishu.cn/open-apis/docx/v1/documents/doc1/blocks/root"
+    children = limiter._endpoint_bucket("POST", f"{base}/children")
+    assert children is not None
+    assert limiter._endpoint_bucket("POST", f"{base}/descendant") is children
+    assert limiter._endpoint_bucket("GET", f"{base}/children") is not children
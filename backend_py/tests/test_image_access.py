@@ -0,0 +1,68 @@
+"""
+图片代理缓存：缓存命中时仍需校验访问权限
+"""
+import uuid
+
+import pytest
+
+from routers import documents
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+TMP_URL_PATH = "/open-apis/drive/v1/medias/batch_get_tmp_download_url"
+
+
+@pytest.fixture(autouse=True)
+def _clear_grants():
+    documents._image_grants.clear()
+    yield
+    documents._image_grants.clear()
+
+
+def _grant(feishu, image_token, allowed):
+    if allowed:
+        body = {"code": 0, "data": {"tmp_download_urls": [{"file_token": image_token, "tmp_download_url": "https://x"}]}}
+    else:
+        body = {"code": 1061004, "msg": "forbidden", "data": {}}
+    feishu.add("GET", TMP_URL_PATH, json=body)
+
+
+def test_cache_hit_requires_access(api, feishu):
+    image_token = f"img_{uuid.uuid4().hex}"
+    download_path = f"/open-apis/drive/v1/medias/{image_token}/download"
+    feishu.add("GET", download_path, content=PNG, headers={"content-type": "image/png"})
+
+    # 首次请求由本人从飞书下载，不需要额外校验
+    response = api.get(f"/api/documents/image/doc/{image_token}", headers={"Authorization": "Bearer user-a"})
+    assert response.status_code == 200
+    assert response.content == PNG
+    assert feishu.count("GET", TMP_URL_PATH) == 0
+
+    # 其他用户命中缓存：飞书拒绝时不能返回图片
+    _grant(feishu, image_token, allowed=False)
+    response = api.get(f"/api/documents/image/doc/{image_token}", headers={"Authorization": "Bearer user-b"})
+    assert response.status_code == 403
+    assert feishu.count("GET", download_path) == 1
+
+    # 有权限的用户命中缓存；校验结果在TTL内复用
+    _grant(feishu, image_token, allowed=True)
+    for _ in range(2):
+        response = api.get(f"/api/documents/image/doc/{image_token}", headers={"Authorization": "Bearer user-c"})
+        assert response.status_code == 200
+        assert response.content == PNG
+    assert feishu.count("GET", TMP_URL_PATH) == 2
+    assert feishu.count("GET", download_path) == 1
+
+
+def test_ai_download_path_checks_access(api, feishu):
+    import asyncio
+    from routers.ai import download_images
+
+    image_token = f"img_{uuid.uuid4().hex}"
+    feishu.add("GET", f"/open-apis/drive/v1/medias/{image_token}/download", content=PNG,
+               headers={"content-type": "image/png"})
+    assert api.get(f"/api/documents/image/doc/{image_token}?token=user-a").status_code == 200
+
+    _grant(feishu, image_token, allowed=False)
+    images, failed = asyncio.run(download_images([image_token], "user-b"))
+    assert images == [None]
+    assert failed == [{"image_token": image_token, "error": "无权访问该图片"}]
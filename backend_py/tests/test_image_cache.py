@@ -0,0 +1,105 @@
+"""
+图片磁盘缓存：内容寻址去重、并发合并下载、LRU淘汰、重启后重建索引、Range解析
+"""
+import os
+import asyncio
+
+import pytest
+
+from services.image_cache import ImageCache, parse_range
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 92
+
+
+def _fetcher(data, calls, delay=0):
+    async def fetch(writer):
+        calls.append(1)
+        await asyncio.sleep(delay)
+        await writer.write(data[:10])
+        await writer.write(data[10:])
+        return "application/octet-stream"
+    return fetch
+
+
+def test_concurrent_requests_share_one_download(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1024 * 1024)
+    calls = []
+
+    async def main():
+        fetch = _fetcher(PNG, calls, delay=0.05)
+        return await asyncio.gather(*(cache.get_or_fetch("img1", fetch) for _ in range(5)))
+
+    entries = asyncio.run(main())
+    assert len(calls) == 1
+    assert entries[0]["mime_type"] == "image/png" and entries[0]["size"] == len(PNG)
+    assert cache.stats["coalesced"] == 4
+    assert asyncio.run(cache.read(entries[0])) == PNG
+
+
+def test_same_content_is_stored_once(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1024 * 1024)
+    calls = []
+
+    async def main():
+        a = await cache.get_or_fetch("img1", _fetcher(PNG, calls))
+        b = await cache.get_or_fetch("img2", _fetcher(PNG, calls))
+        assert await cache.get_or_fetch("img1", _fetcher(PNG, calls)) is a
+        return a, b
+
+    a, b = asyncio.run(main())
+    assert a["path"] == b["path"]
+    assert len(calls) == 2
+    assert cache.snapshot()["bytes"] == len(PNG)
+
+
+def test_lru_eviction_removes_blob(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=250)
+    calls = []
+
+    async def main():
+        entries = []
+        for i in range(3):
+            data = PNG + bytes([i]) * 10
+            entries.append(await cache.get_or_fetch(f"img{i}", _fetcher(data, calls)))
+        return entries
+
+    entries = asyncio.run(main())
+    assert cache.lookup("img0") is None
+    assert not os.path.exists(entries[0]["path"])
+    assert cache.lookup("img2") is not None
+    assert cache.snapshot()["bytes"] <= 250 and cache.stats["evictions"] == 1
+
+
+def test_index_is_rebuilt_from_disk(tmp_path):
+    calls = []
+    asyncio.run(ImageCache(str(tmp_path), max_bytes=1024 * 1024).get_or_fetch("img1", _fetcher(PNG, calls)))
+
+    reloaded = ImageCache(str(tmp_path), max_bytes=1024 * 1024)
+    entry = reloaded.lookup("img1")
+    assert entry is not None and entry["size"] == len(PNG)
+    assert reloaded.snapshot()["entries"] == 1
+
+
+def test_failed_download_is_not_cached(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1024 * 1024)
+
+    async def fetch(writer):
+        await writer.write(b"partial")
+        raise RuntimeError("upstream failed")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.get_or_fetch("img1", fetch))
+    assert cache.lookup("img1") is None
+    assert os.listdir(tmp_path / "tmp") == []
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("bytes=abc", 100) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
@@ -0,0 +1,43 @@
+import io
+import asyncio
+
+from PIL import Image
+
+import config
+from services.image_pipeline import preprocess_images, shutdown_executor
+
+
+def _png(color, size=(64, 64), box=None) -> bytes:
+    img = Image.new("RGB", size, color)
+    if box is not None:
+        img.paste((0, 0, 0), box)
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _preprocess(images):
+    try:
+        return asyncio.run(preprocess_images(images))
+    finally:
+        shutdown_executor()
+
+
+def test_distinct_simple_images_are_kept_by_default():
+    assert config.IMAGE_DEDUP_DISTANCE == -1
+    # 纯色图片的 dHash 全部为0，感知去重会把它们当成同一张
+    images = [_png("white"), _png("red"), _png("blue"), _png("white", box=(0, 0, 64, 32))]
+    results = _preprocess(images)
+    assert len(results) == 4
+    assert len({img["sha256"] for img in results}) == 4
+
+
+def test_exact_duplicates_are_removed():
+    results = _preprocess([_png("white"), _png("red"), _png("white")])
+    assert len(results) == 2
+
+
+def test_perceptual_dedup_when_enabled(monkeypatch):
+    monkeypatch.setattr(config, "IMAGE_DEDUP_DISTANCE", 2)
+    results = _preprocess([_png("white"), _png("red")])
+    assert len(results) == 1
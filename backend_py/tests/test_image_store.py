@@ -0,0 +1,56 @@
+import os
+import time
+import asyncio
+import base64
+import hashlib
+
+import pytest
+
+from services.image_store import ImageStore, ImageMissingError
+
+
+def _put(store, data: bytes):
+    return asyncio.run(store.put(data, "image/png", hashlib.sha256(data).hexdigest()))
+
+
+def test_put_dedups_and_reads_back(tmp_path):
+    store = ImageStore(str(tmp_path), ttl=3600)
+    first = _put(store, b"png-1")
+    second = _put(store, b"png-1")
+    assert first == second == {"mime_type": "image/png", "sha256": hashlib.sha256(b"png-1").hexdigest(), "size": 5}
+    assert store.stats["stores"] == 1 and store.stats["dedup_hits"] == 1
+    assert asyncio.run(store.read(first)) == b"png-1"
+    # 旧会话中内联的base64数据
+    assert asyncio.run(store.read({"mime_type": "image/png", "data": base64.b64encode(b"old").decode()})) == b"old"
+
+
+def test_to_parts_keeps_positions(tmp_path):
+    store = ImageStore(str(tmp_path), ttl=3600)
+    refs = [_put(store, b"a"), _put(store, b"b")]
+    parts = asyncio.run(store.to_parts(refs))
+    assert [base64.b64decode(part["data"]) for part in parts] == [b"a", b"b"]
+
+    os.remove(store._path(refs[0]["sha256"]))
+    with pytest.raises(ImageMissingError, match="image_1"):
+        asyncio.run(store.to_parts(refs))
+    assert store.stats["missing"] == 1
+
+
+def test_gc_runs_off_the_event_loop(tmp_path):
+    store = ImageStore(str(tmp_path), ttl=60)
+
+    async def scenario():
+        old = await store.put(b"old", "image/png", hashlib.sha256(b"old").hexdigest())
+        await store._gc_task
+        past = time.time() - 120
+        os.utime(store._path(old["sha256"]), (past, past))
+        store._last_gc = 0.0
+        await store.put(b"new", "image/png", hashlib.sha256(b"new").hexdigest())
+        assert store._gc_task is not None
+        await store._gc_task
+        return old
+
+    old = asyncio.run(scenario())
+    assert not os.path.exists(store._path(old["sha256"]))
+    assert os.path.exists(store._path(hashlib.sha256(b"new").hexdigest()))
+    assert store.stats["removed"] == 1
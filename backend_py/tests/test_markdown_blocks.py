@@ -0,0 +1,105 @@
+import asyncio
+
+from services.markdown_blocks import (
+    MarkdownBlockCompiler, compile_markdown, acompile_markdown, parse_inline,
+    BLOCK_TEXT, BLOCK_HEADING1, BLOCK_BULLET, BLOCK_CODE, BLOCK_IMAGE, BLOCK_TABLE, BLOCK_TODO,
+)
+
+
+def _runs(text):
+    return [
+        (element["text_run"]["content"], element["text_run"].get("text_element_style", {}))
+        for element in parse_inline(text)
+    ]
+
+
+def test_italic_is_not_greedy():
+    assert _runs("_a_ and _b_") == [("a", {"italic": True}), (" and ", {}), ("b", {"italic": True})]
+    assert _runs("*a* and *b*") == [("a", {"italic": True}), (" and ", {}), ("b", {"italic": True})]
+    assert _runs("*斜体 文字*") == [("斜体 文字", {"italic": True})]
+
+
+def test_italic_ignores_word_underscores():
+    assert _runs("snake_case_name") == [("snake_case_name", {})]
+
+
+def test_nested_and_other_styles():
+    assert _runs("**粗体*斜体*部分**") == [
+        ("粗体", {"bold": True}), ("斜体", {"bold": True, "italic": True}), ("部分", {"bold": True})
+    ]
+    assert _runs("~~删除~~ `code`") == [
+        ("删除", {"strikethrough": True}), (" ", {}), ("code", {"inline_code": True})
+    ]
+    assert _runs("[链接](https://example.com/a?b=1)") == [
+        ("链接", {"link": {"url": "https%3A%2F%2Fexample.com%2Fa%3Fb%3D1"}})
+    ]
+
+
+def test_inline_image_ref_is_not_a_link():
+    assert _runs("见图 ![示意图](image_2) 所示") == [("见图 ![示意图](image_2) 所示", {})]
+    runs = _runs("见 ![图](image_2) 和 [链接](https://a.cn)")
+    assert runs[0] == ("见 ![图](image_2) 和 ", {})
+    assert all("image_2" not in style.get("link", {}).get("url", "") for _, style in runs)
+
+
+def test_block_types():
+    text = "\n".join([
+        "# 标题",
+        "- 列表",
+        "- [x] 完成",
+        "![图](image_1)",
+        "```python",
+        "print(1)",
+        "```",
+        "| a | b |",
+        "|---|---|",
+        "| 1 | 2 |",
+        "正文",
+    ])
+    blocks = list(compile_markdown([text]))
+    assert [block["block_type"] for block in blocks] == [
+        BLOCK_HEADING1, BLOCK_BULLET, BLOCK_TODO, BLOCK_IMAGE, BLOCK_CODE, BLOCK_TABLE, BLOCK_TEXT
+    ]
+    assert blocks[3]["image_ref"] == "image_1"
+    assert blocks[4]["code"]["elements"][0]["text_run"]["content"] == "print(1)"
+    assert blocks[5]["table"]["property"]["row_size"] == 2
+
+
+def test_feed_is_eager():
+    compiler = MarkdownBlockCompiler()
+    compiler.feed("# 标题\n正")  # 不使用返回值，输入也不能丢
+    blocks = compiler.feed("文\n")
+    blocks += compiler.close()
+    assert isinstance(blocks, list)
+    assert blocks[0]["text"]["elements"][0]["text_run"]["content"] == "正文"
+
+
+def test_chunked_matches_whole_text():
+    text = "# 标题\n\n段落 **粗体**\n```\ncode\n```\n| a |\n|---|\n| 1 |\n最后一行"
+    whole = list(compile_markdown([text]))
+    for size in (1, 3, 7):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert list(compile_markdown(chunks)) == whole
+
+
+def test_async_compile_matches_and_yields_to_other_tasks():
+    from services import markdown_blocks
+    text = "段落 **粗体**\n\n" * (markdown_blocks._FEED_SIZE // 8)
+    progress = []
+
+    async def other():
+        progress.append("other")
+
+    async def main():
+        task = asyncio.create_task(other())
+        blocks = []
+        async for block in acompile_markdown([text]):
+            if not progress:
+                progress.append("compiling")
+            blocks.append(block)
+        await task
+        return blocks
+
+    assert asyncio.run(main()) == list(compile_markdown([text]))
+    # 其他任务在第一段解析之前就已运行
+    assert progress[0] == "other"
@@ -0,0 +1,149 @@
+"""
+RoutingProvider：熔断器半开探测在调用被取消或流被提前关闭时也要释放；准入按成员提供商申请
+"""
+import time
+import asyncio
+
+import pytest
+
+import ai_provider
+from ai_provider import RoutingProvider
+from services import admission
+
+
+class EndlessStream(ai_provider.AIProvider):
+    async def astream(self, prompt, images=None, timeout=30):
+        while True:
+            yield "片段"
+            await asyncio.sleep(0)
+
+
+class SlowProvider(ai_provider.AIProvider):
+    async def agenerate(self, prompt, images=None, timeout=30):
+        await asyncio.sleep(60)
+
+
+@pytest.fixture
+def routing(monkeypatch):
+    def make(provider):
+        monkeypatch.setitem(ai_provider._registry, "test-member", provider)
+        router = RoutingProvider(["test-member"])
+        breaker = router.breakers["test-member"]
+        breaker.state = "open"
+        breaker.opened_at = time.monotonic() - breaker.cooldown - 1
+        return router, breaker
+    return make
+
+
+def test_stream_closed_early_releases_probe(routing):
+    router, breaker = routing(EndlessStream())
+
+    async def main():
+        stream = router.astream("prompt")
+        assert await stream.__anext__() == "片段"
+        assert breaker.state == "half_open" and breaker._probe_in_flight
+        await stream.aclose()  # GeneratorExit
+
+    asyncio.run(main())
+    assert not breaker._probe_in_flight
+    assert breaker.available()
+
+
+def test_stream_cancelled_releases_probe(routing):
+    router, breaker = routing(EndlessStream())
+
+    async def consume():
+        async for _ in router.astream("prompt"):
+            pass
+
+    async def main():
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert not breaker._probe_in_flight
+    assert breaker.available()
+
+
+def test_generate_cancelled_releases_probe(routing):
+    router, breaker = routing(SlowProvider())
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(router.agenerate("prompt", timeout=60), 0.05)
+
+    asyncio.run(main())
+    assert not breaker._probe_in_flight
+    assert breaker.available()
+
+
+class InstantProvider(ai_provider.AIProvider):
+    def __init__(self, name, seen):
+        super().__init__()
+        self.name = name
+        self.seen = seen
+
+    async def agenerate(self, prompt, images=None, timeout=30):
+        self.seen.append((self.name, admission.snapshot()[self.name]["running"]))
+        return "# 标题\n\n正文"
+
+
+def _full_controller(name):
+    controller = admission.AdmissionController(name, max_concurrency=1, max_queue=0, max_per_user=2)
+    controller.try_acquire(0, "someone-else")
+    return controller
+
+
+def test_failover_when_member_not_admitted(monkeypatch):
+    seen = []
+    monkeypatch.setitem(ai_provider._registry, "test-full", InstantProvider("test-full", seen))
+    monkeypatch.setitem(ai_provider._registry, "test-free", InstantProvider("test-free", seen))
+    full = _full_controller("test-full")
+    monkeypatch.setitem(admission._controllers, "test-full", full)
+    router = RoutingProvider(["test-full", "test-free"])
+
+    async def main():
+        admission.set_routed_request(admission.PRIORITY_CREATE, "user", time.monotonic() + 5)
+        return await router.agenerate("prompt")
+
+    assert asyncio.run(main()) == "# 标题\n\n正文"
+    assert seen == [("test-free", 1)]
+    assert full.rejected == 1
+    # 未获准入不计入熔断
+    assert router.breakers["test-full"].state == "closed"
+    assert admission.snapshot()["test-free"]["running"] == 0
+
+
+def _create(api):
+    return api.post(
+        "/api/ai/create",
+        json={
+            "doc_id": "doc_routed",
+            "blocks": [{"block_type": "text", "text": "素材"}],
+            "instruction": "写一篇文章",
+            "no_cache": True
+        },
+        headers={"Authorization": "Bearer user-routed"}
+    )
+
+
+def test_auto_mode_admits_against_member(api, monkeypatch):
+    seen = []
+    monkeypatch.setenv("AI_PROVIDER", "test-auto")
+    monkeypatch.setitem(ai_provider._registry, "test-routed", InstantProvider("test-routed", seen))
+    monkeypatch.setitem(ai_provider._registry, "test-auto", RoutingProvider(["test-routed"]))
+
+    response = _create(api)
+    assert response.status_code == 200
+    assert seen == [("test-routed", 1)]
+    assert "test-auto" not in admission.snapshot()
+    assert admission.snapshot()["test-routed"]["running"] == 0
+
+    # 成员提供商名额已满时返回 503 + Retry-After
+    monkeypatch.setitem(admission._controllers, "test-routed", _full_controller("test-routed"))
+    response = _create(api)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,112 @@
+"""
+会话存储：内存后端（闲置TTL、按字节数LRU）与共享后端（SQLiteKV，多实例共享同一文件）
+"""
+import time
+import asyncio
+
+from services.session_store import MemorySessionStore, SharedSessionStore, SQLiteKV
+
+
+def _session(text="正文"):
+    return {"current_article": text, "messages": [{"role": "user", "content": "写文章"}]}
+
+
+def test_memory_store_roundtrip_and_delete():
+    store = MemorySessionStore(ttl=60, max_bytes=1024 * 1024)
+
+    async def main():
+        await store.set("s1", _session())
+        assert (await store.get("s1"))["current_article"] == "正文"
+        assert await store.delete("s1")
+        assert not await store.delete("s1")
+        assert await store.get("s1") is None
+
+    asyncio.run(main())
+    assert store.snapshot()["bytes"] == 0
+
+
+def test_memory_store_idle_ttl(monkeypatch):
+    store = MemorySessionStore(ttl=10, max_bytes=1024 * 1024)
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    async def main():
+        await store.set("s1", _session())
+        now[0] += 8
+        assert await store.get("s1") is not None  # 访问后顺延过期时间
+        now[0] += 8
+        assert await store.get("s1") is not None
+        now[0] += 11
+        assert await store.get("s1") is None
+
+    asyncio.run(main())
+    assert store.stats["expirations"] == 1
+
+
+def test_memory_store_lru_eviction_keeps_latest():
+    store = MemorySessionStore(ttl=60, max_bytes=500)
+
+    async def main():
+        await store.set("s1", _session("x" * 150))
+        await store.set("s2", _session("x" * 150))
+        await store.get("s1")
+        await store.set("s3", _session("x" * 150))
+        assert await store.get("s2") is None
+        assert await store.get("s1") is not None
+        # 单个会话超过上限时仍保留刚保存的会话
+        await store.set("big", _session("x" * 1000))
+        assert await store.get("big") is not None
+
+    asyncio.run(main())
+    assert store.snapshot()["sessions"] == 1
+
+
+def test_sqlite_store_shared_between_instances(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    a = SharedSessionStore(SQLiteKV(path, 1024 * 1024), ttl=60, backend="sqlite")
+    b = SharedSessionStore(SQLiteKV(path, 1024 * 1024), ttl=60, backend="sqlite")
+
+    async def main():
+        await a.set("s1", _session("中文正文"))
+        assert (await b.get("s1"))["current_article"] == "中文正文"
+        assert await b.delete("s1")
+        assert await a.get("s1") is None
+
+    asyncio.run(main())
+    snapshot = a.snapshot()
+    assert snapshot["backend"] == "sqlite" and snapshot["keys"] == 0
+
+
+def test_sqlite_kv_expiry(tmp_path, monkeypatch):
+    kv = SQLiteKV(str(tmp_path / "kv.db"), 1024 * 1024)
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    async def main():
+        await kv.set("k", "v", ex=10)
+        now[0] += 5
+        assert await kv.expire("k", 10)
+        now[0] += 8
+        assert await kv.get("k") == b"v"
+        now[0] += 11
+        assert await kv.get("k") is None
+        assert not await kv.expire("k", 10)
+
+    asyncio.run(main())
+
+
+def test_sqlite_kv_evicts_least_recently_used(tmp_path, monkeypatch):
+    kv = SQLiteKV(str(tmp_path / "kv.db"), max_bytes=250)
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    monkeypatch.setattr(SQLiteKV, "_MAINTENANCE_INTERVAL", 1)
+
+    async def main():
+        for key in ("a", "b", "c"):
+            now[0] += 1
+            await kv.set(key, b"x" * 100)
+        assert await kv.get("a") is None
+        assert await kv.get("c") == b"x" * 100
+
+    asyncio.run(main())
+    assert kv.stats["evictions"] == 1
@@ -26,7 +26,7 @@ import {
 import ReactMarkdown from 'react-markdown'
 import remarkGfm from 'remark-gfm'
 import { documentService, Document, ContentBlock } from '@/services/documents'
-import { aiService, Message } from '@/services/ai'
+import { aiService, Message, PreviewData, PreviewImage } from '@/services/ai'
 
 const { Sider, Content } = Layout
 const { TextArea } = Input
@@ -46,7 +46,9 @@ export default function EditorWorkspace({ document, onBack }: Props) {
   const [sessionId, setSessionId] = useState<string | null>(null)
   const [messages, setMessages] = useState<Message[]>([])
   const [showPreview, setShowPreview] = useState(false)
-  const [previewImages, setPreviewImages] = useState<Array<{mime_type: string; data: string}>>([])
+  const [previewImages, setPreviewImages] = useState<PreviewImage[]>([])
+  // 已获取的预览版本号，之后只请求变化过的字段
+  const [previewVersion, setPreviewVersion] = useState<number | undefined>(undefined)
 
   useEffect(() => {
     loadContent()
@@ -102,9 +104,8 @@ export default function EditorWorkspace({ document, onBack }: Props) {
         
         // 首次生成后，自动加载预览数据（包含图片）
         try {
-          const previewData = await aiService.previewArticle(response.session_id)
-          setPreviewImages(previewData.images)
-          console.log(`Loaded ${previewData.images.length} images for preview`)
+          const previewData = applyPreview(await aiService.previewArticle(response.session_id))
+          console.log(`Loaded ${previewData.images?.length ?? 0} images for preview`)
         } catch (err) {
           console.error('加载图片失败:', err)
         }
@@ -118,8 +119,7 @@ export default function EditorWorkspace({ document, onBack }: Props) {
         
         // 精修后也刷新预览数据
         try {
-          const previewData = await aiService.previewArticle(sessionId)
-          setPreviewImages(previewData.images)
+          applyPreview(await aiService.previewArticle(sessionId, previewVersion))
         } catch (err) {
           console.error('加载图片失败:', err)
         }
@@ -149,6 +149,8 @@ export default function EditorWorkspace({ document, onBack }: Props) {
       }
     }
     setSessionId(null)
+    setPreviewImages([])
+    setPreviewVersion(undefined)
     setArticle('')
     setMessages([])
     setInstruction('')
@@ -207,9 +209,10 @@ export default function EditorWorkspace({ document, onBack }: Props) {
 
     try {
       setLoading(true)
-      const previewData = await aiService.previewArticle(sessionId)
-      setPreviewImages(previewData.images)
-      setArticle(previewData.article_content)
+      const previewData = applyPreview(await aiService.previewArticle(sessionId, previewVersion))
+      if (previewData.article_content !== undefined) {
+        setArticle(previewData.article_content)
+      }
       setShowPreview(true)
       message.success('预览加载成功')
     } catch (error: any) {
@@ -220,6 +223,15 @@ export default function EditorWorkspace({ document, onBack }: Props) {
     }
   }
 
+  // 合并预览数据：未返回的字段表示自上次获取后没有变化
+  const applyPreview = (previewData: PreviewData) => {
+    if (previewData.images) {
+      setPreviewImages(previewData.images)
+    }
+    setPreviewVersion(previewData.version)
+    return previewData
+  }
+
   // 渲染文章内容，将 ![alt](image_N) 替换为实际图片
   const renderArticleWithImages = (content: string) => {
     console.log('renderArticleWithImages called')
@@ -231,12 +243,11 @@ export default function EditorWorkspace({ document, onBack }: Props) {
       return <ReactMarkdown remarkPlugins={[remarkGfm]}>{content}</ReactMarkdown>
     }
 
-    // 替换图片占位符为实际的base64图片
+    // 替换图片占位符为图片URL（图片由浏览器按ETag缓存）
     let renderedContent = content
-    previewImages.forEach((img, index) => {
-      const placeholderRegex = new RegExp(`!\\[([^\\]]*)\\]\\(image_${index + 1}\\)`, 'g')
-      const imgTag = `![${img.mime_type}](data:${img.mime_type};base64,${img.data})`
-      console.log(`Replacing image_${index + 1} with base64 data (length: ${img.data?.length})`)
+    previewImages.forEach((img) => {
+      const placeholderRegex = new RegExp(`!\\[([^\\]]*)\\]\\(${img.id}\\)`, 'g')
+      const imgTag = `![$1](${aiService.getPreviewImageUrl(img)})`
       renderedContent = renderedContent.replace(placeholderRegex, imgTag)
     })
 
@@ -283,7 +294,8 @@ export default function EditorWorkspace({ document, onBack }: Props) {
                         </Text>
                       </div>
                       <Image
-                        src={documentService.getImageUrl(document.doc_id, block.image_token)}
+                        src={documentService.getImageUrl(document.doc_id, block.image_token, 640)}
+                        preview={{ src: documentService.getImageUrl(document.doc_id, block.image_token) }}
                         alt={`Image ${index}`}
                         className="rounded"
                       />
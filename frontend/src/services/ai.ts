@@ -16,6 +16,40 @@ export interface AIResponse {
   session_id: string
   content: string
   messages: Message[]
+  failed_images?: Array<{ image_token: string; error: string }>
+}
+
+// 预览中的图片引用，图片数据通过 url 单独获取（可被浏览器缓存）
+export interface PreviewImage {
+  id: string
+  sha256: string
+  mime_type: string
+  size?: number
+  url: string
+}
+
+export interface PreviewData {
+  session_id: string
+  doc_id: string
+  version: number
+  // 传入 since 时，只包含该版本之后变化过的字段
+  article_content?: string
+  images?: PreviewImage[]
+  original_blocks?: ContentBlock[]
+}
+
+// 局部精修的目标：某个标题下的章节，或 [range_start, range_end) 字符范围
+export interface RefineTarget {
+  section?: string
+  range_start?: number
+  range_end?: number
+}
+
+export interface StreamHandlers {
+  onDelta?: (text: string) => void
+  onMeta?: (meta: { session_id: string; provider: string; image_count: number }) => void
+  // 局部精修时，后续 delta 替换的原文范围
+  onSection?: (range: { start: number; end: number }) => void
 }
 
 class AIService {
@@ -53,13 +87,15 @@ class AIService {
    */
   async refineArticle(
     sessionId: string,
-    instruction: string
+    instruction: string,
+    target?: RefineTarget
   ): Promise<AIResponse> {
     const response = await axios.post(
       `${API_URL}/api/ai/refine`,
       {
         session_id: sessionId,
         instruction,
+        ...target,
       },
       {
         headers: this.getHeaders(),
@@ -68,6 +104,84 @@ class AIService {
     return response.data
   }
 
+  /**
+   * 以SSE方式读取流式生成结果，返回done事件的数据
+   */
+  private async readEventStream(
+    path: string,
+    body: Record<string, unknown>,
+    handlers: StreamHandlers
+  ): Promise<any> {
+    const response = await fetch(`${API_URL}${path}`, {
+      method: 'POST',
+      headers: {
+        ...this.getHeaders(),
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(body),
+    })
+    if (!response.ok || !response.body) {
+      throw new Error(`请求失败: ${response.status}`)
+    }
+
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ''
+    while (true) {
+      const { done, value } = await reader.read()
+      if (done) break
+      buffer += decoder.decode(value, { stream: true })
+
+      let sep
+      while ((sep = buffer.indexOf('\n\n')) !== -1) {
+        const raw = buffer.slice(0, sep)
+        buffer = buffer.slice(sep + 2)
+        const event = raw.match(/^event: (.*)$/m)?.[1]
+        const data = raw.match(/^data: (.*)$/m)?.[1]
+        if (!event || !data) continue
+        const payload = JSON.parse(data)
+        if (event === 'delta') handlers.onDelta?.(payload.content)
+        else if (event === 'meta') handlers.onMeta?.(payload)
+        else if (event === 'section') handlers.onSection?.(payload)
+        else if (event === 'error') throw new Error(payload.detail)
+        else if (event === 'done') return payload
+      }
+    }
+    throw new Error('流式响应意外结束')
+  }
+
+  /**
+   * 首次生成文章（流式）
+   */
+  async createArticleStream(
+    docId: string,
+    blocks: ContentBlock[],
+    instruction: string,
+    handlers: StreamHandlers = {}
+  ): Promise<{ session_id: string; content: string }> {
+    return this.readEventStream(
+      '/api/ai/create/stream',
+      { doc_id: docId, blocks, instruction },
+      handlers
+    )
+  }
+
+  /**
+   * 精修文章（流式）
+   */
+  async refineArticleStream(
+    sessionId: string,
+    instruction: string,
+    handlers: StreamHandlers = {},
+    target?: RefineTarget
+  ): Promise<AIResponse> {
+    return this.readEventStream(
+      '/api/ai/refine/stream',
+      { session_id: sessionId, instruction, ...target },
+      handlers
+    )
+  }
+
   /**
    * 重置会话
    */
@@ -91,23 +205,26 @@ class AIService {
   }
 
   /**
-   * 预览重新排版后的文章（包含图片）
+   * 预览重新排版后的文章（图片以引用返回）
+   * @param since 已有的预览版本号，只获取之后变化过的字段
    */
-  async previewArticle(sessionId: string): Promise<{
-    session_id: string
-    doc_id: string
-    article_content: string
-    images: Array<{mime_type: string; data: string}>
-    original_blocks: ContentBlock[]
-  }> {
+  async previewArticle(sessionId: string, since?: number): Promise<PreviewData> {
     const response = await axios.get(
       `${API_URL}/api/ai/preview/${sessionId}`,
       {
         headers: this.getHeaders(),
+        params: since !== undefined ? { since } : undefined,
       }
     )
     return response.data
   }
+
+  /**
+   * 获取预览图片的完整URL
+   */
+  getPreviewImageUrl(image: PreviewImage): string {
+    return `${API_URL}${image.url}`
+  }
 }
 
 export const aiService = new AIService()
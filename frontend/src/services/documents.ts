@@ -65,11 +65,12 @@ class DocumentService {
   }
 
   /**
-   * 获取图片URL
+   * 获取图片URL（传入 width 时返回缩略图）
    */
-  getImageUrl(docId: string, imageToken: string): string {
+  getImageUrl(docId: string, imageToken: string, width?: number): string {
     const token = authService.getToken()
-    return `${API_URL}/api/documents/image/${docId}/${imageToken}?token=${token}`
+    const url = `${API_URL}/api/documents/image/${docId}/${imageToken}?token=${token}`
+    return width ? `${url}&w=${width}` : url
   }
 
   /**
@@ -78,7 +79,7 @@ class DocumentService {
   async createFeishuCopy(
     title: string,
     content: string,
-    images: Array<{mime_type: string; data: string}>
+    images: Array<{mime_type: string; data?: string; sha256?: string}>
   ): Promise<{doc_id: string; doc_url: string; message: string}> {
     const response = await axios.post(
       `${API_URL}/api/documents/create`,